@@ -0,0 +1,225 @@
+"""Versioned JSON API (/api/v1) for scripts and other non-browser clients.
+
+Requests authenticate with ``Authorization: Bearer <token>`` (tokens are
+created from a logged-in browser session at POST /api/v1/tokens) or with the
+browser session itself. ``POST /api/v1/entries/batch`` applies many creates,
+updates and deletes in one transaction and reports a result per item.
+"""
+from datetime import datetime
+from functools import wraps
+import hmac
+
+from cryptography.fernet import InvalidToken
+from flask import Blueprint, current_app, g, jsonify, request, session
+
+import dbtrace
+from crypto import encrypt_password, decrypt_password, fingerprint_password
+from envelope import (UserCipher, api_token_hash, new_api_token_secret, unwrap_dek_for_token,
+                      wrap_dek_for_token)
+from models import (apply_password_batch, create_api_token, get_api_token, touch_api_token, list_api_tokens,
+                    revoke_api_token, get_password, get_user_passwords_page, get_vault_version, log_audit)
+from security import validate_password_strength
+from vault_version import vault_etag, replica_behind, not_modified, with_etag
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+OPERATIONS = ('create', 'update', 'delete')
+
+
+def error(message, status, **extra):
+    return dict(extra, error=message), status
+
+
+def _token_user(header):
+    """(user_id, cipher) for a valid bearer token, else None"""
+    token_id, _, secret = header[len('Bearer '):].strip().partition('.')
+    if not token_id.isdigit() or not secret:
+        return None
+    app = current_app
+    row = get_api_token(int(token_id), app.get_directory_db)
+    if row is None or not hmac.compare_digest(bytes(row['token_hash']), api_token_hash(secret)):
+        return None
+    cipher = app.dek_cache.get(row['user_id'])
+    if cipher is None:
+        try:
+            cipher = UserCipher(unwrap_dek_for_token(row['dek_wrapped'], secret), app.key)
+        except InvalidToken:
+            return None
+        app.dek_cache.put(row['user_id'], cipher)
+    if row['last_used_at'] is None or row['stale']:
+        touch_api_token(row['id'], app.get_directory_db)
+    return row['user_id'], cipher
+
+
+def api_auth(session_only=False):
+    """Require a bearer token or a logged-in session; sets g.api_user_id and g.api_cipher"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            header = request.headers.get('Authorization', '')
+            if header.startswith('Bearer ') and not session_only:
+                user = _token_user(header)
+                if user is None:
+                    return error('invalid or expired token', 401)
+                g.api_user_id, g.api_cipher = user
+                if current_app.use_user_shard(g.api_user_id).moving and request.method != 'GET':
+                    return error('the vault is being moved; retry shortly', 503) + ({'Retry-After': '10'},)
+            elif session.get('user_id') and session.get('dek'):
+                # A cross-site form cannot send JSON, so this also stops CSRF
+                if request.method == 'POST' and not request.is_json:
+                    return error('expected a JSON body', 415)
+                g.api_user_id, g.api_cipher = session['user_id'], current_app.user_cipher()
+            else:
+                return error('authentication required', 401)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+@api.route('/tokens', methods=['POST'])
+@api_auth(session_only=True)
+def create_token():
+    """Issue a token for the logged-in user; the secret is only shown in this response"""
+    body = request.get_json(silent=True) or {}
+    name = str(body.get('name') or 'api').strip()[:100]
+    days = body.get('expires_in_days')
+    if days is not None and (not isinstance(days, int) or days < 1):
+        return error('expires_in_days must be a positive integer', 400)
+
+    secret = new_api_token_secret()
+    dek = current_app.session_dek()
+    token_id, expires_at = create_api_token(g.api_user_id, name, api_token_hash(secret),
+                                            wrap_dek_for_token(dek, secret), days, current_app.get_directory_db)
+    log_audit(g.api_user_id, 'create_api_token', f'Created API token {token_id} ({name})', request.remote_addr,
+              current_app.get_db, current_app.audit_writer)
+    return {'id': token_id, 'name': name, 'token': f'{token_id}.{secret}',
+            'expires_at': expires_at.isoformat() if expires_at else None}, 201, {'Cache-Control': 'no-store'}
+
+
+@api.route('/tokens', methods=['GET'])
+@api_auth()
+def list_tokens():
+    tokens = [{key: (value.isoformat() if isinstance(value, datetime) else value) for key, value in row.items()}
+              for row in list_api_tokens(g.api_user_id, current_app.get_directory_db)]
+    return {'tokens': tokens}
+
+
+@api.route('/tokens/<int:token_id>', methods=['DELETE'])
+@api_auth()
+def revoke_token(token_id):
+    if not revoke_api_token(token_id, g.api_user_id, current_app.get_directory_db):
+        return error('token not found', 404)
+    log_audit(g.api_user_id, 'revoke_api_token', f'Revoked API token {token_id}', request.remote_addr,
+              current_app.get_db, current_app.audit_writer)
+    return {'revoked': token_id}
+
+
+@api.route('/entries', methods=['GET'])
+@api_auth()
+def list_entries():
+    """One page of entries without their passwords, ordered by (service, id)"""
+    user_id = g.api_user_id
+    etag = vault_etag(user_id, lambda: get_vault_version(user_id, current_app.get_db))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    config = current_app.config
+    limit = max(1, min(request.args.get('limit', config['DASHBOARD_PAGE_SIZE'], type=int), config['DASHBOARD_MAX_PAGE_SIZE']))
+    after_id = request.args.get('after_id', type=int)
+    after = (request.args.get('after_service', ''), after_id) if after_id is not None else None
+    rows, next_cursor = get_user_passwords_page(user_id, current_app.get_read_db, after, limit)
+    if replica_behind(lambda: get_vault_version(user_id, current_app.get_read_db)):
+        rows, next_cursor = get_user_passwords_page(user_id, current_app.get_db, after, limit)
+    return with_etag(jsonify(
+        entries=[{'id': row['id'], 'service': row['service'], 'username': row['username']} for row in rows],
+        next={'after_service': next_cursor[0], 'after_id': next_cursor[1]} if next_cursor else None), etag)
+
+
+@api.route('/entries/<int:entry_id>', methods=['GET'])
+@api_auth()
+def get_entry(entry_id):
+    row = get_password(entry_id, g.api_user_id, current_app.get_read_db)
+    if row is None:
+        return error('entry not found', 404)
+    log_audit(g.api_user_id, 'reveal_password', f'Revealed password ID {entry_id} via API', request.remote_addr,
+              current_app.get_db, current_app.audit_writer)
+    return {'id': row['id'], 'service': row['service'], 'username': row['username'],
+            'password': decrypt_password(row['password'], g.api_cipher)}, 200, {'Cache-Control': 'no-store'}
+
+
+def _validate(item, seen_ids):
+    """Check one batch operation; returns an error message or None"""
+    if not isinstance(item, dict) or item.get('op') not in OPERATIONS:
+        return 'op must be one of: ' + ', '.join(OPERATIONS)
+    if item['op'] != 'create':
+        if not isinstance(item.get('id'), int):
+            return 'id is required'
+        if item['id'] in seen_ids:
+            return 'id {} appears more than once in the batch'.format(item['id'])
+        seen_ids.add(item['id'])
+    if item['op'] == 'delete':
+        return None
+    for field, max_length in (('service', 100), ('username', 100)):
+        value = item.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return '{} is required'.format(field)
+        if len(value) > max_length:
+            return '{} is too long'.format(field)
+    if not isinstance(item.get('password'), str):
+        return 'password is required'
+    is_valid, message = validate_password_strength(item['password'])
+    return None if is_valid else message
+
+
+@api.route('/entries/batch', methods=['POST'])
+@dbtrace.budget(max_queries=None, repeat_threshold=None)  # execute_values pages grow with the batch
+@api_auth()
+def batch():
+    """Apply ``{"operations": [{"op": "create"|"update"|"delete", ...}]}`` atomically.
+
+    Every item is validated first; if any is invalid, or an update/delete
+    targets an entry that does not exist, nothing is applied.
+    """
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return error('expected a JSON object with a non-empty "operations" list', 400)
+    if len(operations) > current_app.config['API_BATCH_MAX_SIZE']:
+        return error('at most {} operations per batch'.format(current_app.config['API_BATCH_MAX_SIZE']), 413)
+
+    seen_ids = set()
+    results = []
+    for index, item in enumerate(operations):
+        message = _validate(item, seen_ids)
+        results.append({'index': index, 'op': item.get('op') if isinstance(item, dict) else None,
+                        'status': 'error' if message else 'ok', **({'error': message} if message else {})})
+    if any(result['status'] == 'error' for result in results):
+        return {'applied': False, 'results': results}, 422
+
+    user_id, cipher, key = g.api_user_id, g.api_cipher, current_app.fingerprint_key
+    creates, updates, deletes = [], [], []
+    for item in operations:
+        if item['op'] == 'delete':
+            deletes.append(item['id'])
+            continue
+        row = (item['service'].strip(), item['username'].strip(), encrypt_password(item['password'], cipher),
+               fingerprint_password(item['password'], key, user_id))
+        if item['op'] == 'create':
+            creates.append(row)
+        else:
+            updates.append((item['id'],) + row)
+
+    created, missing = apply_password_batch(user_id, creates, updates, deletes, current_app.get_db)
+    if missing:
+        for result, item in zip(results, operations):
+            if item.get('id') in missing:
+                result.update(status='error', error='entry not found')
+        return {'applied': False, 'results': results}, 409
+
+    created = iter(created)
+    for result, item in zip(results, operations):
+        result['id'] = next(created) if item['op'] == 'create' else item['id']
+    log_audit(user_id, 'api_batch', f'API batch: {len(creates)} created, {len(updates)} updated, {len(deletes)} deleted',
+              request.remote_addr, current_app.get_db, current_app.audit_writer)
+    return {'applied': True, 'results': results}
@@ -1,13 +1,42 @@
-from flask import Flask, request, render_template, redirect, url_for, session, flash
+from flask import Flask, Response, request, redirect, url_for, session, flash, g, stream_with_context
+from flask import render_template as flask_render_template
 from config import Config
-from models import init_db, save_password, delete_password, update_password, get_user_passwords, get_password, log_audit
-from security import init_limiter, validate_password_strength, hash_password, verify_password, generate_secure_password
-from crypto import load_key, encrypt_password, decrypt_password
+from models import (init_db, save_password, delete_password, update_password, get_user_passwords_page, get_password,
+                    search_passwords_prefix, search_passwords_fuzzy, get_reused_passwords, get_vault_version,
+                    log_audit, get_audit_history_page, create_audit_partitions, get_user_credentials, update_user_keys,
+                    record_login, find_directory_user, find_directory_email, reserve_user, release_user, create_user,
+                    next_user_id, init_user_keys)
+from security import (init_limiter, validate_password_strength, hash_password, verify_password, needs_rehash,
+                      GenerationPolicy, generate_passwords, generation_entropy, HashingPool, HashingBusy)
+from crypto import load_key, load_fingerprint_key, encrypt_password, decrypt_password, fingerprint_password
+from pool import ConnectionPool
+from replicas import ReplicaRouter
+from shards import ShardEntry, ShardMap, init_shard_ids, placement_shard, shard_connect_kwargs
+from audit import AuditWriter
+from envelope import DEKCache, SessionKeyRetired, UserCipher, generate_dek, new_salt, wrap_dek, unwrap_dek
+from cryptography.fernet import InvalidToken
+import psycopg2
+from psycopg2.pool import PoolError
+from metrics import REGISTRY
+import dbtrace
+from strength import estimate
+from api import api
+from errors import register_error_handlers
+from availability import AvailabilityIndex, normalize
+from assets import Assets, URL_PREFIX as ASSETS_URL_PREFIX
+from vault_version import VaultVersionCache, vault_etag, replica_behind, not_modified, with_etag
+from datetime import datetime
 from functools import wraps
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-import psycopg2
+import threading
+import time
+
+
+def render_template(template_name, **context):
+    with REGISTRY.time('template_render_duration_seconds', template=template_name):
+        return flask_render_template(template_name, **context)
 
 
 def create_app():
@@ -27,28 +56,350 @@ def create_app():
     # Rate limiter
     limiter = init_limiter(app)
 
-    # Database connection
-    def get_db():
-        return psycopg2.connect(
-            dbname=app.config['POSTGRES_DB'],
-            user=app.config['POSTGRES_USER'],
-            password=app.config['POSTGRES_PASSWORD'],
-            host=app.config['POSTGRES_HOST'],
-            port=app.config['POSTGRES_PORT']
+    # Metrics: per-route latency, aggregated across workers through METRICS_DIR
+    REGISTRY.configure(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    # Startup work that needs the database or the key files (initialize,
+    # below) runs on the first request that needs it, not at import
+    @app.before_request
+    def ensure_initialized():
+        if request.endpoint in ('livez', 'metrics', 'static', 'assets'):
+            return
+        try:
+            app.initialize()
+        except (psycopg2.Error, PoolError, OSError) as e:
+            app.logger.error('Initialization failed: %s', e)
+            return 'Service is starting; please try again in a moment.', 503, {'Retry-After': '5'}
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            REGISTRY.observe('http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+            REGISTRY.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    # Per-request database budget; checked at teardown so streamed responses count in full
+    @app.before_request
+    def start_db_trace():
+        if app.config['DB_TRACE']:
+            g.db_trace_token = dbtrace.start(app.config['DB_TRACE_SLOW_QUERY_MS'])
+
+    @app.teardown_request
+    def check_db_trace(exc):
+        token = g.pop('db_trace_token', None)
+        if token is None:
+            return
+        trace = dbtrace.finish(token)
+        endpoint = request.endpoint or 'unmatched'
+        REGISTRY.observe('db_request_queries', trace.queries, endpoint=endpoint)
+        REGISTRY.observe('db_request_connections', trace.connections, endpoint=endpoint)
+        limits = dict(max_queries=app.config['DB_TRACE_MAX_QUERIES'],
+                      max_connections=app.config['DB_TRACE_MAX_CONNECTIONS'],
+                      repeat_threshold=app.config['DB_TRACE_REPEAT_THRESHOLD'])
+        limits.update(getattr(app.view_functions.get(request.endpoint), 'db_budget', {}))
+        problems = trace.problems(**limits)
+        if not problems:
+            return
+        for reason, _ in problems:
+            REGISTRY.inc('db_budget_exceeded_total', endpoint=endpoint, reason=reason)
+        message = '{} {} ({} rows, {:.0f} ms in the database): {}'.format(
+            request.method, request.path, trace.rows, trace.duration * 1000, '; '.join(text for _, text in problems))
+        if app.config['DB_TRACE_STRICT']:
+            raise dbtrace.QueryBudgetExceeded(message)
+        app.logger.warning('Database budget exceeded by %s', message)
+
+    # Database connection pools, one per shard; shard 0 (POSTGRES_*) also
+    # holds the user directory and the API tokens
+    def make_pool(minconn, **kwargs):
+        return ConnectionPool(
+            minconn=minconn,
+            maxconn=app.config['DB_POOL_MAX_SIZE'],
+            timeout=app.config['DB_POOL_TIMEOUT'],
+            max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+            max_idle=app.config['DB_POOL_MAX_IDLE'],
+            ping_interval=app.config['DB_POOL_PING_INTERVAL'],
+            **kwargs
         )
 
+    shard_kwargs = shard_connect_kwargs(app.config)
+    app.shard_pools = [make_pool(app.config['DB_POOL_MIN_SIZE'], **kwargs) for kwargs in shard_kwargs]
+    app.db_pool = app.shard_pools[0]
+    app.shard_map = ShardMap(app.db_pool, app.config['SHARD_MAP_CACHE_TTL'], app.config['SHARD_MAP_CACHE_SIZE'])
+
+    def get_shard_db(shard):
+        """Return the request's pooled connection to ``shard``, checking one out on first use"""
+        conns = g.setdefault('db_conns', {})
+        if shard not in conns:
+            conns[shard] = app.shard_pools[shard].getconn()
+        return conns[shard]
+
+    def get_db():
+        """Return the request's connection to the shard of the user it acts for"""
+        return get_shard_db(g.get('shard', 0))
+
+    def get_directory_db():
+        return get_shard_db(0)
+
+    def use_user_shard(user_id):
+        """Route this request's queries to the user's shard; returns the user's ShardEntry"""
+        if len(app.shard_pools) == 1:
+            return ShardEntry(0, False)
+        entry = app.shard_map.get(user_id)
+        g.shard = entry.shard
+        return entry
+
+    @app.before_request
+    def route_to_shard():
+        if session.get('user_id') and use_user_shard(session['user_id']).moving and request.method != 'GET':
+            return 'Your vault is being moved; please try again in a moment.', 503, {'Retry-After': '10'}
+
+    # Read replicas (of shard 0) for read-only queries, with the same pool settings
+    app.replicas = ReplicaRouter(
+        app.config['POSTGRES_REPLICA_DSNS'],
+        check_interval=app.config['REPLICA_CHECK_INTERVAL'],
+        max_lag=app.config['REPLICA_MAX_LAG'],
+        connect_timeout=app.config['REPLICA_CONNECT_TIMEOUT'],
+        minconn=0,
+        maxconn=app.config['DB_POOL_MAX_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+        max_idle=app.config['DB_POOL_MAX_IDLE'],
+        ping_interval=app.config['DB_POOL_PING_INTERVAL']
+    )
+
+    def get_read_db():
+        """Return a connection for read-only queries.
+
+        Reads go to a healthy replica, except when this request already
+        uses the primary or the session wrote within READ_YOUR_WRITES_SECONDS
+        (a replica may not have replayed the write yet); then, and when no
+        replica is available, they go to the primary. Users on other shards
+        always read from their shard.
+        """
+        if g.get('shard', 0) != 0 or 0 in g.get('db_conns', ()) or not app.replicas:
+            return get_db()
+        if 'read_db_conn' in g:
+            return g.read_db_conn
+        if time.time() - session.get('db_written_at', 0) < app.config['READ_YOUR_WRITES_SECONDS']:
+            return get_db()
+        checkout = app.replicas.getconn()
+        if checkout is None:
+            return get_db()
+        g.read_db_replica, g.read_db_conn = checkout
+        return g.read_db_conn
+
+    @app.after_request
+    def stick_to_primary(response):
+        # A request that may have written pins the session's reads to the primary for a while
+        if request.method != 'GET' and 0 in g.get('db_conns', ()) and app.replicas:
+            session['db_written_at'] = time.time()
+        return response
+
+    @app.teardown_appcontext
+    def release_db(exc):
+        for shard, conn in g.pop('db_conns', {}).items():
+            app.shard_pools[shard].putconn(conn)
+        conn = g.pop('read_db_conn', None)
+        if conn is not None:
+            app.replicas.putconn(g.pop('read_db_replica'), conn)
+
     app.get_db = get_db
+    app.get_shard_db = get_shard_db
+    app.get_directory_db = get_directory_db
+    app.get_read_db = get_read_db
+    app.use_user_shard = use_user_shard
 
-    # Initialize DB and load key
-    with app.app_context():
-        init_db(app.get_db)
-        app.key = load_key()
+    # Audit events are written in batches off the request thread
+    app.audit_writer = None
+    if app.config['AUDIT_ASYNC']:
+        app.audit_writer = AuditWriter(
+            app.db_pool,
+            max_queue=app.config['AUDIT_QUEUE_SIZE'],
+            batch_size=app.config['AUDIT_BATCH_SIZE'],
+            flush_interval=app.config['AUDIT_FLUSH_INTERVAL'],
+            overflow=app.config['AUDIT_OVERFLOW'],
+            route=(lambda user_id: app.shard_pools[app.shard_map.get(user_id).shard]) if len(app.shard_pools) > 1 else None
+        )
+
+    def pool_metrics():
+        stats = app.db_pool.stats()
+        samples = [('db_pool_connections', {'state': state}, stats[state]) for state in ('size', 'idle', 'in_use', 'max')]
+        samples += [('db_pool_events', {'event': event}, stats[event])
+                    for event in ('checkouts', 'waits', 'timeouts', 'created', 'discarded', 'recycled', 'failed_checks')]
+        for replica in app.replicas.stats():
+            labels = {'replica': replica['replica']}
+            samples += [('db_replica_healthy', labels, int(replica['healthy'])), ('db_replica_lag_seconds', labels, replica['lag']),
+                        ('db_replica_failures', labels, replica['failures']), ('db_replica_connections', labels, replica['in_use'])]
+        for shard, pool in enumerate(app.shard_pools[1:], 1):
+            stats = pool.stats()
+            samples += [('db_shard_pool_connections', {'shard': shard, 'state': state}, stats[state])
+                        for state in ('size', 'idle', 'in_use', 'max')]
+        if app.audit_writer is not None:
+            samples += [('audit_writer_events', {'event': event}, value) for event, value in app.audit_writer.stats().items()]
+        return samples
+
+    REGISTRY.add_collector(pool_metrics)
+
+    # Schema (every shard) and keys are set up once per process; a worker
+    # forked after the master ran it (gunicorn.conf.py) only warms its pools
+    app.initialized = False
+    app.key = app.fingerprint_key = None
+    init_lock = threading.Lock()
+    warmed = {'pid': None}
+
+    def initialize(warm=True):
+        """Migrate and check every shard, load the keys and warm this process's pools; idempotent"""
+        with init_lock:
+            if not app.initialized:
+                with app.app_context():
+                    for shard in range(len(app.shard_pools)):
+                        g.shard = shard
+                        init_db(app.get_db)
+                        try:
+                            create_audit_partitions(app.config['AUDIT_PARTITIONS_AHEAD'], app.get_db)
+                        except psycopg2.Error:
+                            # Events still land in the default partition, so serve
+                            # requests and leave it to audit_retention.py to catch up
+                            app.logger.exception('Creating audit_log partitions failed on shard %d', shard)
+                            REGISTRY.inc('audit_partition_failures_total', shard=shard)
+                    init_shard_ids([get_shard_db(shard) for shard in range(len(app.shard_pools))])
+                app.key = load_key()
+                app.fingerprint_key = load_fingerprint_key()
+                app.initialized = True
+            if warm and warmed['pid'] != os.getpid():
+                for pool in app.shard_pools:
+                    pool.warm()
+                app.availability.start()
+                warmed['pid'] = os.getpid()
+
+    app.initialize = initialize
+
+    # Breached-password corpus: memory-mapped, so workers share the page cache
+    app.breach_corpus = None
+    if app.config['BREACHED_PASSWORDS_FILE']:
+        from breach import BreachCorpus
+        app.breach_corpus = BreachCorpus(app.config['BREACHED_PASSWORDS_FILE'])
+
+    # Password hashing and key derivation run off the request thread
+    app.hashing = HashingPool(app.config['HASH_WORKERS'], app.config['HASH_MAX_PENDING'], app.config['HASH_TIMEOUT'])
+
+    @app.errorhandler(SessionKeyRetired)
+    def session_key_retired(error):
+        if request.blueprint == 'api':
+            return {'error': 'session expired; log in again'}, 401
+        flash('Your session has expired. Please log in again.', 'warning')
+        return redirect(url_for('login'))
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(error):
+        return 'Server busy, please try again in a moment.', 503, {'Retry-After': '2'}
+
+    def hash_master_password(password):
+        return app.hashing.run(hash_password, password, app.config['PASSWORD_HASH_METHOD'])
+
+    # Vault versions behind the ETags of the vault views; other workers'
+    # writes arrive through LISTEN/NOTIFY
+    app.vault_versions = VaultVersionCache(
+        [lambda kwargs=kwargs: psycopg2.connect(**kwargs) for kwargs in shard_kwargs],
+        ttl=app.config['VAULT_VERSION_CACHE_TTL'],
+        listen=app.config['VAULT_VERSION_LISTEN']
+    )
+    # Taken usernames and emails, so the registration form's checks rarely query
+    app.availability = AvailabilityIndex(
+        lambda: psycopg2.connect(**shard_kwargs[0]),
+        capacity=app.config['AVAILABILITY_FILTER_CAPACITY'],
+        error_rate=app.config['AVAILABILITY_FILTER_ERROR_RATE']
+    )
+
+    # Hashed, precompressed static files from `python assets.py build`
+    app.assets = Assets(app.static_folder)
+    app.add_template_global(app.assets.url, 'asset_url')
+
+    # Changes with the templates and the asset build, so a deploy invalidates cached pages
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    app.build_id = format(int(max(os.path.getmtime(os.path.join(template_dir, name))
+                                  for name in os.listdir(template_dir))), 'x') + app.assets.version
+
+    @app.route(ASSETS_URL_PREFIX + '/<path:filename>')
+    @limiter.exempt
+    def assets(filename):
+        return app.assets.send(filename)
+
+    @app.after_request
+    def invalidate_vault_version(response):
+        # This worker's next read of a changed vault must not be served from cache
+        if request.method != 'GET':
+            user_id = g.get('api_user_id') or session.get('user_id')
+            if user_id:
+                app.vault_versions.invalidate(user_id)
+        return response
+
+    # Unwrapped per-user data keys
+    app.dek_cache = DEKCache(app.config['DEK_CACHE_SIZE'], app.config['DEK_CACHE_TTL'])
+
+    def open_vault(user, master_password):
+        """Unwrap the user's data key at login, creating one for users that predate envelope encryption"""
+        if not user['dek_wrapped']:
+            dek = generate_dek()
+            salt = new_salt()
+            iterations = app.config['KDF_ITERATIONS']
+            dek_wrapped = app.hashing.run(wrap_dek, dek, master_password, salt, iterations)
+            if not init_user_keys(user['id'], dek_wrapped, salt, iterations, app.get_db):
+                # A concurrent login stored its key first: unwrap that one instead
+                user = get_user_credentials(user['id'], app.get_db)
+        if user['dek_wrapped']:
+            dek = app.hashing.run(unwrap_dek, user['dek_wrapped'], master_password, user['dek_salt'], user['kdf_iterations'])
+        # The session keeps the data key encrypted under the server key ring so
+        # any worker can rebuild the cipher without the master password
+        session['dek'] = app.key.encrypt(dek).decode()
+        app.dek_cache.put(user['id'], UserCipher(dek, app.key))
+
+    def session_dek():
+        try:
+            return app.key.decrypt(session['dek'].encode())
+        except InvalidToken:
+            # Encrypted under a key retired since login; only the master password can recover it
+            session.clear()
+            raise SessionKeyRetired()
+
+    def user_cipher():
+        """Return the cipher of the logged-in user's vault"""
+        user_id = session['user_id']
+        cipher = app.dek_cache.get(user_id)
+        if cipher is None:
+            cipher = UserCipher(session_dek(), app.key)
+            app.dek_cache.put(user_id, cipher)
+        return cipher
+
+    def fill_fingerprints(user_id):
+        """Fingerprint the user's entries saved before fingerprints existed.
+
+        Only the user's session can decrypt the ones under their data key, so
+        this runs at login rather than from backfill_fingerprints.py. Entries
+        that still cannot be decrypted are skipped and counted as unchecked.
+        """
+        from backfill_fingerprints import backfill_fingerprints
+        conn = app.get_db()
+        try:
+            backfill_fingerprints(conn, user_cipher(), app.fingerprint_key, user_id)
+        except psycopg2.Error:
+            conn.rollback()
+            app.logger.exception('Filling fingerprints failed for user %d', user_id)
+
+    app.user_cipher = user_cipher
+    app.session_dek = session_dek
 
     # Login decorator
     def login_required(f):
         @wraps(f)
         def decorated(*args, **kwargs):
-            if not session.get('user_id'):
+            if not session.get('user_id') or not session.get('dek'):
                 flash('Please log in to access this page.', 'warning')
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
@@ -59,28 +410,42 @@ def create_app():
         return redirect(url_for('login'))
 
     @app.route('/login', methods=['GET', 'POST'])
+    @dbtrace.budget(max_queries=None, repeat_threshold=None)  # fill_fingerprints runs a batch at a time
     @limiter.limit("5 per minute")
     def login():
         if request.method == 'POST':
-            username = request.form['username']
+            username = normalize(request.form['username'])
             password = request.form['password']
 
-            conn = app.get_db()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT id, hashed_password FROM users WHERE username = %s", (username,))
-                    user = cur.fetchone()
-
-                    if user and verify_password(user[1], password):
-                        session['user_id'] = user[0]
-                        log_audit(user[0], 'login', 'Successful login', request.remote_addr, app.get_db)
-                        flash('Login successful!', 'success')
-                        return redirect(url_for('dashboard'))
-                    
-                    log_audit(None, 'login_failed', f'Failed login attempt for {username}', request.remote_addr, app.get_db)
-                    flash('Invalid username or password', 'danger')
-            finally:
-                conn.close()
+            # The directory says which shard holds the user. Credentials are
+            # read from the primaries: a lagging replica could still accept an
+            # old master password or miss a data key stored by another login.
+            entry = find_directory_user(username, app.get_directory_db)
+            if entry is not None and entry['moving']:
+                flash('Your vault is being moved; please try again in a moment.', 'warning')
+                return render_template('login.html')
+            user = None
+            if entry is not None:
+                g.shard = entry['shard']
+                user = get_user_credentials(entry['user_id'], app.get_db)
+
+            if user and app.hashing.run(verify_password, user['hashed_password'], password):
+                session.clear()
+                session['user_id'] = user['id']
+                open_vault(user, password)
+
+                # Upgrade hashes made under an older policy while we have the plaintext
+                new_hash = None
+                if needs_rehash(user['hashed_password'], app.config['PASSWORD_HASH_METHOD']):
+                    new_hash = hash_master_password(password)
+                record_login(user['id'], app.get_db, new_hash)
+                fill_fingerprints(user['id'])
+                log_audit(user['id'], 'login', 'Successful login', request.remote_addr, app.get_db, app.audit_writer)
+                flash('Login successful!', 'success')
+                return redirect(url_for('dashboard'))
+            
+            log_audit(None, 'login_failed', f'Failed login attempt for {username}', request.remote_addr, app.get_db, app.audit_writer)
+            flash('Invalid username or password', 'danger')
 
         return render_template('login.html')
 
@@ -88,56 +453,130 @@ def create_app():
     @limiter.limit("3 per minute")
     def register():
         if request.method == 'POST':
-            username = request.form['username']
-            email = request.form['email']
+            username = normalize(request.form['username'])
+            email = normalize(request.form['email'])
             password = request.form['password']
             
             is_valid, message = validate_password_strength(password)
             if not is_valid:
                 flash(message, 'danger')
                 return render_template('register.html')
+
+            # Spare the hashing for names already taken; reserve_user below still decides races
+            if (app.availability.is_taken('username', username, lambda value: find_directory_user(value, app.get_directory_db))
+                    or app.availability.is_taken('email', email, lambda value: find_directory_email(value, app.get_directory_db))):
+                flash('Registration error: username or email already registered.', 'danger')
+                return render_template('register.html')
             
-            hashed_password = hash_password(password)
+            hashed_password = hash_master_password(password)
+            salt = new_salt()
+            iterations = app.config['KDF_ITERATIONS']
+            dek_wrapped = app.hashing.run(wrap_dek, generate_dek(), password, salt, iterations)
             
-            conn = app.get_db()
+            # Ids come from the new user's shard; the directory makes the
+            # username and email unique across shards
+            shard = placement_shard(username, len(app.shard_pools))
+            user_id = next_user_id(lambda: app.get_shard_db(shard))
+            if not reserve_user(user_id, username, email, shard, app.get_directory_db):
+                flash('Registration error: username or email already registered.', 'danger')
+                return render_template('register.html')
+            app.availability.add(username, email)
+            g.shard = shard
             try:
-                with conn.cursor() as cur:
-                    try:
-                        cur.execute("""
-                            INSERT INTO users (username, email, hashed_password)
-                            VALUES (%s, %s, %s) RETURNING id
-                        """, (username, email, hashed_password))
-                        user_id = cur.fetchone()[0]
-                        conn.commit()
-                        
-                        log_audit(user_id, 'register', 'New user registration', request.remote_addr, app.get_db)
-                        flash('Registration successful! Please log in.', 'success')
-                        return redirect(url_for('login'))
-                    except Exception as e:
-                        conn.rollback()
-                        flash(f'Registration error: {str(e)}', 'danger')
-            finally:
-                conn.close()
+                create_user(user_id, username, email, hashed_password, dek_wrapped, salt, iterations, app.get_db)
+            except psycopg2.Error as e:
+                release_user(user_id, app.get_directory_db)
+                flash(f'Registration error: {str(e)}', 'danger')
+                return render_template('register.html')
+
+            log_audit(user_id, 'register', 'New user registration', request.remote_addr, app.get_db, app.audit_writer)
+            flash('Registration successful! Please log in.', 'success')
+            return redirect(url_for('login'))
 
         return render_template('register.html')
 
+    @app.route('/register/availability')
+    @limiter.limit("60 per minute")
+    def registration_availability():
+        """Whether the username and/or email typed into the registration form are free"""
+        lookups = {'username': (find_directory_user, 50), 'email': (find_directory_email, 120)}
+        result = {}
+        for field, (find, max_length) in lookups.items():
+            value = normalize(request.args.get(field, ''))
+            if not value:
+                continue
+            if len(value) > max_length:
+                return {'error': '{} is too long'.format(field)}, 400
+            taken = app.availability.is_taken(field, value, lambda value, find=find: find(value, app.get_directory_db))
+            result[field] = {'available': not taken}
+        return result, 200, {'Cache-Control': 'no-store'}
+
     @app.route('/dashboard')
     @login_required
     def dashboard():
         user_id = session['user_id']
-        passwords = get_user_passwords(user_id, app.get_db)
-        
-        decrypted_passwords = [
-            {
-                'id': pwd['id'],
-                'service': pwd['service'],
-                'username': pwd['username'],
-                'password': decrypt_password(pwd['password'], app.key)
-            }
-            for pwd in passwords
-        ]
-        
-        return render_template('dashboard.html', passwords=decrypted_passwords)
+        limit = request.args.get('limit', app.config['DASHBOARD_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['DASHBOARD_MAX_PAGE_SIZE']))
+        after_id = request.args.get('after_id', type=int)
+        after = (request.args.get('after_service', ''), after_id) if after_id is not None else None
+        q = request.args.get('q', '').strip()
+
+        etag = vault_etag(user_id, lambda: get_vault_version(user_id, app.get_db))
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        def load_page(get_db_func):
+            if q:
+                return search_passwords_prefix(user_id, q, get_db_func, after, limit)
+            return get_user_passwords_page(user_id, get_db_func, after, limit)
+
+        # Passwords stay encrypted here; /reveal/<id> decrypts one on demand
+        passwords, next_cursor = load_page(app.get_read_db)
+        if replica_behind(lambda: get_vault_version(user_id, app.get_read_db)):
+            passwords, next_cursor = load_page(app.get_db)
+
+        return with_etag(app.make_response(render_template('dashboard.html', passwords=passwords, next_cursor=next_cursor,
+                                                           limit=limit, first_page=after is None, q=q)), etag)
+
+    @app.route('/search')
+    @login_required
+    def search():
+        """JSON search over service and username; passwords are returned encrypted"""
+        q = request.args.get('q', '').strip()
+        mode = request.args.get('mode', 'prefix')
+        limit = request.args.get('limit', app.config['DASHBOARD_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['DASHBOARD_MAX_PAGE_SIZE']))
+        after_id = request.args.get('after_id', type=int)
+        if not q or mode not in ('prefix', 'fuzzy'):
+            return {'error': 'q is required and mode must be prefix or fuzzy'}, 400
+
+        # Trigrams need a few characters; shorter fuzzy queries behave as prefixes
+        if mode == 'fuzzy' and len(q) >= app.config['SEARCH_FUZZY_MIN_LENGTH']:
+            after = (request.args.get('after_score', 0.0, type=float), after_id) if after_id is not None else None
+            rows, next_cursor = search_passwords_fuzzy(session['user_id'], q, app.get_read_db, after, limit)
+            next_page = {'after_score': next_cursor[0], 'after_id': next_cursor[1]} if next_cursor else None
+        else:
+            mode = 'prefix'
+            after = (request.args.get('after_service', ''), after_id) if after_id is not None else None
+            rows, next_cursor = search_passwords_prefix(session['user_id'], q, app.get_read_db, after, limit)
+            next_page = {'after_service': next_cursor[0], 'after_id': next_cursor[1]} if next_cursor else None
+
+        results = [{'id': row['id'], 'service': row['service'], 'username': row['username'],
+                    'password': row['password']} for row in rows]
+        return {'query': q, 'mode': mode, 'results': results, 'next': next_page}, 200, {'Cache-Control': 'no-store'}
+
+    @app.route('/reveal/<int:id>', methods=['POST'])
+    @login_required
+    def reveal(id):
+        password = get_password(id, session['user_id'], app.get_read_db)
+        if not password:
+            return {'error': 'Password not found'}, 404
+
+        log_audit(session['user_id'], 'reveal_password', f'Revealed password ID {id}', request.remote_addr, app.get_db, app.audit_writer)
+        response = app.make_response({'password': decrypt_password(password['password'], user_cipher())})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
 
     @app.route('/save', methods=['POST'])
     @login_required
@@ -151,10 +590,11 @@ def create_app():
             flash(message, 'danger')
             return redirect(url_for('dashboard'))
         
-        encrypted = encrypt_password(password, app.key)
-        save_password(service, username, encrypted, session['user_id'], app.get_db)
+        encrypted = encrypt_password(password, user_cipher())
+        fingerprint = fingerprint_password(password, app.fingerprint_key, session['user_id'])
+        save_password(service, username, encrypted, session['user_id'], app.get_db, fingerprint)
         
-        log_audit(session['user_id'], 'save_password', f'Saved password for {service}', request.remote_addr, app.get_db)
+        log_audit(session['user_id'], 'save_password', f'Saved password for {service}', request.remote_addr, app.get_db, app.audit_writer)
         flash('Password saved!', 'success')
         return redirect(url_for('dashboard'))
 
@@ -162,7 +602,7 @@ def create_app():
     @login_required
     def delete(id):
         delete_password(id, session['user_id'], app.get_db)
-        log_audit(session['user_id'], 'delete_password', f'Deleted password ID {id}', request.remote_addr, app.get_db)
+        log_audit(session['user_id'], 'delete_password', f'Deleted password ID {id}', request.remote_addr, app.get_db, app.audit_writer)
         flash('Password deleted!', 'success')
         return redirect(url_for('dashboard'))
 
@@ -179,14 +619,15 @@ def create_app():
                 flash(message, 'danger')
                 return redirect(url_for('edit', id=id))
             
-            encrypted = encrypt_password(password, app.key)
-            update_password(id, service, username, encrypted, session['user_id'], app.get_db)
+            encrypted = encrypt_password(password, user_cipher())
+            fingerprint = fingerprint_password(password, app.fingerprint_key, session['user_id'])
+            update_password(id, service, username, encrypted, session['user_id'], app.get_db, fingerprint)
             
-            log_audit(session['user_id'], 'update_password', f'Updated password for {service}', request.remote_addr, app.get_db)
+            log_audit(session['user_id'], 'update_password', f'Updated password for {service}', request.remote_addr, app.get_db, app.audit_writer)
             flash('Password updated!', 'success')
             return redirect(url_for('dashboard'))
         
-        password = get_password(id, session['user_id'], app.get_db)
+        password = get_password(id, session['user_id'], app.get_read_db)
         if not password:
             flash('Password not found.', 'danger')
             return redirect(url_for('dashboard'))
@@ -195,20 +636,191 @@ def create_app():
             'id': password['id'],
             'service': password['service'],
             'username': password['username'],
-            'password': decrypt_password(password['password'], app.key)
+            'password': decrypt_password(password['password'], user_cipher())
         }
         
         return render_template('edit.html', password=decrypted)
 
+    @app.route('/reuse-report')
+    @login_required
+    def reuse_report():
+        """Entries that share a password, grouped by fingerprint"""
+        groups, unchecked = get_reused_passwords(session['user_id'], app.get_read_db)
+        return {'groups': groups, 'unchecked': unchecked}, 200, {'Cache-Control': 'no-store'}
+
+    @app.route('/audit-history')
+    @login_required
+    def audit_history():
+        """The user's own audit events, newest first, a keyset page at a time"""
+        limit = request.args.get('limit', app.config['AUDIT_HISTORY_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, app.config['DASHBOARD_MAX_PAGE_SIZE']))
+        before_id = request.args.get('before_id', type=int)
+        before = None
+        if before_id is not None:
+            try:
+                before = (datetime.fromisoformat(request.args.get('before_at', '')), before_id)
+            except ValueError:
+                return redirect(url_for('audit_history', limit=limit))
+
+        events, next_cursor = get_audit_history_page(session['user_id'], app.get_read_db, before, limit)
+        response = app.make_response(render_template('audit_history.html', events=events, next_cursor=next_cursor,
+                                                      limit=limit, first_page=before is None))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    @app.route('/import', methods=['POST'])
+    @dbtrace.budget(max_queries=None, repeat_threshold=None)  # a few statements per batch of rows
+    @login_required
+    @limiter.limit("10 per hour")
+    def import_vault():
+        # The bulk modules are only loaded by the workers that need them
+        from vault_io import VaultImportError, iter_csv, iter_json, import_passwords
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or JSON file to import.', 'danger')
+            return redirect(url_for('dashboard'))
+
+        fmt = request.form.get('format') or ('json' if upload.filename.lower().endswith(('.json', '.jsonl')) else 'csv')
+        rows = iter_json(upload.stream) if fmt == 'json' else iter_csv(upload.stream)
+        try:
+            imported, rejected, weak = import_passwords(rows, session['user_id'], app.get_db, session_dek(), app.key, app.fingerprint_key,
+                                                        app.config['BULK_IMPORT_BATCH_SIZE'], app.config['BULK_IMPORT_WORKERS'],
+                                                        app.config['MIN_PASSWORD_SCORE'])
+        except VaultImportError as e:
+            flash(f'Import failed: {e}', 'danger')
+            return redirect(url_for('dashboard'))
+
+        # One summarizing audit record for the whole import
+        log_audit(session['user_id'], 'bulk_import', f'Imported {imported} passwords ({len(rejected)} rejected)', request.remote_addr, app.get_db, app.audit_writer)
+        flash(f'Imported {imported} passwords.', 'success')
+        if weak:
+            flash(f'{weak} imported passwords are easy to guess; consider changing them.', 'warning')
+        if rejected:
+            details = '; '.join(f'row {number}: {reason}' for number, reason in rejected[:5])
+            flash(f'{len(rejected)} rows skipped ({details}).', 'warning')
+        return redirect(url_for('dashboard'))
+
+    @app.route('/export')
+    @login_required
+    @limiter.limit("10 per hour")
+    def export_vault():
+        from vault_io import export_passwords
+        fmt = 'json' if request.args.get('format') == 'json' else 'csv'
+        log_audit(session['user_id'], 'bulk_export', f'Exported vault as {fmt}', request.remote_addr, app.get_db, app.audit_writer)
+
+        # Rows are read through a server-side cursor and sent as they are decrypted
+        chunks = export_passwords(session['user_id'], app.get_read_db, user_cipher(), fmt)
+        return Response(stream_with_context(chunks),
+                        mimetype='application/json' if fmt == 'json' else 'text/csv',
+                        headers={'Content-Disposition': f'attachment; filename=vault.{fmt}',
+                                 'Cache-Control': 'no-store'})
+
+    @app.route('/change-master-password', methods=['GET', 'POST'])
+    @login_required
+    def change_master_password():
+        if request.method == 'POST':
+            current_password = request.form['senha_atual']
+            new_password = request.form['nova_senha']
+            user_id = session['user_id']
+
+            user = get_user_credentials(user_id, app.get_db)
+            if not app.hashing.run(verify_password, user['hashed_password'], current_password):
+                log_audit(user_id, 'change_master_password_failed', 'Wrong current master password', request.remote_addr, app.get_db, app.audit_writer)
+                return render_template('change_master_password.html', erro='Senha atual incorreta.')
+
+            if new_password != request.form.get('confirmar_senha', new_password):
+                return render_template('change_master_password.html', erro='As senhas não coincidem.')
+
+            is_valid, message = validate_password_strength(new_password)
+            if not is_valid:
+                return render_template('change_master_password.html', erro=message)
+
+            # Only the data key is re-wrapped; vault entries stay untouched
+            salt = new_salt()
+            iterations = app.config['KDF_ITERATIONS']
+            dek_wrapped = app.hashing.run(wrap_dek, session_dek(), new_password, salt, iterations)
+            update_user_keys(user_id, dek_wrapped, salt, iterations, app.get_db,
+                             hashed_password=hash_master_password(new_password))
+
+            log_audit(user_id, 'change_master_password', 'Master password changed', request.remote_addr, app.get_db, app.audit_writer)
+            flash('Master password changed!', 'success')
+            return redirect(url_for('dashboard'))
+
+        return render_template('change_master_password.html')
+
+    @app.route('/password-strength', methods=['POST'])
+    @limiter.limit("30 per minute")
+    def password_strength():
+        """Score and feedback for a candidate password, plus whether the policy accepts it"""
+        password = request.form.get('password', '')
+        result = estimate(password)
+        is_valid, message = validate_password_strength(password)
+        return {'score': result.score, 'guesses_log10': round(result.guesses_log10, 2),
+                'feedback': result.feedback, 'valid': is_valid, 'message': message}, 200, {'Cache-Control': 'no-store'}
+
     @app.route('/generate-password')
     @login_required
     def generate_password():
-        return {'password': generate_secure_password()}
+        """One or many random passwords (or passphrases) following the query-string policy"""
+        args = request.args
+
+        def flag(name, default=True):
+            return args.get(name, '1' if default else '0').lower() in ('1', 'true', 'yes', 'on')
+
+        count = args.get('count', 1, type=int)
+        if not 1 <= count <= app.config['GENERATE_MAX_COUNT']:
+            return {'error': 'count must be between 1 and {}'.format(app.config['GENERATE_MAX_COUNT'])}, 400
+        try:
+            policy = GenerationPolicy(
+                length=args.get('length', 16, type=int),
+                lowercase=flag('lowercase'), uppercase=flag('uppercase'),
+                digits=flag('digits'), symbols=flag('symbols'),
+                exclude_ambiguous=flag('exclude_ambiguous', False),
+                passphrase=args.get('mode') == 'passphrase',
+                words=args.get('words', 6, type=int),
+                separator=args.get('separator', '-')[:3])
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        wordlist = app.config['PASSPHRASE_WORDLIST']
+        passwords = generate_passwords(count, policy, wordlist)
+        return {'password': passwords[0], 'passwords': passwords,
+                'entropy_bits': round(generation_entropy(policy, wordlist), 1)}, 200, {'Cache-Control': 'no-store'}
+
+    @app.route('/metrics')
+    @limiter.exempt
+    def metrics():
+        return REGISTRY.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    # Liveness: the process answers, without touching the database
+    @app.route('/livez')
+    @limiter.exempt
+    def livez():
+        return {'status': 'alive'}
+
+    # Readiness: initialized (ensure_initialized answers 503 until then) and every shard reachable
+    @app.route('/readyz')
+    @dbtrace.budget(max_connections=None)
+    @limiter.exempt
+    def readyz():
+        try:
+            for shard in range(len(app.shard_pools)):
+                with app.get_shard_db(shard).cursor() as cur:
+                    cur.execute("SELECT 1")
+        except (psycopg2.Error, PoolError) as e:
+            app.logger.warning('Readiness check failed: %s', e)
+            return {'status': 'unavailable'}, 503
+        return {'status': 'ready'}
+
+    # JSON API for scripts (bearer tokens or the browser session)
+    app.register_blueprint(api)
+    register_error_handlers(app)
 
     @app.route('/logout')
     def logout():
         if 'user_id' in session:
-            log_audit(session['user_id'], 'logout', 'User logged out', request.remote_addr)
+            app.dek_cache.invalidate(session['user_id'])
+            log_audit(session['user_id'], 'logout', 'User logged out', request.remote_addr, app.get_db, app.audit_writer)
         session.clear()
         flash('You have been logged out.', 'info')
         return redirect(url_for('login'))
@@ -221,5 +833,6 @@ app = create_app()
 
 # Only used locally
 if __name__ == '__main__':
+    app.initialize()
     with app.app_context():
         app.run(host="0.0.0.0", debug=app.config['DEBUG'])
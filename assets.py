@@ -0,0 +1,207 @@
+"""Static asset build: vendoring, minification, content hashes and precompression.
+
+    python assets.py vendor    # fetch Bootstrap and bootstrap-icons into static/vendor/
+    python assets.py build     # write static/dist/ and its manifest.json
+
+``build`` copies every file under static/ (except dist/) to
+``static/dist/<dir>/<name>.<hash>.<ext>``, minifying CSS on the way and
+pointing its ``url()`` references at the hashed files, and stores ``.gz``
+and ``.br`` variants of the text assets next to them. The app serves those
+under /assets/ with immutable cache headers, so a browser that has a page's
+assets never asks for them again; a changed file gets a new name. Earlier
+builds' files are kept so pages cached before a deploy still find theirs.
+
+Templates reference assets through ``asset_url(name)``. Before a build it
+falls back to /static/, or to the CDN for vendored files not fetched yet.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+URL_PREFIX = '/assets'
+
+# Pinned third-party assets: path under static/ -> upstream URL
+VENDOR = {
+    'vendor/bootstrap/bootstrap.min.css':
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'vendor/bootstrap-icons/bootstrap-icons.css':
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/bootstrap-icons.css',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff2':
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/fonts/bootstrap-icons.woff2',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff':
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/fonts/bootstrap-icons.woff',
+}
+
+# Worth precompressing; fonts and images already are
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # in order of preference
+
+_STRING = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+_HASHED = re.compile(r'\.[0-9a-f]{12}\.[A-Za-z0-9]+$')
+
+
+def minify_css(text):
+    """Drop comments and whitespace, leaving strings untouched"""
+    parts = _STRING.split(text)
+    for i in range(0, len(parts), 2):
+        code = _COMMENT.sub('', parts[i])
+        code = re.sub(r'\s+', ' ', code)
+        code = re.sub(r'\s*([{};,>])\s*', r'\1', code)
+        parts[i] = code.replace(';}', '}')
+    return ''.join(parts).strip()
+
+
+def _rewrite_urls(text, name, manifest):
+    """Point the url() references of a CSS file at their hashed files"""
+    def replace(match):
+        ref = match.group(2)
+        if ref.startswith(('data:', 'http:', 'https:', '/', '#')):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), re.split(r'[?#]', ref)[0]))
+        if target not in manifest:
+            return match.group(0)
+        return 'url({}/{})'.format(URL_PREFIX, manifest[target])
+    return _URL.sub(replace, text)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _sources(static_dir):
+    for root, dirs, files in os.walk(static_dir):
+        rel = os.path.relpath(root, static_dir)
+        if rel == DIST or rel.startswith(DIST + os.sep):
+            dirs[:] = []
+            continue
+        for filename in files:
+            yield posixpath.normpath(posixpath.join(rel.replace(os.sep, '/'), filename))
+
+
+def build(static_dir=STATIC_DIR, report=None):
+    """Write the hashed, minified and precompressed assets; returns the manifest"""
+    import brotli
+
+    manifest = {}
+    # CSS last, so the files it references already have their hashed names
+    for name in sorted(_sources(static_dir), key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            text = data.decode('utf-8')
+            if not name.endswith('.min.css'):
+                text = minify_css(text)
+            text = re.sub(r'/\*# sourceMappingURL=.*?\*/', '', text)
+            data = _rewrite_urls(text, name, manifest).encode('utf-8')
+        stem, ext = posixpath.splitext(name)
+        hashed = '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:12], ext)
+        path = os.path.join(static_dir, DIST, hashed)
+        _write(path, data)
+        if ext in COMPRESSIBLE:
+            for suffix, compressed in (('.br', brotli.compress(data, quality=11)),
+                                       ('.gz', gzip.compress(data, 9, mtime=0))):
+                if len(compressed) < len(data):
+                    _write(path + suffix, compressed)
+        manifest[name] = hashed
+        if report:
+            report('{} -> {}'.format(name, hashed))
+    _write(os.path.join(static_dir, DIST, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return manifest
+
+
+def vendor(static_dir=STATIC_DIR, force=False, report=None):
+    """Download the pinned third-party assets that are not in static/ yet"""
+    for name, url in VENDOR.items():
+        path = os.path.join(static_dir, name)
+        if os.path.exists(path) and not force:
+            continue
+        with urllib.request.urlopen(url, timeout=30) as response:
+            _write(path, response.read())
+        if report:
+            report('{} <- {}'.format(name, url))
+
+
+class Assets:
+    """The build's manifest, for templates and the /assets/ route"""
+
+    def __init__(self, static_dir=STATIC_DIR):
+        self.static_dir = static_dir
+        self.dist = os.path.join(static_dir, DIST)
+        try:
+            with open(os.path.join(self.dist, MANIFEST), 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b'{}'
+        self.manifest = json.loads(raw)
+        self._hashed = set(self.manifest.values())
+        self._variants = {hashed + suffix for hashed in self._hashed for _, suffix in ENCODINGS
+                          if os.path.exists(os.path.join(self.dist, hashed + suffix))}
+        # Part of the page ETags: pages embed the hashed URLs
+        self.version = hashlib.sha256(raw).hexdigest()[:8] if self.manifest else ''
+
+    def url(self, name):
+        """URL of the asset at ``name`` (a path under static/)"""
+        hashed = self.manifest.get(name)
+        if hashed is not None:
+            return '{}/{}'.format(URL_PREFIX, hashed)
+        if name in VENDOR and not os.path.exists(os.path.join(self.static_dir, name)):
+            return VENDOR[name]
+        return url_for('static', filename=name)
+
+    def send(self, filename):
+        """Response for /assets/<filename>, precompressed when the client accepts it.
+
+        Files of earlier builds are served while they are still in dist/;
+        their names are content hashes, so they can never be stale.
+        """
+        if filename in self._hashed:
+            variants = self._variants
+        elif _HASHED.search(filename) and os.path.isfile(safe_join(self.dist, filename) or ''):
+            variants = {filename + suffix for _, suffix in ENCODINGS
+                        if os.path.isfile(safe_join(self.dist, filename + suffix))}
+        else:
+            abort(404)
+        for encoding, suffix in ENCODINGS:
+            if encoding in request.accept_encodings and filename + suffix in variants:
+                response = send_from_directory(self.dist, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.dist, filename)
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vendor and build the static assets')
+    parser.add_argument('command', choices=('vendor', 'build'))
+    parser.add_argument('--force', action='store_true', help='vendor: download again even if present')
+    args = parser.parse_args()
+    if args.command == 'vendor':
+        vendor(force=args.force, report=print)
+    else:
+        build(report=print)
+
+
+if __name__ == '__main__':
+    main()
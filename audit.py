@@ -0,0 +1,157 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+
+from models import audit_time, log_audit_batch
+
+logger = logging.getLogger(__name__)
+
+
+class AuditWriter:
+    """Background writer that batches audit events into multi-row INSERTs.
+
+    Events are queued in a bounded in-process queue and flushed by a daemon
+    thread whenever ``batch_size`` events are pending or ``flush_interval``
+    seconds have passed. When the queue is full the event is either handed
+    back to the caller to be written synchronously (``overflow='sync'``) or
+    dropped and counted (``overflow='drop'``). Pending events are flushed on
+    interpreter shutdown. Events are stamped when submitted, not when
+    written; a batch that fails is retried one event at a time. With ``route``, each event is written to the pool
+    ``route(user_id)`` returns (the user's shard); events without a user go
+    to ``pool``.
+    """
+
+    def __init__(self, pool, max_queue=10000, batch_size=200, flush_interval=1.0, overflow='sync', route=None):
+        if overflow not in ('sync', 'drop'):
+            raise ValueError("overflow must be 'sync' or 'drop'")
+        self.pool = pool
+        self.route = route
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self._pid = None
+        self._lock = threading.Lock()
+        self._counters = {'queued': 0, 'flushed': 0, 'batches': 0, 'dropped': 0, 'sync_fallback': 0, 'failed': 0}
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        """Start the writer thread once per process (fork-safe)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def submit(self, user_id, action, details, ip_address):
+        """Queue an event; return False if the caller must write it synchronously"""
+        self._ensure_started()
+        event = (user_id, action, details, ip_address, audit_time())
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            if self.overflow == 'drop':
+                self._count('dropped')
+                return True
+            self._count('sync_fallback')
+            return False
+        self._count('queued')
+        return True
+
+    def _drain(self, first, deadline):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if self.route is None:
+            self._write_to(self.pool, batch)
+            return
+        by_pool = {}
+        for event in batch:
+            try:
+                pool = self.route(event[0]) if event[0] is not None else self.pool
+            except Exception:
+                self._count('failed')
+                logger.exception('Failed to find the shard of user %s', event[0])
+                continue
+            by_pool.setdefault(pool, []).append(event)
+        for pool, events in by_pool.items():
+            self._write_to(pool, events)
+
+    def _write_to(self, pool, batch):
+        try:
+            with pool.connection() as conn:
+                failed = self._insert(conn, batch)
+        except Exception:
+            failed = len(batch)
+            logger.exception('Failed to write %d audit events', len(batch))
+        else:
+            self._count('batches')
+        if failed:
+            self._count('failed', failed)
+        self._count('flushed', len(batch) - failed)
+
+    def _insert(self, conn, batch):
+        """Insert a batch, or its events one by one if that fails; returns the number lost"""
+        try:
+            log_audit_batch(batch, lambda: conn)
+            return 0
+        except psycopg2.Error:
+            if len(batch) == 1:
+                logger.exception('Failed to write a %s audit event', batch[0][1])
+                return 1
+            # One bad event (say, of a user deleted meanwhile) must not take the others with it
+            logger.warning('Failed to write %d audit events at once; retrying one at a time', len(batch), exc_info=True)
+        return sum(self._insert(conn, [event]) for event in batch)
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._write(self._drain(first, time.monotonic() + self.flush_interval))
+
+    def close(self, timeout=10):
+        """Flush pending events and stop the writer thread"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        # Anything the thread did not get to is written here
+        pending = []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(pending), self.batch_size):
+            self._write(pending[i:i + self.batch_size])
+        self._pid = None
+
+    def stats(self):
+        """Return the writer counters"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize() if self._pid == os.getpid() else 0
+        return stats
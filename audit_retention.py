@@ -0,0 +1,147 @@
+"""Audit log retention: archive expired monthly partitions, then drop them.
+
+    python audit_retention.py [--keep-months N] [--archive-dir DIR] [--dry-run]
+
+Run it daily from cron or a scheduler. It first creates the upcoming
+partitions and the partitions of any month with rows in the default
+partition, moving those rows out of it, then, for every partition whose month ended more than
+``--keep-months`` months ago, streams its rows through a server-side cursor
+into ``DIR/audit_log_yYYYYmMM.jsonl.gz`` (one JSON object per line) and
+detaches and drops the partition in one transaction once the archive is on
+disk and its row count matches. A run that is interrupted leaves the
+partition in place, so the job can simply be run again.
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+from datetime import date
+
+import psycopg2
+from psycopg2 import sql
+
+from config import Config
+from models import create_audit_partitions
+from shards import shard_connect_kwargs
+
+PARTITION_NAME = re.compile(r'^audit_log_y(\d{4})m(\d{2})$')
+COLUMNS = ('id', 'user_id', 'action', 'details', 'ip_address', 'created_at')
+
+
+def month_offset(month, months):
+    """The first day of the month ``months`` after (or before) ``month``"""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def expired_partitions(conn, keep_months, today=None):
+    """Names of the monthly partitions that ended before the retention cutoff, oldest first"""
+    today = today or date.today()
+    cutoff = month_offset(today.replace(day=1), -keep_months)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'audit_log'::regclass
+        """)
+        names = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    expired = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match and month_offset(date(int(match.group(1)), int(match.group(2)), 1), 1) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def archive_partition(conn, name, archive_dir, batch_size=5000):
+    """Write every row of partition ``name`` to a gzip JSONL file; returns (path, rows)"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, name + '.jsonl.gz')
+    tmp = path + '.tmp'
+    count = 0
+    try:
+        with open(tmp, 'wb') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8') as out:
+                with conn.cursor(name='archive_' + name) as cur:
+                    cur.itersize = batch_size
+                    cur.execute(sql.SQL('SELECT {} FROM {} ORDER BY created_at, id').format(
+                        sql.SQL(', ').join(map(sql.Identifier, COLUMNS)), sql.Identifier(name)))
+                    for row in cur:
+                        record = dict(zip(COLUMNS, row))
+                        record['created_at'] = record['created_at'].isoformat()
+                        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        count += 1
+            raw.flush()
+            os.fsync(raw.fileno())
+        conn.rollback()
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return path, count
+
+
+def drop_partition(conn, name, expected_rows):
+    """Detach and drop partition ``name`` if it still holds ``expected_rows`` rows"""
+    with conn.cursor() as cur:
+        # Detaching locks the parent; give up rather than queue the app's inserts behind us
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        cur.execute(sql.SQL('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE').format(sql.Identifier(name)))
+        cur.execute(sql.SQL('SELECT COUNT(*) FROM {}').format(sql.Identifier(name)))
+        rows = cur.fetchone()[0]
+        if rows != expected_rows:
+            conn.rollback()
+            raise RuntimeError('{} changed while it was archived ({} rows, {} archived)'.format(name, rows, expected_rows))
+        cur.execute(sql.SQL('ALTER TABLE audit_log DETACH PARTITION {}').format(sql.Identifier(name)))
+        cur.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(name)))
+    conn.commit()
+
+
+def oldest_default_month(conn):
+    """The first day of the month of the oldest row in the default partition, or None when it is empty"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT date_trunc('month', MIN(created_at))::date FROM audit_log_default")
+        month = cur.fetchone()[0]
+    conn.rollback()
+    return month
+
+
+def run_retention(conn, keep_months, archive_dir, months_ahead=3, dry_run=False, report=print):
+    """Create upcoming partitions and empty the default partition into monthly
+    ones, then archive and drop the expired partitions"""
+    first_month = oldest_default_month(conn)
+    if first_month is not None:
+        report('{} default partition rows from {:%Y-%m} on.'.format(
+            'Would move' if dry_run else 'Moving', first_month))
+    created = 0 if dry_run else create_audit_partitions(months_ahead, lambda: conn, first_month)
+    if created:
+        report('Created {} partitions.'.format(created))
+    for name in expired_partitions(conn, keep_months):
+        if dry_run:
+            report('Would archive and drop {}.'.format(name))
+            continue
+        path, rows = archive_partition(conn, name, archive_dir)
+        drop_partition(conn, name, rows)
+        report('Archived {} rows of {} to {} and dropped it.'.format(rows, name, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive and drop expired audit log partitions')
+    parser.add_argument('--keep-months', type=int, default=Config.AUDIT_RETENTION_MONTHS)
+    parser.add_argument('--archive-dir', default=Config.AUDIT_ARCHIVE_DIR)
+    parser.add_argument('--dry-run', action='store_true', help='only list the partitions that would be dropped')
+    args = parser.parse_args()
+
+    for shard, kwargs in enumerate(shard_connect_kwargs(vars(Config))):
+        conn = psycopg2.connect(**kwargs)
+        try:
+            # Partition names repeat across shards, so each shard archives to its own directory
+            archive_dir = os.path.join(args.archive_dir, 'shard{}'.format(shard)) if shard else args.archive_dir
+            run_retention(conn, args.keep_months, archive_dir, Config.AUDIT_PARTITIONS_AHEAD, args.dry_run)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Username and email availability for the registration page.
+
+Each worker keeps a Bloom filter of every username and email in the user
+directory. A value the filter has never seen is certainly free and is
+answered without a query; only possible hits are confirmed against the
+directory's unique indexes. The filter is built by a background thread with
+a streaming scan and then follows other workers' registrations through
+LISTEN/NOTIFY (``reserve_user`` notifies); the registering worker adds its
+own at once. Names are never removed, which at worst costs a confirming
+query. Until the first scan completes every check goes to the database.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import select
+import threading
+import time
+
+import psycopg2
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'user_directory'
+
+
+def normalize(value):
+    """A username or email as registration stores it and the availability checks look it up"""
+    return value.strip() if value else value
+
+
+def key(field, value):
+    """Filter key of a 'username' or 'email' value: normalized, case-folded and tagged with its field"""
+    return '{}:{}'.format(field, normalize(value).lower())
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, sized for ``capacity`` items at ``error_rate``"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, value):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        positions = self._positions(value)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class AvailabilityIndex:
+    """Per-worker pre-filter of taken usernames and emails.
+
+    ``connect`` opens a connection to the directory database (shard 0). The
+    filter holds ``capacity`` names, or twice the directory's estimated size
+    when that is larger.
+    """
+
+    def __init__(self, connect, capacity=1000000, error_rate=0.01, batch_size=5000):
+        self.connect = connect
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.batch_size = batch_size
+        self._filter = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Start the build and listener thread once per process (fork-safe)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._filter = None
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='availability-index', daemon=True).start()
+
+    def add(self, username, email):
+        """Record a registration of this worker"""
+        bloom = self._filter
+        if bloom is not None:
+            bloom.add(key('username', username))
+            bloom.add(key('email', email))
+
+    def is_taken(self, field, value, confirm):
+        """Whether ``value`` is taken as a ``field`` ('username' or 'email').
+
+        ``confirm(value)`` looks the normalized value up in the directory; it
+        is only called when the filter cannot rule the value out.
+        """
+        value = normalize(value)
+        self.start()
+        bloom = self._filter
+        if bloom is not None and key(field, value) not in bloom:
+            REGISTRY.inc('availability_checks_total', field=field, result='filtered')
+            return False
+        taken = bool(confirm(value))
+        result = 'unfiltered' if bloom is None else 'taken' if taken else 'false_positive'
+        REGISTRY.inc('availability_checks_total', field=field, result=result)
+        return taken
+
+    def _build(self):
+        """Scan the directory into a new filter"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT reltuples FROM pg_class WHERE oid = 'user_directory'::regclass")
+                estimate = max(cur.fetchone()[0], 0)
+            bloom = BloomFilter(max(self.capacity, int(estimate * 2)), self.error_rate)
+            with conn.cursor(name='availability_scan') as cur:
+                cur.itersize = self.batch_size
+                cur.execute("SELECT username, email FROM user_directory")
+                for username, email in cur:
+                    bloom.add(key('username', username))
+                    bloom.add(key('email', email))
+            conn.rollback()
+            return bloom
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute('LISTEN ' + CHANNEL)
+                # Listening first, so registrations during the scan are not missed
+                bloom = self._build()
+                self._filter = bloom
+                while True:
+                    if select.select([conn], [], [], 5) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            username, email = json.loads(conn.notifies.pop(0).payload)
+                            bloom.add(key('username', username))
+                            bloom.add(key('email', email))
+            except Exception:
+                logger.warning('Availability index disconnected; checking the database until it is rebuilt', exc_info=True)
+                self._filter = None
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(5)
@@ -0,0 +1,93 @@
+"""Backfill the fingerprint column of passwords saved before it existed.
+
+    python backfill_fingerprints.py [--batch-size N]
+
+The fingerprint needs the plaintext, so only rows the server key ring can
+decrypt are filled here. Rows encrypted with a user's own data key are
+filled for that user from their session when they next log in. Each batch is committed on its own and only updates rows whose
+ciphertext did not change since they were read, so the job can be stopped
+and rerun at any time.
+"""
+import argparse
+import time
+
+import psycopg2
+from cryptography.fernet import InvalidToken
+from psycopg2.extras import execute_values
+
+from config import Config
+from crypto import KEY_FILE, decrypt_password, fingerprint_password, load_fingerprint_key
+from key_ring import KeyRing
+from shards import shard_connect_kwargs
+
+
+def backfill_fingerprints(conn, cipher, key, user_id=None, batch_size=500, report=None):
+    """Fingerprint rows that have none, a batch per transaction.
+
+    ``cipher`` decrypts the rows (the key ring, or a user's UserCipher with
+    ``user_id``). Returns (filled, skipped); skipped rows could not be
+    decrypted with ``cipher``.
+    """
+    filled = skipped = 0
+    after = (0, 0)
+    started = time.monotonic()
+    while True:
+        with conn.cursor() as cur:
+            # Keyset over (user_id, id), served by idx_passwords_missing_fingerprint
+            cur.execute("""
+                SELECT id, user_id, password FROM passwords
+                WHERE fingerprint IS NULL AND (user_id, id) > (%s, %s)
+                  AND (%s IS NULL OR user_id = %s)
+                ORDER BY user_id, id
+                LIMIT %s
+            """, (after[0], after[1], user_id, user_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+            after = (rows[-1][1], rows[-1][0])
+
+            batch = []
+            for row_id, owner_id, token in rows:
+                try:
+                    password = decrypt_password(token, cipher)
+                except InvalidToken:
+                    skipped += 1
+                    continue
+                batch.append((row_id, token, fingerprint_password(password, key, owner_id)))
+            if batch:
+                # Rows edited since they were read already carry a fresh fingerprint
+                execute_values(cur, """
+                    UPDATE passwords AS p SET fingerprint = v.fingerprint
+                    FROM (VALUES %s) AS v (id, old, fingerprint)
+                    WHERE p.id = v.id AND p.password = v.old AND p.fingerprint IS NULL
+                """, batch, page_size=len(batch))
+        conn.commit()
+        filled += len(batch)
+        if report:
+            elapsed = time.monotonic() - started
+            report('user {} id {}: {} filled, {} under user keys ({:.0f} rows/s)'.format(
+                after[0], after[1], filled, skipped, (filled + skipped) / elapsed if elapsed else 0))
+    return filled, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill missing password fingerprints')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    ring, key = KeyRing.load(KEY_FILE), load_fingerprint_key()
+    filled = skipped = 0
+    for kwargs in shard_connect_kwargs(vars(Config)):
+        conn = psycopg2.connect(**kwargs)
+        try:
+            shard_filled, shard_skipped = backfill_fingerprints(conn, ring, key, batch_size=args.batch_size, report=print)
+        finally:
+            conn.close()
+        filled += shard_filled
+        skipped += shard_skipped
+    print('Done: {} filled, {} left for their owners to fill at their next login.'.format(filled, skipped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+
+def summarize(samples, unit='s'):
+    """Summary statistics of per-operation timings"""
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'unit': unit,
+        'n': n,
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'p95': samples[min(n - 1, int(n * 0.95))],
+        'p99': samples[min(n - 1, int(n * 0.99))],
+        'max': samples[-1],
+    }
+
+
+def bench(func, number=100, repeat=7, warmup=1):
+    """Time ``func`` ``number`` times per sample; return per-call statistics"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - started) / number)
+    result = summarize(samples)
+    result['ops_per_sec'] = 1 / result['median'] if result['median'] else None
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def new_report():
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': {},
+    }
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,50 @@
+"""Compare a benchmark report against a stored baseline.
+
+    python -m benchmarks.compare benchmarks/baseline.json results.json --threshold 0.2
+
+Exits with status 1 when any benchmark's median got slower by more than the
+threshold (a fraction of the baseline), so it can gate CI.
+"""
+import argparse
+import sys
+
+from benchmarks.common import load_report
+
+
+def compare(baseline, current, threshold):
+    """Return (rows, regressions) comparing medians of benchmarks present in both reports"""
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before = baseline['results'][name]['median']
+        after = current['results'][name]['median']
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare benchmark reports')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, e.g. 0.2 for 20%%')
+    args = parser.parse_args()
+
+    baseline, current = load_report(args.baseline), load_report(args.current)
+    if baseline['meta'].get('quick') != current['meta'].get('quick'):
+        print('warning: comparing a --quick report with a full one', file=sys.stderr)
+
+    rows, regressions = compare(baseline, current, args.threshold)
+    for name, before, after, change in rows:
+        flag = 'REGRESSION' if name in regressions else ''
+        print('{:40} {:>10.3f} ms -> {:>10.3f} ms  {:>+7.1%}  {}'.format(name, before * 1000, after * 1000, change, flag))
+    missing = sorted(set(baseline['results']) - set(current['results']))
+    if missing:
+        print('not in current report: {}'.format(', '.join(missing)))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""End-to-end load scenarios against a throwaway PostgreSQL database.
+
+The application runs in-process behind Flask's test client, so the numbers
+include routing, hashing, the data layer, crypto and template rendering but
+not a real HTTP server. They are meant to be compared run against run on the
+same machine, not as absolute capacity figures.
+"""
+import os
+import threading
+import time
+
+# The benchmark database must be configured before config.py is imported, so
+# import this module first (benchmarks.run does). The POSTGRES_* of the
+# environment or a .env file name the real vault database and are
+# overridden, never used
+BENCH_DB = os.getenv('BENCH_POSTGRES_DB', 'bench')
+os.environ['POSTGRES_HOST'] = os.getenv('BENCH_POSTGRES_HOST', 'localhost')
+os.environ['POSTGRES_PORT'] = os.getenv('BENCH_POSTGRES_PORT', '55432')
+os.environ['POSTGRES_DB'] = BENCH_DB
+os.environ['POSTGRES_USER'] = os.getenv('BENCH_POSTGRES_USER', 'bench')
+os.environ['POSTGRES_PASSWORD'] = os.getenv('BENCH_POSTGRES_PASSWORD', 'bench')
+os.environ['POSTGRES_SHARD_DSNS'] = ''
+os.environ['POSTGRES_REPLICA_DSNS'] = ''
+os.environ['SESSION_COOKIE_SECURE'] = 'False'
+os.environ['RATELIMIT_ENABLED'] = 'False'
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from benchmarks.common import summarize
+
+PASSWORD = 'Bench-Password-123!'
+
+
+def reset_database(config):
+    """Drop everything so each run starts from an empty, freshly migrated schema"""
+    from pool import connect_kwargs
+    conn = psycopg2.connect(**connect_kwargs(config))
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT current_database()")
+            database = cur.fetchone()[0]
+            if database != BENCH_DB:
+                raise RuntimeError('refusing to reset {!r}: only the bench database {!r} is reset'.format(database, BENCH_DB))
+            cur.execute("DROP SCHEMA public CASCADE")
+            cur.execute("CREATE SCHEMA public")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def register(client, username):
+    response = client.post('/register', data={
+        'username': username, 'email': username + '@bench.local', 'password': PASSWORD})
+    assert response.status_code in (200, 302), response.status_code
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert response.status_code == 302, response.status_code
+    return response
+
+
+def user_id(app, username):
+    with app.db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+        return cur.fetchone()[0]
+
+
+def seed_vault(app, uid, count):
+    """Insert ``count`` entries directly (encrypted under the server key ring)"""
+    from crypto import encrypt_password
+    token = encrypt_password(PASSWORD, app.key)
+    rows = [('service-%06d' % i, 'user%d@example.com' % i, token, uid) for i in range(count)]
+    with app.db_pool.connection() as conn, conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO passwords (service, username, password, user_id) VALUES %s",
+                       rows, page_size=1000)
+        conn.commit()
+
+
+def run_concurrently(threads, per_thread, make_client, request):
+    """Run ``request(client, i)`` from several threads; return latencies, errors and wall time"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(n):
+        client = make_client(n)
+        local = []
+        for i in range(per_thread):
+            started = time.perf_counter()
+            status = request(client, i)
+            local.append(time.perf_counter() - started)
+            if status >= 400:
+                with lock:
+                    errors.append(status)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def _result(latencies, errors, elapsed):
+    result = summarize(latencies)
+    result['throughput'] = len(latencies) / elapsed
+    result['errors'] = len(errors)
+    return result
+
+
+def login_storm(app, threads, per_thread):
+    for n in range(threads):
+        register(app.test_client(), 'storm%d' % n)
+
+    def request(client, i):
+        return client.post('/login', data={'username': client.bench_user, 'password': PASSWORD}).status_code
+
+    def make_client(n):
+        client = app.test_client()
+        client.bench_user = 'storm%d' % n
+        return client
+
+    return _result(*run_concurrently(threads, per_thread, make_client, request))
+
+
+def dashboard(app, size, requests):
+    username = 'vault%d' % size
+    client = app.test_client()
+    register(client, username)
+    seed_vault(app, user_id(app, username), size)
+    login(client, username)
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        t = time.perf_counter()
+        assert client.get('/dashboard').status_code == 200
+        latencies.append(time.perf_counter() - t)
+    return _result(latencies, [], time.perf_counter() - started)
+
+
+def bulk_save(app, count):
+    client = app.test_client()
+    register(client, 'bulk')
+    login(client, 'bulk')
+
+    def request(client, i):
+        return client.post('/save', data={
+            'service': 'bulk-%d' % i, 'username': 'bulk', 'password': PASSWORD}).status_code
+
+    return _result(*run_concurrently(1, count, lambda n: client, request))
+
+
+def audit_heavy(app, threads, per_thread):
+    """Reveal traffic: every request writes an audit event"""
+    clients = []
+    for n in range(threads):
+        client = app.test_client()
+        register(client, 'audit%d' % n)
+        seed_vault(app, user_id(app, 'audit%d' % n), 1)
+        login(client, 'audit%d' % n)
+        with app.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id FROM passwords WHERE user_id = %s", (user_id(app, 'audit%d' % n),))
+            client.entry_id = cur.fetchone()[0]
+        clients.append(client)
+
+    def request(client, i):
+        return client.post('/reveal/%d' % client.entry_id).status_code
+
+    result = _result(*run_concurrently(threads, per_thread, lambda n: clients[n], request))
+    if app.audit_writer is not None:
+        app.audit_writer.close()
+        result['audit_writer'] = app.audit_writer.stats()
+    return result
+
+
+def run(quick=False):
+    from config import Config
+    if (Config.POSTGRES_DB, str(Config.POSTGRES_PORT)) != (BENCH_DB, os.environ['POSTGRES_PORT']) \
+            or Config.RATELIMIT_ENABLED:
+        raise RuntimeError('config was imported before benchmarks.load; import benchmarks.load first')
+    reset_database(vars(Config))
+
+    from app import create_app
+    app = create_app()
+
+    scale = 0.1 if quick else 1
+    results = {
+        'load.login_storm': login_storm(app, threads=8, per_thread=max(1, int(10 * scale))),
+    }
+    for size in (10, 1000, 10000):
+        results['load.dashboard.%d' % size] = dashboard(app, int(size * scale) or 1, requests=max(5, int(50 * scale)))
+    results['load.bulk_save'] = bulk_save(app, count=max(10, int(500 * scale)))
+    results['load.audit_heavy'] = audit_heavy(app, threads=8, per_thread=max(5, int(100 * scale)))
+    app.db_pool.closeall()
+    return results
@@ -0,0 +1,68 @@
+"""Micro-benchmarks of the CPU-bound helpers on the request path."""
+import hashlib
+import os
+import tempfile
+
+from flask import Flask
+from werkzeug.security import generate_password_hash
+
+from breach import BreachCorpus, build
+from config import Config
+from crypto import encrypt_password, decrypt_password, generate_key
+from envelope import UserCipher, generate_dek
+from key_ring import KeyRing
+from security import (validate_password_strength, verify_password, generate_secure_password,
+                      GenerationPolicy, generate_passwords)
+from strength import estimate, estimate_batch
+
+from benchmarks.common import bench
+
+PASSWORD = 'Correct-Horse-9-Battery'
+
+
+def run(quick=False):
+    number = 20 if quick else 200
+    ring = KeyRing({1: generate_key(), 2: generate_key()})
+    cipher = UserCipher(generate_dek(), ring)
+    token = encrypt_password(PASSWORD, cipher)
+    legacy_token = encrypt_password(PASSWORD, KeyRing({1: ring.keys[1]}))
+
+    results = {
+        'micro.encrypt_password': bench(lambda: encrypt_password(PASSWORD, cipher), number),
+        'micro.decrypt_password': bench(lambda: decrypt_password(token, cipher), number),
+        'micro.decrypt_password.legacy_key': bench(lambda: decrypt_password(legacy_token, cipher), number),
+        'micro.generate_secure_password': bench(generate_secure_password, number),
+        'micro.generate_passwords.500': bench(lambda: generate_passwords(500, GenerationPolicy(24)), max(1, number // 20)),
+        'micro.strength_estimate': bench(lambda: estimate(PASSWORD), number),
+    }
+
+    # Per-password cost of scoring a 1000-row import
+    passwords = ['{}-{}'.format(PASSWORD, i) for i in range(1000)]
+    results['micro.strength_estimate_batch'] = bench(lambda: estimate_batch(passwords), 1 if quick else 5)
+
+    stored_hash = generate_password_hash(PASSWORD, method=Config.PASSWORD_HASH_METHOD)
+    results['micro.verify_password'] = bench(lambda: verify_password(stored_hash, PASSWORD), 2 if quick else 5, repeat=5)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = breach_corpus(directory, 10_000 if quick else 1_000_000)
+        results['micro.breach_lookup.hit'] = bench(lambda: 'breached-1234' in corpus, number * 10)
+        results['micro.breach_lookup.miss'] = bench(lambda: PASSWORD in corpus, number * 10)
+
+        app = Flask(__name__)
+        app.config.from_object(Config)
+        app.breach_corpus = corpus
+        with app.app_context():
+            results['micro.validate_password_strength'] = bench(lambda: validate_password_strength(PASSWORD), number * 10)
+        corpus.close()
+    return results
+
+
+def breach_corpus(directory, size):
+    """Build a corpus of ``size`` synthetic breached passwords"""
+    dump = os.path.join(directory, 'dump.txt')
+    with open(dump, 'w') as f:
+        for i in range(size):
+            f.write('{}:1\n'.format(hashlib.sha1(b'breached-%d' % i).hexdigest().upper()))
+    path = os.path.join(directory, 'breached.bin')
+    build(dump, path)
+    return BreachCorpus(path)
@@ -0,0 +1,36 @@
+"""Run the benchmark suite and write a JSON report.
+
+    python -m benchmarks.run --out results.json             # micro-benchmarks only
+    python -m benchmarks.run --load --out results.json      # plus load scenarios (needs the bench database)
+"""
+import argparse
+
+from benchmarks.common import new_report, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Password manager benchmarks')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--load', action='store_true', help='also run the end-to-end load scenarios')
+    parser.add_argument('--quick', action='store_true', help='smaller iteration counts and data sets')
+    args = parser.parse_args()
+
+    if args.load:
+        # Points POSTGRES_* at the bench database; must come before anything imports config
+        from benchmarks import load
+    from benchmarks import micro
+
+    report = new_report()
+    report['meta']['quick'] = args.quick
+    report['results'].update(micro.run(args.quick))
+    if args.load:
+        report['results'].update(load.run(args.quick))
+
+    write_report(report, args.out)
+    for name, result in sorted(report['results'].items()):
+        print('{:40} median {:>10.3f} ms   p95 {:>10.3f} ms'.format(name, result['median'] * 1000, result['p95'] * 1000))
+    print('Report written to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
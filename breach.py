@@ -0,0 +1,194 @@
+"""Offline check of passwords against a corpus of breached SHA-1 hashes.
+
+    python breach.py build pwned-passwords-sha1.txt breached.bin [--min-count N]
+    python breach.py build --plain wordlist.txt breached.bin
+    python breach.py check breached.bin
+
+The text dump has one ``SHA1HEX[:count]`` per line (the Pwned Passwords
+format) or, with ``--plain``, one password per line. The binary file is
+
+    header   8 bytes magic, uint32 version, uint32 record count
+    fan-out  65537 uint32: index of the first record for each 2-byte prefix
+    records  the remaining 18 bytes of every hash, sorted, no duplicates
+
+Lookups memory-map the file, read the prefix's record range from the fan-out
+table and binary-search it, so nothing is parsed at load time and every
+worker shares the same page-cache pages.
+"""
+import argparse
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'BRCHSHA1'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+PREFIX_SIZE = 2
+SUFFIX_SIZE = 20 - PREFIX_SIZE
+FANOUT_SIZE = (1 << 8 * PREFIX_SIZE) + 1
+RECORDS_OFFSET = HEADER.size + 4 * FANOUT_SIZE
+
+
+class CorpusError(ValueError):
+    """Raised when a corpus file is missing its header or is truncated"""
+
+
+class BreachCorpus:
+    """Memory-mapped sorted SHA-1 corpus; ``password in corpus`` is a binary search"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < RECORDS_OFFSET:
+            raise CorpusError('{} is not a breached-password corpus'.format(path))
+        magic, version, self.count = HEADER.unpack_from(self._mm)
+        if magic != MAGIC or version != VERSION:
+            raise CorpusError('{} is not a breached-password corpus'.format(path))
+        if len(self._mm) != RECORDS_OFFSET + self.count * SUFFIX_SIZE:
+            raise CorpusError('{} is truncated'.format(path))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, password):
+        return self.contains_hash(hashlib.sha1(password.encode()).digest())
+
+    def contains_hash(self, digest):
+        """Whether the 20-byte SHA-1 ``digest`` is in the corpus"""
+        mm = self._mm
+        prefix = int.from_bytes(digest[:PREFIX_SIZE], 'big')
+        lo, hi = struct.unpack_from('<II', mm, HEADER.size + 4 * prefix)
+        suffix = digest[PREFIX_SIZE:]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = RECORDS_OFFSET + mid * SUFFIX_SIZE
+            record = mm[offset:offset + SUFFIX_SIZE]
+            if record < suffix:
+                lo = mid + 1
+            elif record > suffix:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def close(self):
+        self._mm.close()
+
+
+def _read_digests(path, plain=False, min_count=0):
+    """Yield 20-byte digests from a text dump"""
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            if plain:
+                yield hashlib.sha1(line).digest()
+                continue
+            hex_hash, _, count = line.partition(b':')
+            if min_count and count and int(count) < min_count:
+                continue
+            yield bytes.fromhex(hex_hash.decode('ascii'))
+
+
+def _sorted_runs(digests, run_size, directory):
+    """Split into sorted temporary files of at most ``run_size`` digests.
+
+    Runs of an input that is already sorted (like the hash-ordered dumps)
+    are written out without sorting.
+    """
+    runs = []
+    chunk = []
+    in_order = True
+    for digest in digests:
+        if chunk and digest < chunk[-1]:
+            in_order = False
+        chunk.append(digest)
+        if len(chunk) >= run_size:
+            runs.append(_write_run(chunk, in_order, directory))
+            chunk = []
+            in_order = True
+    if chunk:
+        runs.append(_write_run(chunk, in_order, directory))
+    return runs
+
+
+def _write_run(chunk, in_order, directory):
+    if not in_order:
+        chunk.sort()
+    run = tempfile.TemporaryFile(dir=directory)
+    run.write(b''.join(chunk))
+    run.seek(0)
+    return run
+
+
+def _iter_run(run):
+    while True:
+        digest = run.read(20)
+        if not digest:
+            return
+        yield digest
+
+
+def build(source, destination, plain=False, min_count=0, run_size=5_000_000):
+    """Convert a text dump into the binary corpus format; returns the record count"""
+    directory = os.path.dirname(os.path.abspath(destination))
+    runs = _sorted_runs(_read_digests(source, plain, min_count), run_size, directory)
+    fanout = [0] * FANOUT_SIZE
+    count = 0
+    previous = None
+    tmp = destination + '.tmp'
+    try:
+        with open(tmp, 'wb') as out:
+            out.seek(RECORDS_OFFSET)
+            for digest in heapq.merge(*map(_iter_run, runs)):
+                if digest == previous:
+                    continue
+                previous = digest
+                out.write(digest[PREFIX_SIZE:])
+                fanout[int.from_bytes(digest[:PREFIX_SIZE], 'big') + 1] += 1
+                count += 1
+            for i in range(1, FANOUT_SIZE):
+                fanout[i] += fanout[i - 1]
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, count))
+            out.write(struct.pack('<{}I'.format(FANOUT_SIZE), *fanout))
+        os.replace(tmp, destination)
+    finally:
+        for run in runs:
+            run.close()
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return count
+
+
+def main():
+    import getpass
+
+    parser = argparse.ArgumentParser(description='Breached-password corpus tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help='convert a text dump into the binary corpus')
+    build_cmd.add_argument('source')
+    build_cmd.add_argument('destination')
+    build_cmd.add_argument('--plain', action='store_true', help='the dump has plaintext passwords, not SHA-1 hashes')
+    build_cmd.add_argument('--min-count', type=int, default=0, help='skip hashes seen fewer times than this')
+    build_cmd.add_argument('--run-size', type=int, default=5_000_000, help='hashes sorted in memory at once')
+    check_cmd = commands.add_parser('check', help='look up a password interactively')
+    check_cmd.add_argument('corpus')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        count = build(args.source, args.destination, args.plain, args.min_count, args.run_size)
+        print('Wrote {} hashes to {}.'.format(count, args.destination))
+    else:
+        corpus = BreachCorpus(args.corpus)
+        password = getpass.getpass('Password: ')
+        print('Found in the breach corpus.' if password in corpus else 'Not found.')
+
+
+if __name__ == '__main__':
+    main()
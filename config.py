@@ -11,7 +11,57 @@ class Config:
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'senha123')
     POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
     POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
-    
+
+    # Connection pool (per worker process)
+    DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+    DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # seconds to wait for a free connection
+    DB_POOL_MAX_LIFETIME = int(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # recycle after 30 minutes
+    DB_POOL_MAX_IDLE = int(os.getenv('DB_POOL_MAX_IDLE', '300'))
+    DB_POOL_PING_INTERVAL = int(os.getenv('DB_POOL_PING_INTERVAL', '30'))  # ping connections idle longer than this
+
+    # Read replicas: comma-separated libpq DSNs ("host=replica1 dbname=... user=..."),
+    # each with its own pool sized like the primary's. Empty means every query goes to the primary.
+    POSTGRES_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv('POSTGRES_REPLICA_DSNS', '').split(',') if dsn.strip()]
+    REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))  # seconds between health checks
+    REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '10'))  # seconds of replay lag before a replica is skipped
+    REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', '2'))
+    READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '10'))  # reads stay on the primary after a write
+
+    # Shards: the POSTGRES_* database is shard 0 (and holds the user directory);
+    # POSTGRES_SHARD_DSNS lists shards 1..N-1 as libpq DSNs, comma-separated. Never reorder it.
+    POSTGRES_SHARD_DSNS = [dsn.strip() for dsn in os.getenv('POSTGRES_SHARD_DSNS', '').split(',') if dsn.strip()]
+    SHARD_MAP_CACHE_TTL = float(os.getenv('SHARD_MAP_CACHE_TTL', '5'))  # seconds a user's shard is cached per worker
+    SHARD_MAP_CACHE_SIZE = int(os.getenv('SHARD_MAP_CACHE_SIZE', '10000'))
+
+    # Username/email availability pre-filter (availability.py), one per worker
+    AVAILABILITY_FILTER_CAPACITY = int(os.getenv('AVAILABILITY_FILTER_CAPACITY', '1000000'))  # ~1.2 MB at 1%
+    AVAILABILITY_FILTER_ERROR_RATE = float(os.getenv('AVAILABILITY_FILTER_ERROR_RATE', '0.01'))
+
+    # Audit log writer
+    AUDIT_ASYNC = os.getenv('AUDIT_ASYNC', 'True').lower() == 'true'
+    AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', '10000'))
+    AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '200'))
+    AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1.0'))  # seconds
+    AUDIT_OVERFLOW = os.getenv('AUDIT_OVERFLOW', 'sync')  # 'sync' writes inline when the queue is full, 'drop' discards
+    AUDIT_PARTITIONS_AHEAD = int(os.getenv('AUDIT_PARTITIONS_AHEAD', '3'))  # monthly partitions created in advance
+    AUDIT_RETENTION_MONTHS = int(os.getenv('AUDIT_RETENTION_MONTHS', '12'))
+    AUDIT_ARCHIVE_DIR = os.getenv('AUDIT_ARCHIVE_DIR', 'archive/audit')  # gzip JSONL of dropped partitions
+    AUDIT_HISTORY_PAGE_SIZE = int(os.getenv('AUDIT_HISTORY_PAGE_SIZE', '50'))
+
+    # Per-request database budget (dbtrace.py): requests over it are logged and counted
+    DB_TRACE = os.getenv('DB_TRACE', 'True').lower() == 'true'
+    DB_TRACE_MAX_QUERIES = int(os.getenv('DB_TRACE_MAX_QUERIES', '25'))
+    DB_TRACE_MAX_CONNECTIONS = int(os.getenv('DB_TRACE_MAX_CONNECTIONS', '3'))
+    DB_TRACE_REPEAT_THRESHOLD = int(os.getenv('DB_TRACE_REPEAT_THRESHOLD', '5'))  # runs of one statement that look like N+1
+    DB_TRACE_SLOW_QUERY_MS = float(os.getenv('DB_TRACE_SLOW_QUERY_MS', '200'))
+    DB_TRACE_STRICT = os.getenv('DB_TRACE_STRICT', 'False').lower() == 'true'  # raise QueryBudgetExceeded instead (tests)
+
+    # Metrics (set METRICS_DIR to a directory shared by the workers, e.g. on /dev/shm;
+    # gunicorn removes the files of exited workers when it starts)
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))  # seconds
+
     # Application configuration
     SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
     DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
@@ -21,12 +71,51 @@ class Config:
     SESSION_COOKIE_HTTPONLY = True
     PERMANENT_SESSION_LIFETIME = 3600  # 1 hour
     
-    # Rate limiting
+    # Dashboard pagination
+    DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '50'))
+    DASHBOARD_MAX_PAGE_SIZE = 200
+    SEARCH_FUZZY_MIN_LENGTH = 3  # shorter fuzzy queries fall back to prefix matching
+
+    # Vault version cache behind the dashboard/API ETags
+    VAULT_VERSION_CACHE_TTL = int(os.getenv('VAULT_VERSION_CACHE_TTL', '30'))
+    VAULT_VERSION_LISTEN = os.getenv('VAULT_VERSION_LISTEN', 'True') == 'True'  # LISTEN for other workers' writes
+
+    # JSON API
+    API_BATCH_MAX_SIZE = int(os.getenv('API_BATCH_MAX_SIZE', '1000'))  # operations per /api/v1/entries/batch
+
+    # Bulk import/export
+    BULK_IMPORT_BATCH_SIZE = int(os.getenv('BULK_IMPORT_BATCH_SIZE', '500'))
+    BULK_IMPORT_WORKERS = int(os.getenv('BULK_IMPORT_WORKERS', '2'))  # encryption processes per import
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(64 * 1024 * 1024)))  # largest upload
+
+    # Envelope encryption (per-user data keys)
+    KDF_ITERATIONS = int(os.getenv('KDF_ITERATIONS', '200000'))
+    DEK_CACHE_SIZE = int(os.getenv('DEK_CACHE_SIZE', '1024'))
+    DEK_CACHE_TTL = int(os.getenv('DEK_CACHE_TTL', '900'))  # seconds
+
+    # Password hashing (runs on a process pool)
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    HASH_WORKERS = int(os.getenv('HASH_WORKERS', '2'))
+    HASH_MAX_PENDING = int(os.getenv('HASH_MAX_PENDING', '8'))  # queued jobs before failing fast
+    HASH_TIMEOUT = float(os.getenv('HASH_TIMEOUT', '10'))  # seconds
+
+    # Rate limiting (counters shared by all workers on the host; keep the file on tmpfs)
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'True').lower() == 'true'
     RATELIMIT_DEFAULT = "200 per day;50 per hour"
+    RATELIMIT_STORAGE_URI = os.getenv(
+        'RATELIMIT_STORAGE_URI',
+        'sqlite:///dev/shm/gerenciador-ratelimit.db' if os.path.isdir('/dev/shm') else 'sqlite:///tmp/gerenciador-ratelimit.db'
+    )
+    RATELIMIT_STRATEGY = 'moving-window'
+    RATELIMIT_STORAGE_OPTIONS = {'compact_every': 1000}
     
     # Password requirements
     MIN_PASSWORD_LENGTH = 8
     REQUIRE_SPECIAL_CHARS = True
     REQUIRE_NUMBERS = True
     REQUIRE_UPPERCASE = True
-    REQUIRE_LOWERCASE = True 
\ No newline at end of file
+    REQUIRE_LOWERCASE = True 
+    MIN_PASSWORD_SCORE = int(os.getenv('MIN_PASSWORD_SCORE', '0'))  # 0-4 strength estimate (strength.py) to require; 0 only reports it
+    GENERATE_MAX_COUNT = int(os.getenv('GENERATE_MAX_COUNT', '500'))  # passwords per /generate-password call
+    PASSPHRASE_WORDLIST = os.getenv('PASSPHRASE_WORDLIST', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wordlists', 'passphrase_words.txt'))
+    BREACHED_PASSWORDS_FILE = os.getenv('BREACHED_PASSWORDS_FILE')  # corpus built with breach.py; unset disables
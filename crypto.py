@@ -1,23 +1,76 @@
 from cryptography.fernet import Fernet
+from functools import lru_cache
+from key_ring import KeyRing
+from metrics import timed
+import base64
+import hashlib
+import hmac
 import os
 
 KEY_FILE = "key.key"
+FINGERPRINT_KEY_FILE = "fingerprint.key"
 
 def load_key():
+    # Carrega o chaveiro (key ring); cria um com a primeira chave se não existir
     if not os.path.exists(KEY_FILE):
-        key = Fernet.generate_key()
-        with open(KEY_FILE, "wb") as key_file:
-            key_file.write(key)
+        KeyRing({1: generate_key()}).save(KEY_FILE)
+    return KeyRing.load(KEY_FILE)
+
+
+def generate_key():
+    return Fernet.generate_key()
+
+def save_key(key):
+    # Adiciona a chave ao chaveiro como nova chave primária
+    if os.path.exists(KEY_FILE):
+        ring = KeyRing.load(KEY_FILE).with_new_key(key)
     else:
-        with open(KEY_FILE, "rb") as key_file:
-            key = key_file.read()
-    return key
+        ring = KeyRing({1: key})
+    ring.save(KEY_FILE)
+    return ring.primary_version
+
+
+def load_fingerprint_key():
+    # Carrega a chave HMAC das impressões digitais (separada das chaves Fernet);
+    # cria uma aleatória se não existir (link atômico: outro processo nunca lê
+    # um arquivo pela metade nem sobrescreve a chave já criada)
+    if not os.path.exists(FINGERPRINT_KEY_FILE):
+        tmp = '{}.{}.tmp'.format(FINGERPRINT_KEY_FILE, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.urlsafe_b64encode(os.urandom(32)) + b'\n')
+        try:
+            os.link(tmp, FINGERPRINT_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(FINGERPRINT_KEY_FILE, 'rb') as f:
+        return base64.urlsafe_b64decode(f.read().strip())
 
 
+@lru_cache(maxsize=16)
+def _fernet(key):
+    return Fernet(key)
+
+def _cipher(key):
+    # Aceita uma chave Fernet isolada (bytes) ou um objeto com encrypt/decrypt
+    # (KeyRing, UserCipher)
+    return _fernet(key) if isinstance(key, bytes) else key
+
+
+@timed('crypto_duration_seconds', op='encrypt')
 def encrypt_password(password, key):
     # Criptografa e retorna como string (para salvar no PostgreSQL como texto)
-    return Fernet(key).encrypt(password.encode()).decode()
+    return _cipher(key).encrypt(password.encode()).decode()
 
+@timed('crypto_duration_seconds', op='decrypt')
 def decrypt_password(encrypted_password, key):
     # Converte de volta para bytes e descriptografa
-    return Fernet(key).decrypt(encrypted_password.encode()).decode()
+    return _cipher(key).decrypt(encrypted_password.encode()).decode()
+
+@timed('crypto_duration_seconds', op='fingerprint')
+def fingerprint_password(password, key, user_id):
+    # HMAC-SHA256 da senha em texto claro, com o id do usuário: senhas iguais
+    # no mesmo cofre têm a mesma impressão, mas não entre usuários diferentes
+    return hmac.new(key, b'%d:' % user_id + password.encode(), hashlib.sha256).digest()
@@ -1,6 +1,7 @@
 import psycopg2
 import os
 from contextlib import closing
+from migrate import run_migrations
 
 def get_db_connection():
     return psycopg2.connect(
@@ -14,31 +15,10 @@ def get_db_connection():
 
 
 def init_db():
+    # O schema é gerenciado pelas migrations (ver migrate.py), que também
+    # reconciliam bancos criados pela versão antiga deste módulo
     with closing(get_db_connection()) as conn:
-        with conn.cursor() as cursor:
-            # Criação da tabela de usuários
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    hashed_password TEXT NOT NULL,
-                    data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # Criação da tabela de senhas (com FK)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS passwords (
-                    id SERIAL PRIMARY KEY,
-                    service TEXT NOT NULL,
-                    username TEXT NOT NULL,
-                    password TEXT NOT NULL,
-                    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE
-                )
-            """)
-
-            conn.commit()
+        run_migrations(lambda: conn)
 
 # ====================
 # CRUD com user_id
@@ -0,0 +1,168 @@
+"""Per-request accounting of the database work a request does.
+
+Pooled connections are created as TracedConnection, whose cursors report
+every statement to the trace of the current request (a context variable,
+so background threads such as the audit writer are never counted). At the
+end of the request the app checks the trace against its budget: too many
+connections or queries, and the same statement run over and over with
+different parameters, which is usually a query in a loop (N+1).
+
+Statements are logged with their literals replaced by ``?`` and their
+parameters by type names, so no vault data or credentials reach the logs.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from psycopg2 import extensions, sql
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('db_trace', default=None)
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised at the end of a request over its budget when tracing is strict"""
+
+
+def normalize(query, conn=None):
+    """The statement with whitespace collapsed and literals replaced by ``?``"""
+    if isinstance(query, sql.Composable):
+        query = query.as_string(conn)
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return _SPACE.sub(' ', _LITERAL.sub('?', query)).strip()
+
+
+def redact(params):
+    """Parameters reduced to their type names"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return tuple(type(value).__name__ for value in params)
+
+
+class RequestTrace:
+    """Connections, statements, rows and time of one request"""
+
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.connections = 0
+        self.queries = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record_query(self, query, params, duration, rows, conn=None):
+        statement = normalize(query, conn)
+        self.queries += 1
+        self.rows += max(rows, 0)
+        self.duration += duration
+        self.statements[statement] += 1
+        if self.slow_query_ms is not None and duration * 1000 >= self.slow_query_ms:
+            logger.warning('Slow query (%.0f ms, %d rows): %s params=%s', duration * 1000, rows, statement, redact(params))
+
+    def problems(self, max_queries=None, max_connections=None, repeat_threshold=None):
+        """Return ``[(reason, message)]`` for every budget the request went over; None disables a check"""
+        found = []
+        if max_connections is not None and self.connections > max_connections:
+            found.append(('connections', '{} connections (budget {})'.format(self.connections, max_connections)))
+        if max_queries is not None and self.queries > max_queries:
+            found.append(('queries', '{} queries (budget {})'.format(self.queries, max_queries)))
+        if repeat_threshold is not None:
+            for statement, count in self.statements.most_common():
+                if count < repeat_threshold:
+                    break
+                found.append(('repeated', '{} runs of: {}'.format(count, statement)))
+        return found
+
+
+def start(slow_query_ms=None):
+    """Begin tracing the current request; returns the token for ``finish``"""
+    return _current.set(RequestTrace(slow_query_ms))
+
+
+def finish(token):
+    """Stop tracing and return the request's trace"""
+    trace = _current.get()
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Finished from another context (a streamed response)
+        _current.set(None)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def record_checkout():
+    """Count a connection checked out of a pool for the current request"""
+    trace = _current.get()
+    if trace is not None:
+        trace.connections += 1
+
+
+def budget(**limits):
+    """Override the configured budget of a view: ``max_queries``,
+    ``max_connections`` or ``repeat_threshold``; None lifts that limit."""
+    def decorator(view):
+        view.db_budget = limits
+        return view
+    return decorator
+
+
+class TracingCursorMixin:
+    """Reports execute/executemany/copy_expert to the current request's trace"""
+
+    def _traced(self, method, query, params):
+        trace = _current.get()
+        if trace is None:
+            return method(query, params)
+        started = time.perf_counter()
+        try:
+            return method(query, params)
+        finally:
+            trace.record_query(query, params, time.perf_counter() - started, self.rowcount, self.connection)
+
+    def execute(self, query, vars=None):
+        return self._traced(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._traced(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        trace = _current.get()
+        if trace is None:
+            return super().copy_expert(sql, file, size)
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            trace.record_query(sql, None, time.perf_counter() - started, self.rowcount, self.connection)
+
+
+_cursor_classes = {}
+
+
+def traced_cursor_class(base):
+    """The tracing subclass of a cursor class (DictCursor, ...)"""
+    cls = _cursor_classes.get(base)
+    if cls is None:
+        cls = _cursor_classes.setdefault(base, type('Traced' + base.__name__, (TracingCursorMixin, base), {}))
+    return cls
+
+
+class TracedConnection(extensions.connection):
+    """Connection whose cursors report to the current request's trace"""
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        factory = cursor_factory or self.cursor_factory or extensions.cursor
+        return super().cursor(name, cursor_factory=traced_cursor_class(factory), **kwargs)
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+
+def derive_kek(master_password, salt, iterations):
+    """Derive the key-encryption key (a Fernet key) from the master password"""
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                     iterations=iterations, backend=default_backend())
+    return base64.urlsafe_b64encode(kdf.derive(master_password.encode()))
+
+
+def new_salt():
+    return base64.b64encode(os.urandom(16)).decode()
+
+
+def generate_dek():
+    """Generate a user's data-encryption key"""
+    return Fernet.generate_key()
+
+
+def wrap_dek(dek, master_password, salt, iterations):
+    """Encrypt a data key under the master password; returns text for the users table"""
+    kek = derive_kek(master_password, base64.b64decode(salt), iterations)
+    return Fernet(kek).encrypt(dek).decode()
+
+
+def unwrap_dek(wrapped, master_password, salt, iterations):
+    """Decrypt a wrapped data key (raises InvalidToken on a wrong password)"""
+    kek = derive_kek(master_password, base64.b64decode(salt), iterations)
+    return Fernet(kek).decrypt(wrapped.encode())
+
+
+def new_api_token_secret():
+    """Random secret of an API token; only its hash is stored"""
+    return secrets.token_urlsafe(32)
+
+
+def api_token_hash(secret):
+    return hashlib.sha256(b'hash:' + secret.encode()).digest()
+
+
+def _api_token_key(secret):
+    # The secret is 256 random bits, so a plain hash is enough to derive a key
+    return base64.urlsafe_b64encode(hashlib.sha256(b'wrap:' + secret.encode()).digest())
+
+
+def wrap_dek_for_token(dek, secret):
+    """Encrypt a data key so that only the holder of an API token can unwrap it"""
+    return Fernet(_api_token_key(secret)).encrypt(dek).decode()
+
+
+def unwrap_dek_for_token(wrapped, secret):
+    return Fernet(_api_token_key(secret)).decrypt(wrapped.encode())
+
+
+class SessionKeyRetired(Exception):
+    """Raised when a session's data key is encrypted under a retired server key"""
+
+
+class UserCipher:
+    """Encrypts with a user's data key and also decrypts rows written before
+    the user had one (those are under the application key ring)."""
+
+    def __init__(self, dek, ring):
+        self.primary = Fernet(dek)
+        self._multi = MultiFernet([self.primary] + ring.fernets)
+
+    def encrypt(self, data):
+        return self.primary.encrypt(data)
+
+    def decrypt(self, token):
+        return self._multi.decrypt(token)
+
+
+class DEKCache:
+    """Bounded LRU cache of unwrapped user ciphers with a time-to-live"""
+
+    def __init__(self, max_size=1024, ttl=900):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            if time.monotonic() - item[1] > self.ttl:
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return item[0]
+
+    def put(self, user_id, value):
+        with self._lock:
+            self._data[user_id] = (value, time.monotonic())
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._data)
@@ -1,18 +1,21 @@
 from flask import render_template
-from app import app
 
-@app.errorhandler(404)
-def not_found_error(error):
-    return render_template('errors/404.html'), 404
 
-@app.errorhandler(500)
-def internal_error(error):
-    return render_template('errors/500.html'), 500
+def register_error_handlers(app):
+    """Render the error pages; called by create_app"""
 
-@app.errorhandler(403)
-def forbidden_error(error):
-    return render_template('errors/403.html'), 403
+    @app.errorhandler(404)
+    def not_found_error(error):
+        return render_template('errors/404.html'), 404
 
-@app.errorhandler(429)
-def too_many_requests(error):
-    return render_template('errors/429.html'), 429 
\ No newline at end of file
+    @app.errorhandler(500)
+    def internal_error(error):
+        return render_template('errors/500.html'), 500
+
+    @app.errorhandler(403)
+    def forbidden_error(error):
+        return render_template('errors/403.html'), 403
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return render_template('errors/429.html'), 429
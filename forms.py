@@ -1,7 +1,17 @@
+from flask import current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email, Length, EqualTo, ValidationError
-from models import get_db_connection
+from availability import normalize
+from models import find_directory_user, find_directory_email
+from security import validate_password_strength
+
+class StrongPassword:
+    """Applies the configured password policy, the same check the routes use"""
+    def __call__(self, form, field):
+        is_valid, message = validate_password_strength(field.data or '')
+        if not is_valid:
+            raise ValidationError(message)
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -9,17 +19,17 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Sign In')
 
 class RegistrationForm(FlaskForm):
-    username = StringField('Username', validators=[
+    username = StringField('Username', filters=[normalize], validators=[
         DataRequired(),
         Length(min=4, max=25, message='Username must be between 4 and 25 characters')
     ])
-    email = StringField('Email', validators=[
+    email = StringField('Email', filters=[normalize], validators=[
         DataRequired(),
         Email(message='Invalid email address')
     ])
     password = PasswordField('Password', validators=[
         DataRequired(),
-        Length(min=8, message='Password must be at least 8 characters long')
+        StrongPassword()
     ])
     confirm_password = PasswordField('Confirm Password', validators=[
         DataRequired(),
@@ -27,19 +37,17 @@ class RegistrationForm(FlaskForm):
     ])
     submit = SubmitField('Register')
 
+    # The availability index answers most checks without a query; possible
+    # hits are confirmed on the request's directory connection
     def validate_username(self, username):
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM users WHERE username = %s", (username.data,))
-                if cur.fetchone():
-                    raise ValidationError('Username already taken. Please choose another.')
+        if current_app.availability.is_taken('username', username.data,
+                                             lambda value: find_directory_user(value, current_app.get_directory_db)):
+            raise ValidationError('Username already taken. Please choose another.')
 
     def validate_email(self, email):
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM users WHERE email = %s", (email.data,))
-                if cur.fetchone():
-                    raise ValidationError('Email already registered. Please use another.')
+        if current_app.availability.is_taken('email', email.data,
+                                             lambda value: find_directory_email(value, current_app.get_directory_db)):
+            raise ValidationError('Email already registered. Please use another.')
 
 class PasswordForm(FlaskForm):
     service = StringField('Service', validators=[
@@ -52,7 +60,7 @@ class PasswordForm(FlaskForm):
     ])
     password = PasswordField('Password', validators=[
         DataRequired(),
-        Length(min=8, message='Password must be at least 8 characters long')
+        StrongPassword()
     ])
     submit = SubmitField('Save Password')
 
@@ -60,7 +68,7 @@ class ChangeMasterPasswordForm(FlaskForm):
     current_password = PasswordField('Current Password', validators=[DataRequired()])
     new_password = PasswordField('New Password', validators=[
         DataRequired(),
-        Length(min=8, message='Password must be at least 8 characters long')
+        StrongPassword()
     ])
     confirm_password = PasswordField('Confirm New Password', validators=[
         DataRequired(),
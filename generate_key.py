@@ -1,6 +1,6 @@
 from crypto import generate_key, save_key
 
 key = generate_key()
-save_key(key)
+version = save_key(key)
 
-print("Chave secreta criada e salva em 'secret.key'.")
+print(f"Chave secreta criada e salva em 'key.key' (versão {version}).")
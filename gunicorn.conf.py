@@ -0,0 +1,24 @@
+"""gunicorn settings, read automatically by ``gunicorn app:app``.
+
+The app is imported once in the master, which checks the schema and loads
+the keys before forking; workers inherit that and only open their own
+connections, so restarting every worker at once costs the database nothing
+but the new connections.
+"""
+preload_app = True
+
+
+def on_starting(server):
+    app = server.app.wsgi()
+    # Samples of the previous run's workers
+    from metrics import REGISTRY
+    REGISTRY.prune()
+    try:
+        app.initialize(warm=False)
+    except Exception:
+        # Each worker retries on its first request; /readyz reports 503 until then
+        server.log.exception('Initialization failed')
+    finally:
+        # Workers open their own connections; the master keeps none
+        for pool in app.shard_pools:
+            pool.closeall()
@@ -0,0 +1,85 @@
+import os
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+
+class KeyRing:
+    """Versioned set of Fernet keys.
+
+    The key with the highest version is the primary: it encrypts everything
+    new. Tokens produced by any key still in the ring can be decrypted. The
+    ring is stored one key per line as ``<version>:<key>``; a bare key (the
+    original single-key ``key.key`` format) is read as version 1.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError('A key ring needs at least one key')
+        self.keys = dict(keys)
+        self.versions = sorted(self.keys, reverse=True)
+        self.primary_version = self.versions[0]
+        # Cipher objects are built once and shared by every request
+        self.fernets = [Fernet(self.keys[v]) for v in self.versions]
+        self._multi = MultiFernet(self.fernets)
+        self.primary = self.fernets[0]
+
+    @classmethod
+    def load(cls, path):
+        """Read a key ring file"""
+        keys = {}
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith(b'#'):
+                    continue
+                if b':' in line:
+                    version, key = line.split(b':', 1)
+                    version = int(version)
+                else:
+                    version, key = 1, line
+                if version in keys:
+                    raise ValueError('Duplicate key version {} in {}'.format(version, path))
+                keys[version] = key
+        return cls(keys)
+
+    def save(self, path):
+        """Write the ring atomically, newest key first"""
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            for version in self.versions:
+                f.write(b'%d:%s\n' % (version, self.keys[version]))
+        os.replace(tmp, path)
+
+    def with_new_key(self, key=None):
+        """Return a ring with a new primary key added"""
+        keys = dict(self.keys)
+        keys[self.primary_version + 1] = key or Fernet.generate_key()
+        return KeyRing(keys)
+
+    def without(self, version):
+        """Return a ring with a retired key removed"""
+        if version == self.primary_version:
+            raise ValueError('The primary key cannot be retired')
+        keys = dict(self.keys)
+        del keys[version]
+        return KeyRing(keys)
+
+    def encrypt(self, data):
+        return self.primary.encrypt(data)
+
+    def decrypt(self, token):
+        return self._multi.decrypt(token)
+
+    def is_current(self, token):
+        """Whether a token is already encrypted with the primary key"""
+        try:
+            self.primary.decrypt(token)
+            return True
+        except InvalidToken:
+            return False
+
+    def rotate(self, token):
+        """Re-encrypt a token with the primary key"""
+        return self._multi.rotate(token)
+
@@ -0,0 +1,277 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """Counters and histograms in Prometheus text format.
+
+    Recording is an in-memory update under a lock. With a ``directory`` set,
+    each process periodically writes its samples to ``<directory>/<pid>.json``
+    and ``render`` sums the files of every worker, so any worker can answer a
+    scrape for the whole server. Gauges (from collectors) are only taken from
+    processes that are still alive. Files of exited workers are kept, so the
+    counters never go backwards, until ``prune`` removes them at the next
+    server start.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.flush_interval = 5
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._last_flush = 0.0
+        self._pid = os.getpid()
+        atexit.register(self._flush_at_exit)
+
+    def configure(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help):
+        self._meta.setdefault(name, ('counter', help, None))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._meta.setdefault(name, ('histogram', help, tuple(buckets)))
+
+    def gauge(self, name, help):
+        self._meta.setdefault(name, ('gauge', help, None))
+
+    def add_collector(self, func):
+        """Register ``func() -> [(name, labels, value)]`` evaluated at flush/scrape time"""
+        self._collectors.append(func)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Samples inherited from the parent belong to the parent's file
+            self._pid = os.getpid()
+            self._counters = {}
+            self._histograms = {}
+            self._lock = threading.Lock()
+            self._flush_lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        self._check_pid()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        self._check_pid()
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            series[0][bisect_left(buckets, value)] += 1
+            series[1] += value
+        self._maybe_flush()
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator observing the duration of every call"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def _snapshot(self):
+        gauges = []
+        for collector in self._collectors:
+            try:
+                gauges.extend(collector())
+            except Exception:
+                pass
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[n, list(map(list, l)), v] for (n, l), v in self._counters.items()],
+                'histograms': [[n, list(map(list, l)), b, s] for (n, l), (b, s) in self._histograms.items()],
+                'gauges': [[n, sorted(l.items()), v] for n, l, v in gauges],
+            }
+
+    def _maybe_flush(self):
+        if self.directory and time.monotonic() - self._last_flush > self.flush_interval:
+            self._try_flush()
+
+    def _try_flush(self):
+        # Called while recording or scraping: another thread already flushing
+        # is enough, and a failed flush must never fail a request
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._write()
+        except Exception:
+            logger.exception('Failed to write metrics to %s', self.directory)
+        finally:
+            self._flush_lock.release()
+
+    def _flush_at_exit(self):
+        if self.directory:
+            self._try_flush()
+
+    def flush(self):
+        """Write this process's samples to the shared directory"""
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._write()
+
+    def _write(self):
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def prune(self):
+        """Remove the files of processes that are no longer running; call before forking workers"""
+        if not self.directory:
+            return
+        for filename in os.listdir(self.directory):
+            pid = filename.split('.', 1)[0]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not _alive(int(pid)):
+                try:
+                    os.unlink(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+
+    def _snapshots(self):
+        if not self.directory:
+            return [self._snapshot()]
+        self._try_flush()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """Aggregate every process and return the Prometheus text exposition"""
+        counters, histograms, gauges = {}, {}, {}
+        for snap in self._snapshots():
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, total in snap['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                series = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+                series[0] = [a + b for a, b in zip(series[0], buckets)]
+                series[1] += total
+            if snap['pid'] == os.getpid() or _alive(snap['pid']):
+                for name, labels, value in snap['gauges']:
+                    gauges[(name, tuple(map(tuple, labels)) + (('pid', str(snap['pid'])),))] = value
+
+        lines = []
+        for name, (kind, help, bucket_bounds) in sorted(self._meta.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append('{}{} {}'.format(name, _labels(labels), _num(value)))
+            elif kind == 'gauge':
+                for (n, labels), value in sorted(gauges.items()):
+                    if n == name:
+                        lines.append('{}{} {}'.format(name, _labels(labels), _num(value)))
+            else:
+                for (n, labels), (buckets, total) in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(bucket_bounds + (float('inf'),), buckets):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _labels(labels), _num(total)))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Process-wide registry shared by the app, the data layer and crypto
+REGISTRY = Registry()
+REGISTRY.counter('http_requests_total', 'HTTP requests by endpoint, method and status')
+REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency by endpoint')
+REGISTRY.histogram('db_query_duration_seconds', 'Time spent in data-layer functions')
+REGISTRY.histogram('crypto_duration_seconds', 'Time spent encrypting and decrypting vault entries')
+REGISTRY.histogram('template_render_duration_seconds', 'Template rendering time')
+REGISTRY.histogram('password_hashing_duration_seconds', 'Password hashing and key derivation time, queueing included')
+REGISTRY.histogram('db_request_queries', 'Statements run per request', (1, 2, 5, 10, 25, 50, 100, 250, 1000))
+REGISTRY.histogram('db_request_connections', 'Pooled connections checked out per request', (0, 1, 2, 3, 4, 6, 8))
+REGISTRY.counter('availability_checks_total', 'Username/email availability checks by how they were answered')
+REGISTRY.counter('db_budget_exceeded_total', 'Requests over their database budget, by endpoint and reason')
+REGISTRY.counter('audit_partition_failures_total', 'Failed audit_log partition creations at startup, by shard')
+REGISTRY.gauge('db_pool_connections', 'Pooled database connections by state')
+REGISTRY.gauge('db_pool_events', 'Connection pool event counters of live workers')
+REGISTRY.gauge('db_replica_healthy', 'Whether each read replica currently takes reads')
+REGISTRY.gauge('db_replica_lag_seconds', 'Replay lag of each read replica at its last health check')
+REGISTRY.gauge('db_replica_failures', 'Consecutive failed health checks of each read replica')
+REGISTRY.gauge('db_replica_connections', 'Replica connections in use')
+REGISTRY.gauge('db_shard_pool_connections', 'Pooled connections to shards 1..N-1 by state')
+REGISTRY.gauge('audit_writer_events', 'Audit writer event counters of live workers')
+
+timed = REGISTRY.timed
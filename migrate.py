@@ -0,0 +1,104 @@
+import os
+import re
+from collections import namedtuple
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Key of the PostgreSQL advisory lock held while migrating
+MIGRATION_LOCK_ID = 724011
+
+Migration = namedtuple('Migration', 'version name path')
+
+_FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+def discover_migrations(path=MIGRATIONS_DIR):
+    """Return the migrations in ``path`` ordered by version"""
+    migrations = []
+    for filename in os.listdir(path):
+        match = _FILENAME.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(path, filename)))
+    migrations.sort()
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError('Duplicate migration versions in {}'.format(path))
+    return migrations
+
+
+def current_version(cur):
+    """Return the applied schema version (0 on a fresh database)"""
+    cur.execute("SELECT to_regclass('schema_version')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def run_migrations(get_db_func, path=MIGRATIONS_DIR):
+    """Apply pending migrations and return the ones that were applied.
+
+    When the schema is already current this costs two SELECTs and runs no
+    DDL. Otherwise an advisory lock serialises workers so only one of them
+    migrates; the others wait and then find nothing left to do. Each
+    migration runs in its own transaction together with its schema_version row.
+    """
+    migrations = discover_migrations(path)
+    if not migrations:
+        return []
+    target = migrations[-1].version
+
+    conn = get_db_func()
+    with conn.cursor() as cur:
+        if current_version(cur) >= target:
+            conn.rollback()
+            return []
+
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        applied = []
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(100) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+
+            # Another worker may have migrated while we waited for the lock
+            version = current_version(cur)
+            for migration in migrations:
+                if migration.version <= version:
+                    continue
+                with open(migration.path) as f:
+                    cur.execute(f.read())
+                cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                            (migration.version, migration.name))
+                conn.commit()
+                applied.append(migration)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+    return applied
+
+
+if __name__ == '__main__':
+    import psycopg2
+    from config import Config
+    from shards import shard_connect_kwargs
+
+    for shard, kwargs in enumerate(shard_connect_kwargs(vars(Config))):
+        conn = psycopg2.connect(**kwargs)
+        try:
+            applied = run_migrations(lambda: conn)
+        finally:
+            conn.close()
+        for migration in applied:
+            print('Shard {}: applied {:04d}_{}'.format(shard, migration.version, migration.name))
+        if not applied:
+            print('Shard {}: schema is up to date.'.format(shard))
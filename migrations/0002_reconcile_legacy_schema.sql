@@ -0,0 +1,22 @@
+-- Databases created by the legacy db.py have users.data_criacao instead of
+-- created_at and are missing last_login and the passwords bookkeeping columns
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'data_criacao') THEN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'created_at') THEN
+            UPDATE users SET created_at = COALESCE(created_at, data_criacao);
+            ALTER TABLE users DROP COLUMN data_criacao;
+        ELSE
+            ALTER TABLE users RENAME COLUMN data_criacao TO created_at;
+        END IF;
+    END IF;
+END $$;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_login TIMESTAMP;
+
+ALTER TABLE passwords ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE passwords ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE passwords ADD COLUMN IF NOT EXISTS notes TEXT;
@@ -0,0 +1,6 @@
+-- Serves the per-user listing ordered by service and its keyset pagination,
+-- and the user_id filter of get_password/update_password/delete_password
+CREATE INDEX IF NOT EXISTS idx_passwords_user_service ON passwords (user_id, service, id);
+
+-- Per-user audit history in chronological order
+CREATE INDEX IF NOT EXISTS idx_audit_log_user_created ON audit_log (user_id, created_at);
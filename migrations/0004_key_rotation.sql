@@ -0,0 +1,12 @@
+-- Checkpoints of the background re-encryption job (rotate_keys.py), one row
+-- per target key version so an interrupted rotation resumes where it stopped
+CREATE TABLE IF NOT EXISTS key_rotation (
+    target_version INTEGER PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    rotated BIGINT NOT NULL DEFAULT 0,
+    skipped BIGINT NOT NULL DEFAULT 0,
+    failed BIGINT NOT NULL DEFAULT 0,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
@@ -0,0 +1,5 @@
+-- Envelope encryption: each user's data-encryption key, wrapped by a key
+-- derived from the master password (PBKDF2 with a per-user salt)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS dek_wrapped TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS dek_salt VARCHAR(32);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS kdf_iterations INTEGER;
@@ -0,0 +1,16 @@
+-- Search over service and username (case-insensitive).
+-- Prefix matches use the btree indexes (text_pattern_ops makes LIKE 'abc%'
+-- indexable whatever the collation); fuzzy matches use trigram GIN indexes
+-- that lead with user_id (btree_gin) so only the user's own rows are scanned.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE INDEX IF NOT EXISTS idx_passwords_user_service_prefix
+    ON passwords (user_id, lower(service) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_passwords_user_username_prefix
+    ON passwords (user_id, lower(username) text_pattern_ops);
+
+CREATE INDEX IF NOT EXISTS idx_passwords_service_trgm
+    ON passwords USING gin (user_id, lower(service) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_passwords_username_trgm
+    ON passwords USING gin (user_id, lower(username) gin_trgm_ops);
@@ -0,0 +1,10 @@
+-- Keyed HMAC of each plaintext password (see crypto.fingerprint_password):
+-- equal passwords within a vault share a fingerprint, so reuse is one GROUP BY
+ALTER TABLE passwords ADD COLUMN IF NOT EXISTS fingerprint BYTEA;
+
+CREATE INDEX IF NOT EXISTS idx_passwords_user_fingerprint
+    ON passwords (user_id, fingerprint) WHERE fingerprint IS NOT NULL;
+
+-- Rows still waiting for the backfill
+CREATE INDEX IF NOT EXISTS idx_passwords_missing_fingerprint
+    ON passwords (user_id, id) WHERE fingerprint IS NULL;
@@ -0,0 +1,16 @@
+-- Bearer tokens for API clients. Only a hash of the secret is stored, plus
+-- the user's data key wrapped by a key derived from the secret, so a token
+-- opens the vault without the master password and a database copy cannot.
+CREATE TABLE IF NOT EXISTS api_tokens (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    name VARCHAR(100) NOT NULL,
+    token_hash BYTEA NOT NULL,
+    dek_wrapped TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP,
+    expires_at TIMESTAMP,
+    revoked_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_api_tokens_user ON api_tokens (user_id);
@@ -0,0 +1,3 @@
+-- Per-user change counter, bumped in the same transaction as every vault
+-- write; ETags of the vault views are built from it
+ALTER TABLE users ADD COLUMN IF NOT EXISTS vault_version BIGINT NOT NULL DEFAULT 0;
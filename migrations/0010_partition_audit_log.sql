@@ -0,0 +1,55 @@
+-- audit_log partitioned by month of created_at. Partitions are named
+-- audit_log_yYYYYmMM; create_audit_partitions() adds the upcoming ones (the
+-- app calls it at startup, audit_retention.py on every run) and the default
+-- partition only catches rows if that ever lapses. Existing rows are copied
+-- into partitions covering their months.
+ALTER TABLE audit_log RENAME TO audit_log_legacy;
+ALTER SEQUENCE audit_log_id_seq RENAME TO audit_log_legacy_id_seq;
+
+CREATE TABLE audit_log (
+    id BIGSERIAL,
+    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    action VARCHAR(50) NOT NULL,
+    details TEXT,
+    ip_address VARCHAR(45),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (created_at, id)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE audit_log_default PARTITION OF audit_log DEFAULT;
+
+-- Per-user history, newest first, with (created_at, id) as the keyset
+CREATE INDEX idx_audit_log_user_history ON audit_log (user_id, created_at DESC, id DESC);
+
+CREATE OR REPLACE FUNCTION create_audit_partitions(first_month DATE, months_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', first_month);
+    last_month DATE := date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    -- Serialise workers starting at the same time
+    PERFORM pg_advisory_xact_lock(724012);
+    WHILE month_start <= last_month LOOP
+        partition_name := 'audit_log_' || to_char(month_start, '"y"YYYY"m"MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF audit_log FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, month_start, month_start + INTERVAL '1 month');
+            created := created + 1;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_audit_partitions(COALESCE((SELECT MIN(created_at) FROM audit_log_legacy)::DATE, CURRENT_DATE), 3);
+
+INSERT INTO audit_log (id, user_id, action, details, ip_address, created_at)
+SELECT id, user_id, action, details, ip_address, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM audit_log_legacy;
+
+SELECT setval('audit_log_id_seq', COALESCE((SELECT MAX(id) FROM audit_log), 0) + 1, false);
+
+DROP TABLE audit_log_legacy;
@@ -0,0 +1,39 @@
+-- Sharding (shards.py). Ids become BIGINT so every shard can hand out its
+-- own residue class of ids (shards.init_shard_ids aligns the sequences);
+-- shard_identity records which shard a database is, so a reordered
+-- POSTGRES_SHARD_DSNS fails at startup instead of mixing ids.
+ALTER TABLE passwords ALTER COLUMN user_id TYPE BIGINT, ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE audit_log ALTER COLUMN user_id TYPE BIGINT;
+ALTER TABLE api_tokens ALTER COLUMN user_id TYPE BIGINT, ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE users ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE key_rotation ALTER COLUMN last_id TYPE BIGINT;
+ALTER SEQUENCE users_id_seq AS BIGINT;
+ALTER SEQUENCE passwords_id_seq AS BIGINT;
+ALTER SEQUENCE api_tokens_id_seq AS BIGINT;
+
+CREATE TABLE IF NOT EXISTS shard_identity (
+    shard INTEGER PRIMARY KEY,
+    id_floor BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Which shard holds each user, with the globally unique usernames and
+-- emails. Only the directory database (shard 0) uses it; moving is set by
+-- move_user.py while the user's rows are copied and writes must wait.
+CREATE TABLE IF NOT EXISTS user_directory (
+    user_id BIGINT PRIMARY KEY,
+    username VARCHAR(50) UNIQUE NOT NULL,
+    email VARCHAR(120) UNIQUE NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0,
+    moving BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+INSERT INTO user_directory (user_id, username, email)
+SELECT id, username, email FROM users
+ON CONFLICT DO NOTHING;
+
+-- API tokens stay in the directory database so a token is found without
+-- knowing its user's shard, and survive the user moving
+ALTER TABLE api_tokens DROP CONSTRAINT IF EXISTS api_tokens_user_id_fkey;
+ALTER TABLE api_tokens ADD CONSTRAINT api_tokens_user_id_fkey
+    FOREIGN KEY (user_id) REFERENCES user_directory(user_id) ON DELETE CASCADE;
@@ -0,0 +1,43 @@
+-- create_audit_partitions() could not create a month whose rows had landed in
+-- audit_log_default (PostgreSQL refuses a partition that would take rows the
+-- default partition holds). Such a month is now created with the default
+-- partition detached, its rows are moved into it, and the default partition
+-- is attached again, all in the caller's transaction and under the parent's
+-- lock, so concurrent inserts wait instead of failing.
+CREATE OR REPLACE FUNCTION create_audit_partitions(first_month DATE, months_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', first_month);
+    last_month DATE := date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    -- Serialise workers starting at the same time
+    PERFORM pg_advisory_xact_lock(724012);
+    WHILE month_start <= last_month LOOP
+        partition_name := 'audit_log_' || to_char(month_start, '"y"YYYY"m"MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Hold inserts off until the month's partition exists
+            LOCK TABLE audit_log IN SHARE ROW EXCLUSIVE MODE;
+            IF EXISTS (SELECT 1 FROM audit_log_default
+                       WHERE created_at >= month_start AND created_at < month_start + INTERVAL '1 month') THEN
+                ALTER TABLE audit_log DETACH PARTITION audit_log_default;
+                EXECUTE format('CREATE TABLE %I PARTITION OF audit_log FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, month_start, month_start + INTERVAL '1 month');
+                INSERT INTO audit_log (id, user_id, action, details, ip_address, created_at)
+                SELECT id, user_id, action, details, ip_address, created_at FROM audit_log_default
+                WHERE created_at >= month_start AND created_at < month_start + INTERVAL '1 month';
+                DELETE FROM audit_log_default
+                WHERE created_at >= month_start AND created_at < month_start + INTERVAL '1 month';
+                ALTER TABLE audit_log ATTACH PARTITION audit_log_default DEFAULT;
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF audit_log FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, month_start, month_start + INTERVAL '1 month');
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
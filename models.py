@@ -1,81 +1,117 @@
+import csv
+import io
+import json
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from contextlib import contextmanager
+from datetime import datetime, timezone
+from migrate import run_migrations
+from metrics import timed
 
 @contextmanager
 def get_db_connection(get_db_func):
-    """Get a database connection with proper error handling"""
-    conn = None
+    """Get the request's pooled connection, rolling back on database errors.
+
+    The connection is owned by the caller of ``get_db_func`` (the app returns
+    it to the pool at the end of the request), so it is not closed here.
+    """
+    conn = get_db_func()
     try:
-        conn = get_db_func()
         yield conn
-    except psycopg2.Error as e:
+    except psycopg2.Error:
+        conn.rollback()
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def init_db(get_db_func):
-    """Initialize the database with required tables"""
-    conn = get_db_func()
-    try:
+    """Bring the database schema up to date (no DDL when already current)"""
+    run_migrations(get_db_func)
+
+@timed('db_query_duration_seconds', query='get_user_credentials')
+def get_user_credentials(user_id, get_db_func):
+    """Get a user's password hash and wrapped data key"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, hashed_password, dek_wrapped, dek_salt, kdf_iterations
+                FROM users WHERE id = %s
+            """, (user_id,))
+            return cur.fetchone()
+
+@timed('db_query_duration_seconds', query='update_user_keys')
+def update_user_keys(user_id, dek_wrapped, dek_salt, kdf_iterations, get_db_func, hashed_password=None):
+    """Store a user's re-wrapped data key (and new password hash) in one transaction"""
+    with get_db_connection(get_db_func) as conn:
         with conn.cursor() as cur:
-            # Create users table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    email VARCHAR(120) UNIQUE NOT NULL,
-                    hashed_password VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_login TIMESTAMP
-                )
-            """)
-            
-            # Create passwords table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS passwords (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    service VARCHAR(100) NOT NULL,
-                    username VARCHAR(100) NOT NULL,
-                    password TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    notes TEXT
-                )
-            """)
-            
-            # Create audit_log table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS audit_log (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
-                    action VARCHAR(50) NOT NULL,
-                    details TEXT,
-                    ip_address VARCHAR(45),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            conn.commit()
-    except Exception as e:
-        raise
-    finally:
-        conn.close()
+            cur.execute("""
+                UPDATE users
+                SET dek_wrapped = %s, dek_salt = %s, kdf_iterations = %s,
+                    hashed_password = COALESCE(%s, hashed_password)
+                WHERE id = %s
+            """, (dek_wrapped, dek_salt, kdf_iterations, hashed_password, user_id))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='init_user_keys')
+def init_user_keys(user_id, dek_wrapped, dek_salt, kdf_iterations, get_db_func):
+    """Store the first wrapped data key of a user that has none; False when another login stored one first"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users
+                SET dek_wrapped = %s, dek_salt = %s, kdf_iterations = %s
+                WHERE id = %s AND dek_wrapped IS NULL
+            """, (dek_wrapped, dek_salt, kdf_iterations, user_id))
+            stored = cur.rowcount == 1
+            conn.commit()
+            return stored
+
+@timed('db_query_duration_seconds', query='record_login')
+def record_login(user_id, get_db_func, hashed_password=None):
+    """Set last_login and, when given, the upgraded password hash in one transaction"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users
+                SET last_login = CURRENT_TIMESTAMP, hashed_password = COALESCE(%s, hashed_password)
+                WHERE id = %s
+            """, (hashed_password, user_id))
+            conn.commit()
+
+def _bump_vault_version(cur, user_id):
+    """Increment the user's vault version inside the caller's transaction.
+
+    Listeners on the vault_version channel are notified at commit.
+    """
+    cur.execute("""
+        UPDATE users SET vault_version = vault_version + 1 WHERE id = %s RETURNING vault_version
+    """, (user_id,))
+    row = cur.fetchone()
+    if row is not None:
+        cur.execute("SELECT pg_notify('vault_version', %s)", ('{}:{}'.format(user_id, row[0]),))
 
-def save_password(service, username, encrypted_password, user_id, get_db_func):
+@timed('db_query_duration_seconds', query='get_vault_version')
+def get_vault_version(user_id, get_db_func):
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT vault_version FROM users WHERE id = %s", (user_id,))
+            row = cur.fetchone()
+    return row[0] if row else 0
+
+@timed('db_query_duration_seconds', query='save_password')
+def save_password(service, username, encrypted_password, user_id, get_db_func, fingerprint=None):
     """Save a new password entry"""
     with get_db_connection(get_db_func) as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO passwords (service, username, password, user_id)
-                VALUES (%s, %s, %s, %s)
+                INSERT INTO passwords (service, username, password, user_id, fingerprint)
+                VALUES (%s, %s, %s, %s, %s)
                 RETURNING id
-            """, (service, username, encrypted_password, user_id))
+            """, (service, username, encrypted_password, user_id, fingerprint))
+            password_id = cur.fetchone()[0]
+            _bump_vault_version(cur, user_id)
             conn.commit()
-            return cur.fetchone()[0]
+            return password_id
 
+@timed('db_query_duration_seconds', query='get_password')
 def get_password(password_id, user_id, get_db_func):
     """Get a specific password entry"""
     with get_db_connection(get_db_func) as conn:
@@ -86,17 +122,22 @@ def get_password(password_id, user_id, get_db_func):
             """, (password_id, user_id))
             return cur.fetchone()
 
-def update_password(password_id, service, username, encrypted_password, user_id, get_db_func):
+@timed('db_query_duration_seconds', query='update_password')
+def update_password(password_id, service, username, encrypted_password, user_id, get_db_func, fingerprint=None):
     """Update an existing password entry"""
     with get_db_connection(get_db_func) as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 UPDATE passwords
-                SET service = %s, username = %s, password = %s, updated_at = CURRENT_TIMESTAMP
+                SET service = %s, username = %s, password = %s, fingerprint = %s,
+                    updated_at = CURRENT_TIMESTAMP
                 WHERE id = %s AND user_id = %s
-            """, (service, username, encrypted_password, password_id, user_id))
+            """, (service, username, encrypted_password, fingerprint, password_id, user_id))
+            if cur.rowcount:
+                _bump_vault_version(cur, user_id)
             conn.commit()
 
+@timed('db_query_duration_seconds', query='delete_password')
 def delete_password(password_id, user_id, get_db_func):
     """Delete a password entry"""
     with get_db_connection(get_db_func) as conn:
@@ -105,8 +146,11 @@ def delete_password(password_id, user_id, get_db_func):
                 DELETE FROM passwords
                 WHERE id = %s AND user_id = %s
             """, (password_id, user_id))
+            if cur.rowcount:
+                _bump_vault_version(cur, user_id)
             conn.commit()
 
+@timed('db_query_duration_seconds', query='get_user_passwords')
 def get_user_passwords(user_id, get_db_func):
     """Get all passwords for a user"""
     with get_db_connection(get_db_func) as conn:
@@ -118,12 +162,407 @@ def get_user_passwords(user_id, get_db_func):
             """, (user_id,))
             return cur.fetchall()
 
-def log_audit(user_id, action, details, ip_address, get_db_func):
-    """Log an audit event"""
+@timed('db_query_duration_seconds', query='get_user_passwords_page')
+def get_user_passwords_page(user_id, get_db_func, after=None, limit=50):
+    """Get one page of a user's passwords ordered by (service, id), still encrypted.
+
+    ``after`` is the (service, id) of the last entry of the previous page.
+    Returns the rows and the cursor of the next page (None on the last page).
+    """
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            if after is None:
+                cur.execute("""
+                    SELECT id, service, username, password FROM passwords
+                    WHERE user_id = %s
+                    ORDER BY service, id
+                    LIMIT %s
+                """, (user_id, limit + 1))
+            else:
+                cur.execute("""
+                    SELECT id, service, username, password FROM passwords
+                    WHERE user_id = %s AND (service, id) > (%s, %s)
+                    ORDER BY service, id
+                    LIMIT %s
+                """, (user_id, after[0], after[1], limit + 1))
+            rows = cur.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]['service'], rows[-1]['id'])
+    return rows, None
+
+def _like_prefix(query):
+    """LIKE pattern matching values that start with ``query`` literally"""
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+@timed('db_query_duration_seconds', query='search_passwords_prefix')
+def search_passwords_prefix(user_id, query, get_db_func, after=None, limit=50):
+    """Entries whose service or username starts with ``query`` (case-insensitive).
+
+    Ordered and paginated like get_user_passwords_page; passwords stay encrypted.
+    """
+    pattern = _like_prefix(query.lower())
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, service, username, password FROM passwords
+                WHERE user_id = %s
+                  AND (lower(service) LIKE %s OR lower(username) LIKE %s)
+                  AND (%s IS NULL OR (service, id) > (%s, %s))
+                ORDER BY service, id
+                LIMIT %s
+            """, (user_id, pattern, pattern, after and after[1],
+                  after and after[0], after and after[1], limit + 1))
+            rows = cur.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]['service'], rows[-1]['id'])
+    return rows, None
+
+@timed('db_query_duration_seconds', query='search_passwords_fuzzy')
+def search_passwords_fuzzy(user_id, query, get_db_func, after=None, limit=50):
+    """Entries whose service or username resembles ``query`` (trigram word similarity).
+
+    Best matches first. ``after`` is the (score, id) of the last entry of the
+    previous page. Passwords stay encrypted.
+    """
+    query = query.lower()
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT * FROM (
+                    SELECT id, service, username, password,
+                           greatest(word_similarity(%s, lower(service)),
+                                    word_similarity(%s, lower(username)))::float8 AS score
+                    FROM passwords
+                    WHERE user_id = %s
+                      AND (%s <%% lower(service) OR %s <%% lower(username))
+                ) matches
+                WHERE %s IS NULL OR score < %s OR (score = %s AND id > %s)
+                ORDER BY score DESC, id
+                LIMIT %s
+            """, (query, query, user_id, query, query, after and after[1],
+                  after and after[0], after and after[0], after and after[1], limit + 1))
+            rows = cur.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]['score'], rows[-1]['id'])
+    return rows, None
+
+@timed('db_query_duration_seconds', query='bulk_insert_passwords')
+def bulk_insert_passwords(batches, user_id, get_db_func):
+    """COPY batches of (service, username, encrypted_password, fingerprint) rows in one transaction"""
+    count = 0
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            for batch in batches:
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                for service, username, encrypted_password, fingerprint in batch:
+                    writer.writerow((service, username, encrypted_password, user_id, '\\x' + fingerprint.hex()))
+                buf.seek(0)
+                cur.copy_expert("""
+                    COPY passwords (service, username, password, user_id, fingerprint) FROM STDIN WITH (FORMAT csv)
+                """, buf)
+                count += len(batch)
+            if count:
+                _bump_vault_version(cur, user_id)
+            conn.commit()
+    return count
+
+@timed('db_query_duration_seconds', query='get_reused_passwords')
+def get_reused_passwords(user_id, get_db_func):
+    """Groups of entries sharing a password, found by fingerprint without decrypting.
+
+    Returns (groups, unchecked): each group is a list of {id, service, username}
+    and unchecked counts entries that have no fingerprint yet.
+    """
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT json_agg(json_build_object('id', id, 'service', service, 'username', username)
+                                ORDER BY service, id)
+                FROM passwords
+                WHERE user_id = %s AND fingerprint IS NOT NULL
+                GROUP BY fingerprint
+                HAVING count(*) > 1
+                ORDER BY count(*) DESC, min(service)
+            """, (user_id,))
+            groups = [row[0] for row in cur.fetchall()]
+            cur.execute("""
+                SELECT count(*) FROM passwords WHERE user_id = %s AND fingerprint IS NULL
+            """, (user_id,))
+            unchecked = cur.fetchone()[0]
+    return groups, unchecked
+
+def stream_user_passwords(user_id, get_db_func, itersize=1000):
+    """Yield a user's passwords (still encrypted) through a server-side cursor"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(name='stream_user_passwords', cursor_factory=DictCursor) as cur:
+            cur.itersize = itersize
+            cur.execute("""
+                SELECT id, service, username, password FROM passwords
+                WHERE user_id = %s
+                ORDER BY service, id
+            """, (user_id,))
+            for row in cur:
+                yield row
+        conn.rollback()
+
+@timed('db_query_duration_seconds', query='apply_password_batch')
+def apply_password_batch(user_id, creates, updates, deletes, get_db_func):
+    """Apply creates, updates and deletes of one user's entries in a single transaction.
+
+    creates are (service, username, encrypted_password, fingerprint), updates
+    (id, service, username, encrypted_password, fingerprint) and deletes ids.
+    Either everything is committed and (created_ids, set()) is returned, or
+    nothing is and the second item holds the ids that were not found.
+    """
+    created = []
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            if creates:
+                created = [row[0] for row in execute_values(cur, """
+                    INSERT INTO passwords (service, username, password, fingerprint, user_id)
+                    VALUES %s RETURNING id
+                """, creates, template='(%s, %s, %s, %s, {})'.format(int(user_id)),
+                    page_size=len(creates), fetch=True)]
+            found = set()
+            if updates:
+                found.update(row[0] for row in execute_values(cur, """
+                    UPDATE passwords AS p
+                    SET service = v.service, username = v.username, password = v.password,
+                        fingerprint = v.fingerprint, updated_at = CURRENT_TIMESTAMP
+                    FROM (VALUES %s) AS v (id, service, username, password, fingerprint)
+                    WHERE p.id = v.id AND p.user_id = {}
+                    RETURNING p.id
+                """.format(int(user_id)), updates, template='(%s, %s, %s, %s, %s::bytea)',
+                    page_size=len(updates), fetch=True))
+            if deletes:
+                cur.execute("""
+                    DELETE FROM passwords WHERE user_id = %s AND id = ANY(%s) RETURNING id
+                """, (user_id, list(deletes)))
+                found.update(row[0] for row in cur.fetchall())
+            missing = {row[0] for row in updates} | set(deletes)
+            missing -= found
+            if missing:
+                conn.rollback()
+                return None, missing
+            _bump_vault_version(cur, user_id)
+            conn.commit()
+    return created, set()
+
+@timed('db_query_duration_seconds', query='create_api_token')
+def create_api_token(user_id, name, token_hash, dek_wrapped, expires_in_days, get_db_func):
+    """Store a new API token; returns its id and expiry (None for no expiry)"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO api_tokens (user_id, name, token_hash, dek_wrapped, expires_at)
+                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(days => %s))
+                RETURNING id, expires_at
+            """, (user_id, name, token_hash, dek_wrapped, expires_in_days))
+            conn.commit()
+            return cur.fetchone()
+
+@timed('db_query_duration_seconds', query='get_api_token')
+def get_api_token(token_id, get_db_func):
+    """An active (not revoked, not expired) API token, or None"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, user_id, token_hash, dek_wrapped, last_used_at,
+                       last_used_at < CURRENT_TIMESTAMP - INTERVAL '1 minute' AS stale
+                FROM api_tokens
+                WHERE id = %s AND revoked_at IS NULL
+                  AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+            """, (token_id,))
+            return cur.fetchone()
+
+@timed('db_query_duration_seconds', query='touch_api_token')
+def touch_api_token(token_id, get_db_func):
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE api_tokens SET last_used_at = CURRENT_TIMESTAMP WHERE id = %s", (token_id,))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='list_api_tokens')
+def list_api_tokens(user_id, get_db_func):
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, name, created_at, last_used_at, expires_at, revoked_at
+                FROM api_tokens WHERE user_id = %s ORDER BY id
+            """, (user_id,))
+            return cur.fetchall()
+
+@timed('db_query_duration_seconds', query='revoke_api_token')
+def revoke_api_token(token_id, user_id, get_db_func):
+    """Revoke one of the user's tokens; returns whether it existed"""
     with get_db_connection(get_db_func) as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO audit_log (user_id, action, details, ip_address)
-                VALUES (%s, %s, %s, %s)
-            """, (user_id, action, details, ip_address))
-            conn.commit() 
\ No newline at end of file
+                UPDATE api_tokens SET revoked_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND user_id = %s AND revoked_at IS NULL
+            """, (token_id, user_id))
+            conn.commit()
+            return cur.rowcount == 1
+
+@timed('db_query_duration_seconds', query='log_audit')
+def log_audit(user_id, action, details, ip_address, get_db_func, writer=None):
+    """Log an audit event, through the background writer when one is given"""
+    if writer is not None and writer.submit(user_id, action, details, ip_address):
+        return
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO audit_log (user_id, action, details, ip_address, created_at)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (user_id, action, details, ip_address, audit_time()))
+            conn.commit()
+
+def audit_time():
+    """The time of an audit event happening now.
+
+    Timezone-aware, so PostgreSQL converts it to the session's TimeZone on
+    the way into the TIMESTAMP column, as it does for CURRENT_TIMESTAMP.
+    """
+    return datetime.now(timezone.utc)
+
+@timed('db_query_duration_seconds', query='log_audit_batch')
+def log_audit_batch(events, get_db_func):
+    """Insert (user_id, action, details, ip_address, created_at) events in one statement"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO audit_log (user_id, action, details, ip_address, created_at)
+                VALUES %s
+            """, events, page_size=len(events))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='get_audit_history_page')
+def get_audit_history_page(user_id, get_db_func, before=None, limit=50):
+    """Get one page of a user's audit events, newest first.
+
+    ``before`` is the (created_at, id) of the last event of the previous
+    page; the keyset is served by idx_audit_log_user_history in every
+    partition. Returns the rows and the cursor of the next page (None on the
+    last page).
+    """
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            if before is None:
+                cur.execute("""
+                    SELECT id, action, details, ip_address, created_at FROM audit_log
+                    WHERE user_id = %s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, limit + 1))
+            else:
+                cur.execute("""
+                    SELECT id, action, details, ip_address, created_at FROM audit_log
+                    WHERE user_id = %s AND (created_at, id) < (%s, %s)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                """, (user_id, before[0], before[1], limit + 1))
+            rows = cur.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]['created_at'], rows[-1]['id'])
+    return rows, None
+
+@timed('db_query_duration_seconds', query='create_audit_partitions')
+def create_audit_partitions(months_ahead, get_db_func, first_month=None):
+    """Create the monthly audit_log partitions from ``first_month`` (default: this month)
+    up to ``months_ahead`` months from now, moving their rows out of the default partition"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT create_audit_partitions(COALESCE(%s, CURRENT_DATE), %s)", (first_month, months_ahead))
+            created = cur.fetchone()[0]
+            conn.commit()
+            return created
+
+@timed('db_query_duration_seconds', query='get_directory_entry')
+def get_directory_entry(user_id, get_db_func):
+    """Get the shard (and whether it is being moved) of a user from the directory"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT user_id, shard, moving FROM user_directory WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+            conn.rollback()
+            return row
+
+@timed('db_query_duration_seconds', query='find_directory_user')
+def find_directory_user(username, get_db_func):
+    """Get the directory entry of a username"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT user_id, shard, moving FROM user_directory WHERE username = %s", (username,))
+            return cur.fetchone()
+
+@timed('db_query_duration_seconds', query='find_directory_email')
+def find_directory_email(email, get_db_func):
+    """Get the directory entry of an email address"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT user_id, shard, moving FROM user_directory WHERE email = %s", (email,))
+            return cur.fetchone()
+
+@timed('db_query_duration_seconds', query='reserve_user')
+def reserve_user(user_id, username, email, shard, get_db_func):
+    """Claim a username and email in the directory for a user about to be created.
+
+    Returns False when either is already taken.
+    """
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("""
+                    INSERT INTO user_directory (user_id, username, email, shard)
+                    VALUES (%s, %s, %s, %s)
+                """, (user_id, username, email, shard))
+            except psycopg2.IntegrityError:
+                conn.rollback()
+                return False
+            # Other workers' availability indexes learn about the names on commit
+            cur.execute("SELECT pg_notify('user_directory', %s)", (json.dumps([username, email]),))
+            conn.commit()
+            return True
+
+@timed('db_query_duration_seconds', query='release_user')
+def release_user(user_id, get_db_func):
+    """Remove a directory entry whose user could not be created"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM user_directory WHERE user_id = %s", (user_id,))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='set_user_shard')
+def set_user_shard(user_id, shard, moving, get_db_func):
+    """Point a directory entry at ``shard`` and set its moving flag"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE user_directory SET shard = %s, moving = %s WHERE user_id = %s",
+                        (shard, moving, user_id))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='create_user')
+def create_user(user_id, username, email, hashed_password, dek_wrapped, dek_salt, kdf_iterations, get_db_func):
+    """Insert a user under an id already reserved in the directory"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (id, username, email, hashed_password, dek_wrapped, dek_salt, kdf_iterations)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (user_id, username, email, hashed_password, dek_wrapped, dek_salt, kdf_iterations))
+            conn.commit()
+
+@timed('db_query_duration_seconds', query='next_user_id')
+def next_user_id(get_db_func):
+    """Draw a user id from a shard's sequence"""
+    with get_db_connection(get_db_func) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT nextval('users_id_seq')")
+            user_id = cur.fetchone()[0]
+            conn.commit()
+            return user_id
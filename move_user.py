@@ -0,0 +1,186 @@
+"""Move a user's rows to another shard while the application keeps running.
+
+    python move_user.py USERNAME TARGET_SHARD [--batch-size N]
+
+1. The user's directory entry is flagged as moving. After the workers'
+   shard map caches have expired, the app refuses the user's writes (503)
+   and logins; reads keep coming from the old shard.
+2. The users row, then the passwords and audit_log rows are copied in
+   keyset batches, each committed on the target on its own.
+3. Once the row counts match, the entry points at the target shard and the
+   flag is cleared.
+4. After the caches have expired again, no worker reads from the old shard
+   any more; audit events logged there meanwhile are copied and the rows
+   are deleted there in batches.
+
+A failure before step 3 clears the flag and removes the partial copy, so the
+move can simply be run again. API tokens live in the directory and stay put.
+"""
+import argparse
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from config import Config
+from models import find_directory_user, set_user_shard
+from shards import shard_connect_kwargs
+
+# (table, keyset columns, column holding the user id), in copy order
+TABLES = (
+    ('users', ('id',), 'id'),
+    ('passwords', ('id',), 'user_id'),
+    ('audit_log', ('created_at', 'id'), 'user_id'),
+)
+
+
+def _columns(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            ORDER BY ordinal_position
+        """, (table,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def _schema_version(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        version = cur.fetchone()[0]
+    conn.rollback()
+    return version
+
+
+def copy_rows(source, target, table, keys, user_column, user_id, batch_size=1000, report=None):
+    """Copy the user's rows of ``table`` in keyset batches; returns the number copied"""
+    columns = _columns(source, table)
+    key_index = [columns.index(key) for key in keys]
+    select = sql.SQL('SELECT {cols} FROM {table} WHERE {user} = %s AND ({keys}) > ({params}) ORDER BY {keys} LIMIT %s').format(
+        cols=sql.SQL(', ').join(map(sql.Identifier, columns)), table=sql.Identifier(table),
+        user=sql.Identifier(user_column), keys=sql.SQL(', ').join(map(sql.Identifier, keys)),
+        params=sql.SQL(', ').join(sql.Placeholder() * len(keys)))
+    insert = sql.SQL('INSERT INTO {table} ({cols}) VALUES %s ON CONFLICT DO NOTHING').format(
+        table=sql.Identifier(table), cols=sql.SQL(', ').join(map(sql.Identifier, columns)))
+
+    copied = 0
+    # Below every key: ids are positive and audit rows have timestamps
+    after = ('-infinity',) * (len(keys) - 1) + (0,)
+    while True:
+        with source.cursor() as cur:
+            cur.execute(select, (user_id,) + after + (batch_size,))
+            rows = cur.fetchall()
+        source.rollback()
+        if not rows:
+            return copied
+        with target.cursor() as cur:
+            execute_values(cur, insert.as_string(target), rows, page_size=len(rows))
+        target.commit()
+        copied += len(rows)
+        after = tuple(rows[-1][i] for i in key_index)
+        if report:
+            report('{}: {} rows copied'.format(table, copied))
+
+
+def count_rows(conn, table, user_column, user_id):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('SELECT COUNT(*) FROM {} WHERE {} = %s').format(
+            sql.Identifier(table), sql.Identifier(user_column)), (user_id,))
+        count = cur.fetchone()[0]
+    conn.rollback()
+    return count
+
+
+def delete_rows(conn, user_id, batch_size=1000):
+    """Delete every row of the user on one shard, children first, a batch per transaction"""
+    for table, keys, user_column in reversed(TABLES):
+        statement = sql.SQL('DELETE FROM {table} WHERE ({keys}) IN (SELECT {keys} FROM {table} WHERE {user} = %s LIMIT %s)').format(
+            table=sql.Identifier(table), keys=sql.SQL(', ').join(map(sql.Identifier, keys)), user=sql.Identifier(user_column))
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(statement, (user_id, batch_size))
+                deleted = cur.rowcount
+            conn.commit()
+            if not deleted:
+                break
+
+
+def move_user(directory, shards, username, target_shard, wait, batch_size=1000, report=print):
+    """Move ``username`` to ``target_shard``; ``shards`` are connections in shard order"""
+    entry = find_directory_user(username, lambda: directory)
+    directory.rollback()
+    if entry is None:
+        raise ValueError('unknown user {}'.format(username))
+    user_id, source_shard = entry['user_id'], entry['shard']
+    if source_shard == target_shard:
+        report('{} is already on shard {}.'.format(username, target_shard))
+        return
+    source, target = shards[source_shard], shards[target_shard]
+    if _schema_version(source) != _schema_version(target):
+        raise RuntimeError('shards {} and {} are at different schema versions; run the migrations first'.format(
+            source_shard, target_shard))
+
+    set_user_shard(user_id, source_shard, True, lambda: directory)
+    report('Waiting {:.0f}s for every worker to stop writing for {}...'.format(wait, username))
+    time.sleep(wait)
+    try:
+        with source.cursor() as cur:
+            cur.execute("SELECT MIN(created_at)::date FROM audit_log WHERE user_id = %s", (user_id,))
+            first_month = cur.fetchone()[0]
+        source.rollback()
+        if first_month is not None:
+            with target.cursor() as cur:
+                cur.execute("SELECT create_audit_partitions(%s, %s)", (first_month, Config.AUDIT_PARTITIONS_AHEAD))
+            target.commit()
+
+        for table, keys, user_column in TABLES:
+            copy_rows(source, target, table, keys, user_column, user_id, batch_size, report)
+            if table == 'audit_log':
+                # Still growing while the user reads; the rest is copied after the switch
+                continue
+            expected, copied = count_rows(source, table, user_column, user_id), count_rows(target, table, user_column, user_id)
+            if expected != copied:
+                raise RuntimeError('{}: {} rows on shard {} but {} copied'.format(table, expected, source_shard, copied))
+    except BaseException:
+        report('Move failed; removing the partial copy from shard {}.'.format(target_shard))
+        target.rollback()
+        delete_rows(target, user_id, batch_size)
+        set_user_shard(user_id, source_shard, False, lambda: directory)
+        raise
+
+    set_user_shard(user_id, target_shard, False, lambda: directory)
+    report('{} now lives on shard {}; waiting {:.0f}s before cleaning up shard {}...'.format(
+        username, target_shard, wait, source_shard))
+    time.sleep(wait)
+    # Reads were still allowed during the copy and log audit events
+    table, keys, user_column = TABLES[-1]
+    copy_rows(source, target, table, keys, user_column, user_id, batch_size, report)
+    delete_rows(source, user_id, batch_size)
+    report('Done.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move a user's vault to another shard")
+    parser.add_argument('username')
+    parser.add_argument('target_shard', type=int)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    shard_kwargs = shard_connect_kwargs(vars(Config))
+    if not 0 <= args.target_shard < len(shard_kwargs):
+        parser.error('target shard must be between 0 and {}'.format(len(shard_kwargs) - 1))
+    # Longer than any worker may keep routing on a stale directory entry
+    # (its shard map cache, or a lagging replica at login)
+    wait = max(Config.SHARD_MAP_CACHE_TTL, Config.REPLICA_MAX_LAG if Config.POSTGRES_REPLICA_DSNS else 0) + 2
+    conns = [psycopg2.connect(**kwargs) for kwargs in shard_kwargs]
+    directory = psycopg2.connect(**shard_kwargs[0])
+    try:
+        move_user(directory, conns, args.username, args.target_shard, wait, args.batch_size)
+    finally:
+        for conn in conns + [directory]:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+from dbtrace import TracedConnection, record_checkout
+
+
+def connect_kwargs(config):
+    """Build psycopg2.connect() arguments from a config mapping"""
+    return dict(
+        dbname=config['POSTGRES_DB'],
+        user=config['POSTGRES_USER'],
+        password=config['POSTGRES_PASSWORD'],
+        host=config['POSTGRES_HOST'],
+        port=config['POSTGRES_PORT']
+    )
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection becomes available before the checkout timeout"""
+
+
+class ConnectionPool:
+    """Per-process PostgreSQL connection pool.
+
+    Connections are handed out LIFO so the warmest ones are reused first.
+    On borrow a connection is discarded if it is closed, older than
+    ``max_lifetime`` or idle for longer than ``max_idle``; connections idle
+    for more than ``ping_interval`` seconds are pinged with ``SELECT 1``.
+    After a fork the child starts with an empty pool and never touches the
+    sockets inherited from the parent. Checkouts and the statements run on
+    the connections count towards the current request's trace (dbtrace.py).
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=5.0, max_lifetime=1800,
+                 max_idle=300, ping_interval=30, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self._connect_kwargs = connect_kwargs
+        self._orphans = []
+        self._reset()
+
+    def _reset(self):
+        """Start from an empty pool owned by the current process"""
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._born = {}
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'recycled': 0,
+            'failed_checks': 0,
+            'wait_time': 0.0,
+        }
+
+    def _check_pid(self):
+        """Drop state inherited from a parent process after fork"""
+        if self._pid != os.getpid():
+            # Keep references so the inherited connections are never closed
+            # (and their sockets never shut down) from the child
+            self._orphans.extend(self._born)
+            self._reset()
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=TracedConnection, **self._connect_kwargs)
+        with self._cond:
+            self._born[conn] = time.monotonic()
+            self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn, stat='discarded'):
+        """Close a connection and release its slot"""
+        with self._cond:
+            self._born.pop(conn, None)
+            self._size -= 1
+            self._stats[stat] += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_stale(self, conn, last_used, now):
+        if conn.closed:
+            return True
+        if self.max_lifetime and now - self._born.get(conn, now) > self.max_lifetime:
+            return True
+        return bool(self.max_idle) and now - last_used > self.max_idle and self._size > self.minconn
+
+    def _is_healthy(self, conn, last_used, now):
+        """Check a connection before handing it out"""
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if self.ping_interval is None or now - last_used < self.ping_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to ``timeout`` seconds for a free slot"""
+        self._check_pid()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            "no connection available after %.1fs (max=%d)" % (timeout, self.maxconn))
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                break
+
+            now = time.monotonic()
+            if self._is_stale(conn, last_used, now):
+                self._discard(conn, 'recycled')
+                continue
+            if not self._is_healthy(conn, last_used, now):
+                self._discard(conn, 'failed_checks')
+                continue
+            break
+
+        with self._cond:
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+            self._stats['wait_time'] += time.monotonic() - started
+        record_checkout()
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, rolling back any open transaction"""
+        if self._pid != os.getpid() or conn not in self._born:
+            # Checked out before a fork, or not ours: never reuse or close it
+            return
+        if close or self._closed or conn.closed:
+            self._discard(conn)
+            return
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+        if self.max_lifetime and time.monotonic() - self._born[conn] > self.max_lifetime:
+            self._discard(conn, 'recycled')
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that checks a connection out and returns it afterwards"""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def warm(self):
+        """Open connections until the pool holds at least ``minconn``"""
+        self._check_pid()
+        conns = []
+        try:
+            while True:
+                with self._cond:
+                    if self._size >= self.minconn:
+                        break
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        self._check_pid()
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Return a snapshot of the pool counters"""
+        self._check_pid()
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                pid=self._pid,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                min=self.minconn,
+                max=self.maxconn,
+            )
+        return stats
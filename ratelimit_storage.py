@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from limits.storage import Storage, MovingWindowSupport
+
+
+class SQLiteStorage(Storage, MovingWindowSupport):
+    """Rate-limit storage shared by every worker process on a host.
+
+    Counters live in a SQLite database in WAL mode with memory-mapped I/O;
+    put it on tmpfs (``sqlite:///dev/shm/...``) so a check is a few
+    microseconds of local work with no network round trip. The moving-window
+    strategy keeps one row per hit, at most ``limit`` per key, stamped with
+    the end of its window; expired rows are compacted every ``compact_every``
+    writes so the file stays proportional to the number of active clients.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, compact_every=1000, **options):
+        super().__init__(uri, **options)
+        self.path = urlparse(uri).path if uri else os.path.join('/tmp', 'ratelimit.db')
+        self.compact_every = int(compact_every)
+        self._local = threading.local()
+        self._writes = 0
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            if 'expires' not in {row[1] for row in db.execute("PRAGMA table_info(window)")}:
+                # Windows written before rows carried their expiry; they are
+                # short-lived, so starting over costs at most one window
+                db.execute("DROP TABLE IF EXISTS window")
+            db.execute("CREATE TABLE IF NOT EXISTS window (key TEXT NOT NULL, ts REAL NOT NULL, expires REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_window_key_ts ON window (key, ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_window_expires ON window (expires)")
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _db(self):
+        """One connection per thread and process"""
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("PRAGMA mmap_size=67108864")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._db())
+
+    def _wrote(self, db, now):
+        self._writes += 1
+        if self._writes % self.compact_every == 0:
+            # Each row's own expiry, so other workers' longer windows survive
+            db.execute("DELETE FROM counters WHERE expires <= ?", (now,))
+            db.execute("DELETE FROM window WHERE expires <= ?", (now,))
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("""
+                INSERT INTO counters (key, count, expires) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    count = CASE WHEN expires <= ? THEN excluded.count ELSE count + excluded.count END,
+                    expires = CASE WHEN expires <= ? OR ? THEN excluded.expires ELSE expires END
+            """, (key, amount, now + expiry, now, now, bool(elastic_expiry)))
+            count = db.execute("SELECT count FROM counters WHERE key = ?", (key,)).fetchone()[0]
+            self._wrote(db, now)
+        return count
+
+    def get(self, key):
+        row = self._db().execute("SELECT count FROM counters WHERE key = ? AND expires > ?",
+                                 (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self._db().execute("SELECT expires FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM window WHERE key = ? AND ts <= ?", (key, now - expiry))
+            count = db.execute("SELECT COUNT(*) FROM window WHERE key = ?", (key,)).fetchone()[0]
+            if count + amount > limit:
+                return False
+            db.executemany("INSERT INTO window (key, ts, expires) VALUES (?, ?, ?)", [(key, now, now + expiry)] * amount)
+            self._wrote(db, now)
+        return True
+
+    def get_moving_window(self, key, limit, expiry):
+        start, count = self._db().execute(
+            "SELECT MIN(ts), COUNT(*) FROM window WHERE key = ? AND ts > ?",
+            (key, time.time() - expiry)).fetchone()
+        return (start if start is not None else time.time()), count
+
+    def check(self):
+        try:
+            self._db().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._transaction() as db:
+            count = db.execute("SELECT (SELECT COUNT(*) FROM counters) + (SELECT COUNT(*) FROM window)").fetchone()[0]
+            db.execute("DELETE FROM counters")
+            db.execute("DELETE FROM window")
+        return count
+
+    def clear(self, key):
+        with self._transaction() as db:
+            db.execute("DELETE FROM counters WHERE key = ?", (key,))
+            db.execute("DELETE FROM window WHERE key = ?", (key,))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, so read-modify-write is atomic across processes"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
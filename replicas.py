@@ -0,0 +1,128 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+from pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Replay lag in seconds; zero when the replica has replayed everything it
+# received (an idle primary does not make it fall behind) or is not a standby
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class Replica:
+    """One read replica: its pool and last known health"""
+
+    def __init__(self, dsn, pool):
+        self.dsn = dsn
+        self.pool = pool
+        self.healthy = True
+        self.lag = 0.0
+        self.failures = 0
+
+    @property
+    def name(self):
+        """The DSN without its password, for logs and metrics"""
+        return ' '.join(part for part in self.dsn.split() if not part.startswith('password='))
+
+
+class ReplicaRouter:
+    """Hands out read-only connections from healthy replicas, round-robin.
+
+    A background thread (started lazily, once per process) checks every
+    replica each ``check_interval`` seconds and takes it out of rotation
+    while it is unreachable or more than ``max_lag`` seconds behind. A
+    replica that fails at checkout is taken out at once. ``getconn`` returns
+    None when no replica can serve, and the caller reads from the primary.
+    """
+
+    def __init__(self, dsns, check_interval=5.0, max_lag=10.0, connect_timeout=2, **pool_kwargs):
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.replicas = [Replica(dsn, ConnectionPool(dsn=dsn, connect_timeout=connect_timeout, **pool_kwargs))
+                         for dsn in dsns]
+        self._next = itertools.cycle(self.replicas) if self.replicas else None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def _ensure_started(self):
+        """Start the health checker once per process (fork-safe)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='replica-health', daemon=True).start()
+
+    def getconn(self):
+        """(replica, connection) from the next healthy replica, or None"""
+        if not self.replicas:
+            return None
+        self._ensure_started()
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = next(self._next)
+            if not replica.healthy:
+                continue
+            try:
+                return replica, replica.pool.getconn()
+            except (PoolError, psycopg2.Error):
+                self._mark_down(replica)
+        return None
+
+    def putconn(self, replica, conn, close=False):
+        replica.pool.putconn(conn, close=close)
+
+    def _mark_down(self, replica):
+        if replica.healthy:
+            logger.warning('Replica %s is unavailable; reading from the primary', replica.name, exc_info=True)
+        replica.healthy = False
+        replica.failures += 1
+
+    def check(self, replica):
+        """Probe one replica and update its health"""
+        try:
+            with replica.pool.connection(timeout=self.check_interval) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(LAG_QUERY)
+                    replica.lag = float(cur.fetchone()[0])
+                conn.rollback()
+        except (PoolError, psycopg2.Error):
+            self._mark_down(replica)
+            return
+        healthy = replica.lag <= self.max_lag
+        if healthy != replica.healthy:
+            logger.warning('Replica %s is %s (lag %.1fs)', replica.name,
+                           'back in rotation' if healthy else 'lagging; reading from the primary', replica.lag)
+        if not healthy:
+            replica.failures += 1
+        replica.healthy = healthy
+
+    def _run(self):
+        while True:
+            for replica in self.replicas:
+                self.check(replica)
+            time.sleep(self.check_interval)
+
+    def stats(self):
+        return [dict(replica.pool.stats(), replica=replica.name, healthy=replica.healthy,
+                     lag=replica.lag, failures=replica.failures) for replica in self.replicas]
+
+    def closeall(self):
+        for replica in self.replicas:
+            replica.pool.closeall()
@@ -0,0 +1,210 @@
+"""Fernet key rotation for the passwords table.
+
+    python rotate_keys.py add                  # add a new primary key
+    python rotate_keys.py rotate [--workers N]  # re-encrypt old ciphertexts
+    python rotate_keys.py status
+    python rotate_keys.py retire VERSION       # drop a key no row uses any more
+
+Restart the web workers after ``add`` so they encrypt with the new key before
+running ``rotate``. Sessions keep their data key under the key that was
+primary at login; after ``retire`` those under the retired key must log in
+again. The rotation streams the table with a server-side cursor,
+re-encrypts batches in worker processes and commits each batch together with
+its checkpoint, so it can be interrupted and resumed and never holds more
+than a few batches in memory or locks more than one batch of rows.
+"""
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import psycopg2
+from cryptography.fernet import InvalidToken
+from psycopg2.extras import execute_values
+
+from config import Config
+from crypto import KEY_FILE
+from key_ring import KeyRing
+from shards import shard_connect_kwargs
+
+_ring = None
+
+
+def _init_worker(keys):
+    global _ring
+    _ring = KeyRing(keys)
+
+
+def _rotate_batch(rows):
+    """Re-encrypt the rows not yet under the primary key"""
+    rotated = []
+    skipped = failed = 0
+    for row_id, token in rows:
+        token = token.encode()
+        if _ring.is_current(token):
+            skipped += 1
+            continue
+        try:
+            rotated.append((row_id, token.decode(), _ring.rotate(token).decode()))
+        except InvalidToken:
+            # Not under the ring: encrypted with a user's own data key
+            failed += 1
+    return rotated, skipped, failed
+
+
+def rotate_passwords(connect, ring, batch_size=1000, workers=None, restart=False, report=print):
+    """Re-encrypt every password with the primary key of ``ring``.
+
+    ``connect`` returns a new database connection; two are used, one holding
+    the read-only scan and one committing the re-encrypted batches.
+    """
+    global _ring
+    workers = os.cpu_count() if workers is None else workers
+    target = ring.primary_version
+    reader, writer = connect(), connect()
+    try:
+        with writer.cursor() as cur:
+            if restart:
+                cur.execute("DELETE FROM key_rotation WHERE target_version = %s", (target,))
+            cur.execute("""
+                INSERT INTO key_rotation (target_version) VALUES (%s)
+                ON CONFLICT (target_version) DO NOTHING
+            """, (target,))
+            cur.execute("""
+                SELECT last_id, rotated, skipped, failed, finished_at FROM key_rotation
+                WHERE target_version = %s
+            """, (target,))
+            last_id, rotated, skipped, failed, finished_at = cur.fetchone()
+            writer.commit()
+        if finished_at is not None:
+            report('Rotation to key version {} already finished at {}'.format(target, finished_at))
+            return
+        if last_id:
+            report('Resuming rotation to key version {} after id {}'.format(target, last_id))
+
+        reader.set_session(readonly=True)
+        scan = reader.cursor(name='key_rotation_scan')
+        scan.itersize = batch_size
+        scan.execute("SELECT id, password FROM passwords WHERE id > %s ORDER BY id", (last_id,))
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(ring.keys,))
+            submit = executor.submit
+        else:
+            executor = None
+            _ring = ring
+            submit = _run_inline
+
+        started = time.monotonic()
+        processed = 0
+        pending = deque()
+        try:
+            while True:
+                rows = scan.fetchmany(batch_size)
+                if rows:
+                    pending.append((rows[-1][0], len(rows), submit(_rotate_batch, rows)))
+                if pending and (len(pending) >= max(workers, 1) * 2 or not rows):
+                    batch_last_id, count, future = pending.popleft()
+                    batch, batch_skipped, batch_failed = future.result()
+                    with writer.cursor() as cur:
+                        if batch:
+                            # Rows edited since they were read keep their new value
+                            execute_values(cur, """
+                                UPDATE passwords AS p SET password = v.new
+                                FROM (VALUES %s) AS v (id, old, new)
+                                WHERE p.id = v.id AND p.password = v.old
+                            """, batch, page_size=len(batch))
+                        cur.execute("""
+                            UPDATE key_rotation
+                            SET last_id = %s, rotated = rotated + %s, skipped = skipped + %s,
+                                failed = failed + %s, updated_at = CURRENT_TIMESTAMP
+                            WHERE target_version = %s
+                        """, (batch_last_id, len(batch), batch_skipped, batch_failed, target))
+                    writer.commit()
+                    processed += count
+                    rotated += len(batch)
+                    skipped += batch_skipped
+                    failed += batch_failed
+                    elapsed = time.monotonic() - started
+                    report('id <= {}: {} rotated, {} current, {} under user keys ({:.0f} rows/s)'.format(
+                        batch_last_id, rotated, skipped, failed, processed / elapsed if elapsed else 0))
+                if not rows and not pending:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        scan.close()
+        reader.rollback()
+        with writer.cursor() as cur:
+            cur.execute("""
+                UPDATE key_rotation SET finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE target_version = %s
+            """, (target,))
+        writer.commit()
+        report('Rotation to key version {} finished'.format(target))
+    finally:
+        reader.close()
+        writer.close()
+
+
+def _run_inline(func, *args):
+    """Run without workers, returning an already-completed Future"""
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def _shard_connects():
+    """A connect function per shard; each shard keeps its own checkpoints"""
+    return [lambda kwargs=kwargs: psycopg2.connect(**kwargs) for kwargs in shard_connect_kwargs(vars(Config))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fernet key rotation for stored passwords')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('add', help='add a new primary key to the key ring')
+    rotate = commands.add_parser('rotate', help='re-encrypt passwords with the primary key')
+    rotate.add_argument('--batch-size', type=int, default=1000)
+    rotate.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    rotate.add_argument('--restart', action='store_true', help='ignore the saved checkpoint')
+    commands.add_parser('status', help='show keys and rotation checkpoints')
+    retire = commands.add_parser('retire', help='remove a key after rotating away from it')
+    retire.add_argument('version', type=int)
+    args = parser.parse_args()
+
+    ring = KeyRing.load(KEY_FILE)
+    if args.command == 'add':
+        ring = ring.with_new_key()
+        ring.save(KEY_FILE)
+        print('Added key version {}. Restart the application, then run "rotate".'.format(ring.primary_version))
+    elif args.command == 'rotate':
+        for shard, connect in enumerate(_shard_connects()):
+            print('Shard {}:'.format(shard))
+            rotate_passwords(connect, ring, args.batch_size, args.workers, args.restart)
+    elif args.command == 'status':
+        print('Keys: {} (primary {})'.format(', '.join(map(str, ring.versions)), ring.primary_version))
+        for shard, connect in enumerate(_shard_connects()):
+            with connect() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT target_version, last_id, rotated, skipped, failed, updated_at, finished_at
+                    FROM key_rotation ORDER BY target_version
+                """)
+                for row in cur.fetchall():
+                    print('shard {} v{}: last id {}, {} rotated, {} current, {} under user keys, updated {}, finished {}'
+                          .format(shard, *row))
+    elif args.command == 'retire':
+        for shard, connect in enumerate(_shard_connects()):
+            with connect() as conn, conn.cursor() as cur:
+                cur.execute("SELECT finished_at FROM key_rotation WHERE target_version = %s",
+                            (ring.primary_version,))
+                row = cur.fetchone()
+            if row is None or row[0] is None:
+                parser.error('finish rotating to key version {} on shard {} first'.format(ring.primary_version, shard))
+        ring.without(args.version).save(KEY_FILE)
+        print('Retired key version {}.'.format(args.version))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,218 @@
-import re
+import os
+import math
+import string
+from array import array
+from functools import lru_cache
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from flask import current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import ratelimit_storage  # noqa: F401 -- registers the sqlite:// limiter storage
+from metrics import REGISTRY
+from strength import SPECIAL_CHARS, policy_from_config
 
 def init_limiter(app):
-    """Initialize rate limiter for the application"""
+    """Initialize rate limiter for the application.
+
+    Storage and strategy come from RATELIMIT_STORAGE_URI / RATELIMIT_STRATEGY;
+    the default is a moving window in a SQLite file shared by all workers.
+    """
     return Limiter(
         app,
         key_func=get_remote_address,
-        default_limits=[current_app.config['RATELIMIT_DEFAULT']]
+        default_limits=[app.config['RATELIMIT_DEFAULT']]
     )
 
 def validate_password_strength(password):
     """Validate password strength based on configuration"""
-    config = current_app.config
-    
-    if len(password) < config['MIN_PASSWORD_LENGTH']:
-        return False, "Password must be at least {} characters long".format(config['MIN_PASSWORD_LENGTH'])
-    
-    if config['REQUIRE_SPECIAL_CHARS'] and not re.search(r'[!@#$%^&*(),.?":{}|<>]', password):
-        return False, "Password must contain at least one special character"
-    
-    if config['REQUIRE_NUMBERS'] and not re.search(r'\d', password):
-        return False, "Password must contain at least one number"
-    
-    if config['REQUIRE_UPPERCASE'] and not re.search(r'[A-Z]', password):
-        return False, "Password must contain at least one uppercase letter"
-    
-    if config['REQUIRE_LOWERCASE'] and not re.search(r'[a-z]', password):
-        return False, "Password must contain at least one lowercase letter"
+    is_valid, message = policy_from_config(current_app.config).check(password)
+    if not is_valid:
+        return is_valid, message
+
+    corpus = getattr(current_app, 'breach_corpus', None)
+    if corpus is not None and password in corpus:
+        return False, "This password has appeared in a data breach, please choose another"
     
-    return True, "Password is valid"
+    return True, message
 
-def hash_password(password):
+def hash_password(password, method='pbkdf2:sha256'):
     """Hash a password using werkzeug's secure password hashing"""
-    return generate_password_hash(password)
+    return generate_password_hash(password, method=method)
 
 def verify_password(hashed_password, password):
     """Verify a password against its hash"""
     return check_password_hash(hashed_password, password)
 
+def _parse_method(method):
+    """Split a werkzeug method string ('pbkdf2:sha256:260000') into (name, iterations)"""
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        iterations = int(parts[2]) if len(parts) > 2 else None
+        return ':'.join(parts[:2]), iterations
+    return method, None
+
+def needs_rehash(hashed_password, method):
+    """Whether a stored hash uses another method or fewer iterations than the policy"""
+    stored_name, stored_iterations = _parse_method(hashed_password.split('$', 1)[0])
+    name, iterations = _parse_method(method)
+    if stored_name != name:
+        return True
+    return iterations is not None and (stored_iterations or 0) < iterations
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool is saturated or too slow to answer"""
+
+class HashingPool:
+    """Runs password hashing and key derivation on a dedicated process pool.
+
+    At most ``workers`` jobs run at once and ``max_pending`` more may wait;
+    beyond that ``run`` fails immediately with HashingBusy instead of tying up
+    the request thread. A job holds its slot until it ends, even after ``run``
+    gave up waiting for it. The executor is created lazily in each process
+    and replaced when a worker dies.
+    """
+
+    def __init__(self, workers=2, max_pending=8, timeout=10):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context('forkserver'))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def run(self, func, *args):
+        """Run ``func(*args)`` in the pool and wait for its result"""
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Too many password operations in progress')
+        try:
+            executor = self._get_executor()
+            started = time.perf_counter()
+            future = executor.submit(func, *args)
+        except BaseException as e:
+            self._slots.release()
+            if isinstance(e, BrokenProcessPool):
+                self._discard(executor)
+                raise HashingBusy('Password worker crashed') from e
+            raise
+        # The slot stays taken until the job ends, even when we stop waiting
+        # for it, so the backlog never exceeds workers + max_pending
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy('Password operation timed out')
+        except BrokenProcessPool as e:
+            self._discard(executor)
+            raise HashingBusy('Password worker crashed') from e
+        finally:
+            REGISTRY.observe('password_hashing_duration_seconds', time.perf_counter() - started, op=func.__name__)
+
+    def _discard(self, executor):
+        """Drop a broken executor so the next run starts a new one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._pid = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+AMBIGUOUS_CHARS = frozenset('Il1|O0o`\'"')
+PASSPHRASE_WORDLIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wordlists', 'passphrase_words.txt')
+
+class GenerationPolicy:
+    """What generate_passwords produces: random characters or a passphrase.
+
+    Symbols are the special characters the strength policy accepts. Only a
+    character password with every class enabled and at least the policy's
+    length contains what validate_password_strength requires; passphrases
+    and passwords without some class may not pass it.
+    """
+
+    def __init__(self, length=16, lowercase=True, uppercase=True, digits=True, symbols=True,
+                 exclude_ambiguous=False, passphrase=False, words=6, separator='-'):
+        excluded = AMBIGUOUS_CHARS if exclude_ambiguous else frozenset()
+        self.classes = [''.join(sorted(frozenset(chars) - excluded)) for enabled, chars in (
+            (lowercase, string.ascii_lowercase),
+            (uppercase, string.ascii_uppercase),
+            (digits, string.digits),
+            (symbols, SPECIAL_CHARS),
+        ) if enabled]
+        self.alphabet = ''.join(self.classes)
+        self.length = length
+        self.passphrase = passphrase
+        self.words = words
+        self.separator = separator
+        if passphrase:
+            if not 3 <= words <= 20:
+                raise ValueError('A passphrase needs between 3 and 20 words')
+        else:
+            if not self.classes:
+                raise ValueError('Choose at least one character class')
+            if not max(4, len(self.classes)) <= length <= 128:
+                raise ValueError('Length must be between {} and 128'.format(max(4, len(self.classes))))
+
+@lru_cache(maxsize=4)
+def load_wordlist(path=PASSPHRASE_WORDLIST):
+    """Distinct words of a passphrase word list, one per line"""
+    with open(path, encoding='utf-8') as f:
+        return tuple(sorted({line.strip().lower() for line in f if line.strip()}))
+
+def _random_ints(count):
+    """``count`` uniformly random 64-bit integers from a single CSPRNG read"""
+    values = array('Q')
+    values.frombytes(os.urandom(values.itemsize * count))
+    return iter(values)
+
+def generate_passwords(count, policy, wordlist=PASSPHRASE_WORDLIST):
+    """Generate ``count`` passwords following ``policy``.
+
+    Every required class is placed once and the rest drawn from the whole
+    alphabet before a Fisher-Yates shuffle, so no password is ever retried.
+    Indexes come from 64-bit draws scaled with a multiply-shift (bias below
+    2**-50 for any alphabet here) and all draws are read from os.urandom at once.
+    """
+    if policy.passphrase:
+        words = load_wordlist(wordlist)
+        rand = _random_ints(count * policy.words)
+        return [policy.separator.join(words[(next(rand) * len(words)) >> 64] for _ in range(policy.words))
+                for _ in range(count)]
+
+    classes, alphabet, length = policy.classes, policy.alphabet, policy.length
+    rand = _random_ints(count * (2 * length - 1))
+    passwords = []
+    for _ in range(count):
+        chars = [chars[(next(rand) * len(chars)) >> 64] for chars in classes]
+        chars += [alphabet[(next(rand) * len(alphabet)) >> 64] for _ in range(length - len(classes))]
+        for i in range(length - 1, 0, -1):
+            j = (next(rand) * (i + 1)) >> 64
+            chars[i], chars[j] = chars[j], chars[i]
+        passwords.append(''.join(chars))
+    return passwords
+
+def generation_entropy(policy, wordlist=PASSPHRASE_WORDLIST):
+    """Approximate entropy in bits of one password generated under ``policy``"""
+    if policy.passphrase:
+        return policy.words * math.log2(len(load_wordlist(wordlist)))
+    return policy.length * math.log2(len(policy.alphabet))
+
 def generate_secure_password(length=16):
     """Generate a secure random password"""
-    import secrets
-    import string
-    
-    alphabet = string.ascii_letters + string.digits + string.punctuation
-    while True:
-        password = ''.join(secrets.choice(alphabet) for i in range(length))
-        if (any(c.islower() for c in password)
-                and any(c.isupper() for c in password)
-                and any(c.isdigit() for c in password)
-                and any(c in string.punctuation for c in password)):
-            break
-    return password 
\ No newline at end of file
+    return generate_passwords(1, GenerationPolicy(length))[0]
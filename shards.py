@@ -0,0 +1,124 @@
+"""Users and their vaults spread over several PostgreSQL databases.
+
+Shard 0 is the database configured by ``POSTGRES_*``; it also holds the
+user directory (user id -> shard, plus the globally unique usernames and
+emails) and the API tokens. ``POSTGRES_SHARD_DSNS`` adds shards 1..N-1. New
+users are placed by a hash of their username; move_user.py moves one later.
+
+Ids stay unique across shards because every shard's sequences step by
+SHARD_ID_STRIDE from a start congruent to the shard number, above every id
+any shard had handed out when it joined.
+"""
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+from psycopg2 import sql
+
+from models import get_directory_entry
+from pool import connect_kwargs
+
+# Largest number of shards ids leave room for
+SHARD_ID_STRIDE = 1024
+SEQUENCES = ('users_id_seq', 'passwords_id_seq', 'audit_log_id_seq', 'api_tokens_id_seq')
+
+# Key of the advisory lock held while a shard's sequences are aligned
+SHARD_INIT_LOCK_ID = 724013
+
+ShardEntry = namedtuple('ShardEntry', 'shard moving')
+
+
+def shard_connect_kwargs(config):
+    """psycopg2.connect() arguments of every shard, shard 0 first"""
+    return [connect_kwargs(config)] + [{'dsn': dsn} for dsn in config['POSTGRES_SHARD_DSNS']]
+
+
+def placement_shard(username, shard_count):
+    """The shard a new user is created on"""
+    return zlib.crc32(username.lower().encode()) % shard_count
+
+
+def _sequence_positions(cur):
+    cur.execute("SELECT sequencename, COALESCE(last_value, 0) FROM pg_sequences WHERE sequencename = ANY(%s)",
+                (list(SEQUENCES),))
+    return dict(cur.fetchall())
+
+
+def init_shard_ids(conns):
+    """Give every shard that has none its residue class of ids.
+
+    ``conns`` are connections to all shards, in shard order. Shards already
+    initialised are only checked against their position.
+    """
+    if len(conns) > SHARD_ID_STRIDE:
+        raise RuntimeError('At most {} shards are supported'.format(SHARD_ID_STRIDE))
+    pending = []
+    floor = 0
+    for shard, conn in enumerate(conns):
+        with conn.cursor() as cur:
+            cur.execute("SELECT shard FROM shard_identity")
+            row = cur.fetchone()
+            if row is not None and row[0] != shard:
+                raise RuntimeError('Database configured as shard {} is shard {}; check the order of POSTGRES_SHARD_DSNS'
+                                   .format(shard, row[0]))
+            if row is None:
+                pending.append(shard)
+            floor = max([floor] + list(_sequence_positions(cur).values()))
+        conn.rollback()
+
+    floor = (floor // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE
+    for shard in pending:
+        conn = conns[shard]
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SHARD_INIT_LOCK_ID,))
+            cur.execute("SELECT 1 FROM shard_identity")
+            if cur.fetchone() is None:
+                for name in SEQUENCES:
+                    cur.execute(sql.SQL("ALTER SEQUENCE {} INCREMENT BY {}").format(
+                        sql.Identifier(name), sql.Literal(SHARD_ID_STRIDE)))
+                    cur.execute("SELECT setval(%s, %s, false)", (name, floor + shard))
+                cur.execute("INSERT INTO shard_identity (shard, id_floor) VALUES (%s, %s)", (shard, floor))
+        conn.commit()
+
+
+class ShardMap:
+    """Cached user id -> ShardEntry lookups in the directory.
+
+    Entries expire after ``ttl`` seconds; move_user.py waits longer than that
+    between changing a user's entry and relying on every worker seeing it.
+    """
+
+    def __init__(self, directory_pool, ttl=5, max_size=10000):
+        self.directory_pool = directory_pool
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, user_id):
+        """The user's ShardEntry; users missing from the directory are on shard 0"""
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._data = OrderedDict()
+                self._pid = os.getpid()
+            cached = self._data.get(user_id)
+            if cached is not None and cached[1] > now:
+                self._data.move_to_end(user_id)
+                return cached[0]
+        with self.directory_pool.connection() as conn:
+            row = get_directory_entry(user_id, lambda: conn)
+        entry = ShardEntry(row['shard'], row['moving']) if row else ShardEntry(0, False)
+        with self._lock:
+            self._data[user_id] = (entry, now + self.ttl)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
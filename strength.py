@@ -0,0 +1,227 @@
+"""Password strength: the configured policy plus a guess-count estimate.
+
+The policy (length and character classes) is compiled once per distinct
+configuration. The estimate follows zxcvbn's approach in a reduced form: the
+password is covered by the cheapest sequence of dictionary words, repeats,
+sequences and brute-forced characters, and the product of their guess
+counts is mapped to a 0-4 score.
+"""
+import math
+import os
+import string
+import threading
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+DICTIONARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wordlists', 'common_passwords.txt')
+
+SPECIAL_CHARS = frozenset('!@#$%^&*(),.?":{}|<>')
+LOWER = frozenset(string.ascii_lowercase)
+UPPER = frozenset(string.ascii_uppercase)
+DIGITS = frozenset(string.digits)
+
+# log10 of the guesses needed to reach each score (as in zxcvbn)
+SCORE_THRESHOLDS = (3, 6, 8, 10)
+# Only this much of a password is scored; the rest can only add guesses
+MAX_SCORED_LENGTH = 100
+MIN_WORD_LENGTH = 3
+LEET = str.maketrans({'4': 'a', '@': 'a', '8': 'b', '(': 'c', '3': 'e', '6': 'g', '1': 'i', '!': 'i',
+                      '|': 'l', '0': 'o', '$': 's', '5': 's', '7': 't', '+': 't', '2': 'z'})
+
+Estimate = namedtuple('Estimate', 'guesses_log10 score feedback')
+
+
+class Dictionary:
+    """Ranked common passwords and words as a sorted array, loaded on first use.
+
+    Substring search walks the array like a trie: extending a candidate stops
+    as soon as no word starts with it.
+    """
+
+    def __init__(self, path=DICTIONARY_FILE):
+        self.path = path
+        self._words = None
+        self._ranks = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._words is None:
+                with open(self.path, encoding='utf-8') as f:
+                    ranked = {}
+                    for rank, line in enumerate(f, 1):
+                        ranked.setdefault(line.strip().lower(), rank)
+                ranked.pop('', None)
+                words = sorted(ranked)
+                self._ranks = array('I', (ranked[word] for word in words))
+                self._words = words
+        return self._words
+
+    def matches(self, text):
+        """Yield (start, end, rank) for every dictionary word inside ``text``"""
+        words = self._words or self._load()
+        ranks = self._ranks
+        n = len(text)
+        for i in range(n - MIN_WORD_LENGTH + 1):
+            lo = 0
+            for j in range(i + MIN_WORD_LENGTH, n + 1):
+                candidate = text[i:j]
+                k = bisect_left(words, candidate, lo)
+                if k == len(words) or not words[k].startswith(candidate):
+                    break
+                lo = k
+                if words[k] == candidate:
+                    yield i, j, ranks[k]
+
+
+DICTIONARY = Dictionary()
+
+
+def _char_cardinality(char):
+    if char in LOWER or char in UPPER:
+        return 26
+    if char in DIGITS:
+        return 10
+    return 33
+
+
+def _case_factor(word):
+    upper = sum(1 for c in word if c.isupper())
+    if not upper or (upper == 1 and word[0].isupper()) or upper == len(word):
+        return 2 if upper else 1
+    return math.comb(len(word), min(upper, len(word) - upper))
+
+
+def _patterns(password, dictionary):
+    """Yield (start, end, guesses, kind) for every pattern found in ``password``"""
+    lowered = password.lower()
+    for i, j, rank in dictionary.matches(lowered):
+        yield i, j, rank * _case_factor(password[i:j]), 'dictionary'
+    unleeted = lowered.translate(LEET)
+    if unleeted != lowered:
+        for i, j, rank in dictionary.matches(unleeted):
+            if unleeted[i:j] != lowered[i:j]:
+                yield i, j, rank * _case_factor(password[i:j]) * 4, 'leet'
+
+    n = len(password)
+    i = 0
+    while i < n:
+        # Runs of one character, and ascending/descending sequences (abc, 987)
+        j = i + 1
+        while j < n and password[j] == password[i]:
+            j += 1
+        if j - i >= 3:
+            yield i, j, _char_cardinality(password[i]) * (j - i), 'repeat'
+        k = i + 1
+        step = ord(password[k]) - ord(password[i]) if k < n else 0
+        if step in (1, -1):
+            while k + 1 < n and ord(password[k + 1]) - ord(password[k]) == step:
+                k += 1
+            if k + 1 - i >= 3:
+                base = 4 if password[i] in 'aAzZ019' else _char_cardinality(password[i])
+                yield i, k + 1, base * (k + 1 - i) * (2 if step < 0 else 1), 'sequence'
+        i = max(j, i + 1) if j - i >= 3 else i + 1
+
+
+def estimate(password, dictionary=DICTIONARY):
+    """Estimate guesses for ``password``; returns Estimate(guesses_log10, score, feedback).
+
+    Guesses stay in log10 space, since the product for a long password does
+    not fit in a float.
+    """
+    password = password[:MAX_SCORED_LENGTH]
+    n = len(password)
+    if not n:
+        return Estimate(0.0, 0, ['Choose a password'])
+
+    ending = [[] for _ in range(n + 1)]
+    for start, end, guesses, kind in _patterns(password, dictionary):
+        ending[end].append((start, guesses, kind))
+
+    # Cheapest cover of the password; best[j] is (log10 guesses, kinds) for password[:j]
+    best = [(0.0, ())] + [None] * n
+    for j in range(1, n + 1):
+        cost, kinds = best[j - 1]
+        candidate = (cost + math.log10(_char_cardinality(password[j - 1])), kinds)
+        for start, guesses, kind in ending[j]:
+            cost = best[start][0] + math.log10(guesses)
+            if cost < candidate[0]:
+                candidate = (cost, best[start][1] + (kind,))
+        best[j] = candidate
+    log_guesses, kinds = best[n]
+
+    score = sum(log_guesses >= threshold for threshold in SCORE_THRESHOLDS)
+    return Estimate(log_guesses, score, _feedback(n, score, kinds))
+
+
+def _feedback(length, score, kinds):
+    if score >= 3:
+        return []
+    feedback = []
+    if 'dictionary' in kinds:
+        feedback.append('Avoid common passwords and dictionary words')
+    if 'leet' in kinds:
+        feedback.append("Predictable substitutions like '@' for 'a' don't help much")
+    if 'repeat' in kinds:
+        feedback.append('Avoid repeated characters')
+    if 'sequence' in kinds:
+        feedback.append('Avoid sequences like abc or 123')
+    if length < 12:
+        feedback.append('Use a longer password; a few unrelated words work well')
+    return feedback
+
+
+def estimate_batch(passwords, dictionary=DICTIONARY):
+    """Estimates for many passwords (e.g. an import), computing duplicates once"""
+    seen = {}
+    return [seen[p] if p in seen else seen.setdefault(p, estimate(p, dictionary)) for p in passwords]
+
+
+class Policy:
+    """Length, character-class and minimum-score requirements"""
+
+    def __init__(self, min_length=8, require_special=True, require_numbers=True,
+                 require_uppercase=True, require_lowercase=True, min_score=0):
+        self.min_length = min_length
+        self.min_score = min_score
+        self.required = tuple((chars, message) for enabled, chars, message in (
+            (require_special, SPECIAL_CHARS, 'Password must contain at least one special character'),
+            (require_numbers, DIGITS, 'Password must contain at least one number'),
+            (require_uppercase, UPPER, 'Password must contain at least one uppercase letter'),
+            (require_lowercase, LOWER, 'Password must contain at least one lowercase letter'),
+        ) if enabled)
+
+    def check(self, password):
+        """Return (is_valid, message) for ``password``"""
+        if len(password) < self.min_length:
+            return False, 'Password must be at least {} characters long'.format(self.min_length)
+
+        # One pass over the password; each class test only looks at its distinct characters
+        chars = set(password)
+        for required, message in self.required:
+            if chars.isdisjoint(required):
+                return False, message
+
+        if self.min_score:
+            result = estimate(password)
+            if result.score < self.min_score:
+                return False, ' '.join(['Password is too easy to guess.'] + [s + '.' for s in result.feedback])
+        return True, 'Password is valid'
+
+
+POLICY_KEYS = ('MIN_PASSWORD_LENGTH', 'REQUIRE_SPECIAL_CHARS', 'REQUIRE_NUMBERS',
+               'REQUIRE_UPPERCASE', 'REQUIRE_LOWERCASE', 'MIN_PASSWORD_SCORE')
+
+_policy = (None, None)
+
+
+def policy_from_config(config):
+    """The Policy for ``config``, rebuilt only when one of its settings changes"""
+    global _policy
+    key = tuple(config.get(name) for name in POLICY_KEYS)
+    cached_key, policy = _policy
+    if key != cached_key:
+        policy = Policy(*key[:5], min_score=key[5] or 0)
+        _policy = (key, policy)
+    return policy
@@ -1,12 +1,20 @@
+import os
+
 import requests
 
+# Token criado numa sessão logada: POST /api/v1/tokens com {"name": "script"}
+BASE_URL = os.getenv("GERENCIADOR_URL", "http://127.0.0.1:5000")
+
 data = {
-    "service": "gmail",
-    "username": "meuemail@gmail.com",
-    "password": "minhaSenha123"
+    "operations": [
+        {"op": "create", "service": "gmail", "username": "meuemail@gmail.com", "password": "minhaSenha123!"},
+        {"op": "create", "service": "github", "username": "meuusuario", "password": "outraSenha456?"},
+    ]
 }
 
-response = requests.post("http://127.0.0.1:5000/save", json=data)
+if __name__ == "__main__":
+    response = requests.post(f"{BASE_URL}/api/v1/entries/batch", json=data,
+                             headers={"Authorization": f"Bearer {os.environ['GERENCIADOR_TOKEN']}"})
 
-print("Status:", response.status_code)
-print("Resposta:", response.json())
+    print("Status:", response.status_code)
+    print("Resposta:", response.json())
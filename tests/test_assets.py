@@ -0,0 +1,37 @@
+import gzip
+import json
+
+from flask import Flask
+
+from assets import Assets
+
+
+def _app(tmp_path):
+    dist = tmp_path / 'dist' / 'css'
+    dist.mkdir(parents=True)
+    (dist / 'app.111111111111.css').write_text('old')
+    (dist / 'app.111111111111.css.gz').write_bytes(gzip.compress(b'old'))
+    (dist / 'app.222222222222.css').write_text('new')
+    (tmp_path / 'dist' / 'manifest.json').write_text(json.dumps({'css/app.css': 'css/app.222222222222.css'}))
+    (tmp_path / 'secret.txt').write_text('secret')
+    assets = Assets(str(tmp_path))
+    app = Flask(__name__)
+    app.add_url_rule('/assets/<path:filename>', 'assets', assets.send)
+    return app.test_client()
+
+
+def test_current_and_earlier_builds_are_served(tmp_path):
+    client = _app(tmp_path)
+    assert client.get('/assets/css/app.222222222222.css').data == b'new'
+    old = client.get('/assets/css/app.111111111111.css', headers={'Accept-Encoding': 'gzip'})
+    assert old.status_code == 200
+    assert old.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in old.headers['Cache-Control']
+
+
+def test_only_hashed_files_under_dist_are_served(tmp_path):
+    client = _app(tmp_path)
+    assert client.get('/assets/manifest.json').status_code == 404
+    assert client.get('/assets/css/app.333333333333.css').status_code == 404
+    assert client.get('/assets/../secret.txt').status_code == 404
+    assert client.get('/assets/css/app.111111111111.css.gz').status_code == 404
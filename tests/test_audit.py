@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+import audit
+from audit import AuditWriter
+
+
+class Pool:
+    @contextmanager
+    def connection(self):
+        yield None
+
+
+def test_failed_batch_is_retried_one_event_at_a_time(monkeypatch):
+    written = []
+
+    def log_audit_batch(events, get_db_func):
+        if any(event[1] == 'bad' for event in events):
+            raise psycopg2.IntegrityError('violates foreign key constraint')
+        written.extend(events)
+
+    monkeypatch.setattr(audit, 'log_audit_batch', log_audit_batch)
+    writer = AuditWriter(Pool())
+    for action in ('login', 'bad', 'logout'):
+        assert writer.submit(1, action, 'details', '127.0.0.1')
+    writer.close()
+
+    assert [event[:4] for event in written] == [(1, 'login', 'details', '127.0.0.1'), (1, 'logout', 'details', '127.0.0.1')]
+    stats = writer.stats()
+    assert (stats['flushed'], stats['failed']) == (2, 1)
+
+
+def test_delayed_flush_keeps_the_submit_time(monkeypatch):
+    written = []
+    monkeypatch.setattr(audit, 'log_audit_batch', lambda events, get_db_func: written.extend(events))
+    writer = AuditWriter(Pool(), flush_interval=0.3)
+    before = datetime.now(timezone.utc)
+    writer.submit(1, 'login', 'details', '127.0.0.1')
+    after = datetime.now(timezone.utc)
+    time.sleep(0.1)
+    writer.submit(1, 'logout', 'details', '127.0.0.1')
+    writer.close()
+
+    (first, second) = written
+    assert before <= first[4] <= after
+    assert second[4] - first[4] >= timedelta(seconds=0.1)
@@ -0,0 +1,20 @@
+from availability import BloomFilter, AvailabilityIndex, key
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    names = ['user{}'.format(i) for i in range(1000)]
+    for name in names:
+        bloom.add(key('username', name))
+    assert all(key('username', name) in bloom for name in names)
+
+
+def test_lookups_use_the_normalized_value():
+    def unavailable():
+        raise OSError('no database in this test')
+
+    index = AvailabilityIndex(unavailable)
+    looked_up = []
+    assert index.is_taken('username', '  Alice \n', lambda value: looked_up.append(value) or True)
+    assert looked_up == ['Alice']
+    assert key('username', ' Alice') == key('username', 'alice ')
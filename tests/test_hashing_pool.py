@@ -0,0 +1,30 @@
+import os
+import time
+
+import pytest
+
+from security import HashingBusy, HashingPool
+
+
+def test_crashed_worker_is_replaced():
+    pool = HashingPool(workers=1, max_pending=0, timeout=30)
+    try:
+        with pytest.raises(HashingBusy):
+            pool.run(os._exit, 1)
+        assert pool.run(abs, -3) == 3
+    finally:
+        pool.shutdown()
+
+
+def test_timed_out_job_keeps_its_slot():
+    pool = HashingPool(workers=1, max_pending=0, timeout=0.2)
+    try:
+        pool.run(abs, 0)  # start the worker
+        with pytest.raises(HashingBusy, match='timed out'):
+            pool.run(time.sleep, 1)
+        with pytest.raises(HashingBusy, match='in progress'):
+            pool.run(abs, 1)
+        time.sleep(1.2)
+        assert pool.run(abs, -2) == 2
+    finally:
+        pool.shutdown()
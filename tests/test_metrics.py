@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+
+from metrics import Registry
+
+
+def _registry(directory):
+    registry = Registry()
+    registry.counter('events_total', 'Events')
+    registry.configure(str(directory), flush_interval=0)
+    return registry
+
+
+def test_concurrent_flushes(tmp_path):
+    registry = _registry(tmp_path)
+    errors = []
+
+    def record():
+        try:
+            for _ in range(200):
+                registry.inc('events_total')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert 'events_total 1600' in registry.render()
+    assert os.listdir(tmp_path) == ['{}.json'.format(os.getpid())]
+
+
+def test_failed_flush_does_not_raise(tmp_path):
+    registry = _registry(tmp_path / 'gone')
+    os.rmdir(tmp_path / 'gone')
+    registry.inc('events_total')
+    registry.inc('events_total')
+    registry.directory = None  # nothing to flush at exit
+
+
+def test_prune_removes_files_of_exited_processes(tmp_path):
+    registry = _registry(tmp_path)
+    registry.inc('events_total')
+    dead = tmp_path / '999999999.json'
+    dead.write_text(json.dumps({'pid': 999999999, 'counters': [], 'histograms': [], 'gauges': []}))
+    registry.prune()
+    assert os.listdir(tmp_path) == ['{}.json'.format(os.getpid())]
@@ -0,0 +1,28 @@
+import time
+
+from ratelimit_storage import SQLiteStorage
+
+
+def test_compaction_keeps_longer_windows_of_other_workers(tmp_path, monkeypatch):
+    uri = 'sqlite://' + str(tmp_path / 'ratelimit.db')
+    hourly = SQLiteStorage(uri, compact_every=1)
+    per_second = SQLiteStorage(uri, compact_every=1)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    assert hourly.acquire_entry('login', 5, 3600)
+    assert per_second.acquire_entry('search', 5, 1)
+
+    monkeypatch.setattr(time, 'time', lambda: now + 10)
+    assert per_second.acquire_entry('search', 5, 1)
+    assert hourly.get_moving_window('login', 5, 3600) == (now, 1)
+    assert per_second.get_moving_window('search', 5, 1) == (now + 10, 1)
+    rows = per_second._db().execute("SELECT COUNT(*) FROM window").fetchone()[0]
+    assert rows == 2
+
+
+def test_moving_window_limit(tmp_path):
+    storage = SQLiteStorage('sqlite://' + str(tmp_path / 'ratelimit.db'))
+    assert all(storage.acquire_entry('key', 3, 60) for _ in range(3))
+    assert not storage.acquire_entry('key', 3, 60)
+    storage.clear('key')
+    assert storage.acquire_entry('key', 3, 60)
@@ -0,0 +1,174 @@
+"""Shard placement, id allocation, the shard map and moving users.
+
+The database tests need at least two scratch PostgreSQL databases, given as
+comma-separated libpq DSNs in TEST_POSTGRES_DSNS (the first one is the
+directory). They are wiped and migrated, so their names must contain
+"test". Without them those tests are skipped.
+"""
+import os
+import time
+
+import psycopg2
+import pytest
+
+from migrate import run_migrations
+from models import create_user, find_directory_user, log_audit, next_user_id, reserve_user, save_password, set_user_shard
+from move_user import move_user
+from pool import ConnectionPool
+from shards import SHARD_ID_STRIDE, ShardEntry, ShardMap, init_shard_ids, placement_shard
+
+TEST_DSNS = [dsn.strip() for dsn in os.getenv('TEST_POSTGRES_DSNS', '').split(',') if dsn.strip()]
+
+needs_shards = pytest.mark.skipif(len(TEST_DSNS) < 2, reason='TEST_POSTGRES_DSNS lists fewer than two databases')
+
+
+def _fresh(dsn):
+    """A connection to an emptied and migrated test database"""
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT current_database()")
+        name = cur.fetchone()[0]
+        if 'test' not in name:
+            conn.close()
+            pytest.fail('refusing to wipe {}: its name does not contain "test"'.format(name))
+        cur.execute("DROP SCHEMA public CASCADE")
+        cur.execute("CREATE SCHEMA public")
+    conn.commit()
+    run_migrations(lambda: conn)
+    return conn
+
+
+@pytest.fixture
+def shard_conns():
+    conns = [_fresh(dsn) for dsn in TEST_DSNS]
+    yield conns
+    for conn in conns:
+        conn.close()
+
+
+@pytest.fixture
+def directory(shard_conns):
+    conn = psycopg2.connect(TEST_DSNS[0])
+    yield conn
+    conn.close()
+
+
+def _add_user(directory, shard_conns, username, shard):
+    conn = shard_conns[shard]
+    user_id = next_user_id(lambda: conn)
+    email = username + '@example.com'
+    assert reserve_user(user_id, username, email, shard, lambda: directory)
+    create_user(user_id, username, email, 'hash', None, None, None, lambda: conn)
+    return user_id
+
+
+def _counts(conn, user_id):
+    """Rows of the user in users, passwords and audit_log"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT (SELECT COUNT(*) FROM users WHERE id = %s),
+                   (SELECT COUNT(*) FROM passwords WHERE user_id = %s),
+                   (SELECT COUNT(*) FROM audit_log WHERE user_id = %s)
+        """, (user_id,) * 3)
+        counts = cur.fetchone()
+    conn.rollback()
+    return counts
+
+
+def _entry(directory, username):
+    row = find_directory_user(username, lambda: directory)
+    directory.rollback()
+    return row['shard'], row['moving']
+
+
+def test_placement_is_stable_and_ignores_case():
+    assert placement_shard('Alice', 4) == placement_shard('alice', 4) == placement_shard('ALICE', 4)
+    assert placement_shard('alice', 1) == 0
+    shards = [placement_shard('user{}'.format(i), 4) for i in range(200)]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+@needs_shards
+def test_each_shard_hands_out_its_residue(shard_conns):
+    init_shard_ids(shard_conns)
+    init_shard_ids(shard_conns)  # already initialised: only checked
+    for shard, conn in enumerate(shard_conns):
+        ids = [next_user_id(lambda: conn) for _ in range(3)]
+        assert [user_id % SHARD_ID_STRIDE for user_id in ids] == [shard] * 3
+        assert ids[1] - ids[0] == ids[2] - ids[1] == SHARD_ID_STRIDE
+
+
+@needs_shards
+def test_reordered_shards_are_refused(shard_conns):
+    init_shard_ids(shard_conns)
+    with pytest.raises(RuntimeError, match='POSTGRES_SHARD_DSNS'):
+        init_shard_ids(list(reversed(shard_conns)))
+
+
+@needs_shards
+def test_move_user_round_trip(shard_conns, directory):
+    init_shard_ids(shard_conns)
+    user_id = _add_user(directory, shard_conns, 'mover', 0)
+    for i in range(5):
+        save_password('service{}'.format(i), 'mover', 'ciphertext', user_id, lambda: shard_conns[0])
+    log_audit(user_id, 'login', 'Successful login', '127.0.0.1', lambda: shard_conns[0])
+
+    move_user(directory, shard_conns, 'mover', 1, wait=0, batch_size=2, report=lambda message: None)
+    assert _entry(directory, 'mover') == (1, False)
+    assert _counts(shard_conns[1], user_id) == (1, 5, 1)
+    assert _counts(shard_conns[0], user_id) == (0, 0, 0)
+
+    move_user(directory, shard_conns, 'mover', 0, wait=0, batch_size=2, report=lambda message: None)
+    assert _entry(directory, 'mover') == (0, False)
+    assert _counts(shard_conns[0], user_id) == (1, 5, 1)
+    assert _counts(shard_conns[1], user_id) == (0, 0, 0)
+
+
+@needs_shards
+def test_failed_move_removes_the_partial_copy(shard_conns, directory):
+    init_shard_ids(shard_conns)
+    user_id = _add_user(directory, shard_conns, 'mover', 0)
+    for i in range(5):
+        save_password('service{}'.format(i), 'mover', 'ciphertext', user_id, lambda: shard_conns[0])
+
+    def report(message):
+        if message.startswith('passwords:'):
+            raise RuntimeError('copy interrupted')
+
+    with pytest.raises(RuntimeError, match='copy interrupted'):
+        move_user(directory, shard_conns, 'mover', 1, wait=0, batch_size=2, report=report)
+    assert _entry(directory, 'mover') == (0, False)
+    assert _counts(shard_conns[1], user_id) == (0, 0, 0)
+    assert _counts(shard_conns[0], user_id) == (1, 5, 0)
+
+
+@needs_shards
+def test_shard_map_caches_for_its_ttl(shard_conns, directory, monkeypatch):
+    init_shard_ids(shard_conns)
+    user_id = _add_user(directory, shard_conns, 'cached', 0)
+    shard_map = ShardMap(ConnectionPool(0, 2, dsn=TEST_DSNS[0]), ttl=60)
+    assert shard_map.get(user_id) == ShardEntry(0, False)
+    assert shard_map.get(-1) == ShardEntry(0, False)
+
+    set_user_shard(user_id, 1, True, lambda: directory)
+    assert shard_map.get(user_id) == ShardEntry(0, False)
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert shard_map.get(user_id) == ShardEntry(1, True)
+
+    set_user_shard(user_id, 1, False, lambda: directory)
+    shard_map.invalidate(user_id)
+    assert shard_map.get(user_id) == ShardEntry(1, False)
+
+
+@needs_shards
+def test_shard_map_starts_empty_after_fork(shard_conns, directory, monkeypatch):
+    init_shard_ids(shard_conns)
+    user_id = _add_user(directory, shard_conns, 'forked', 0)
+    shard_map = ShardMap(ConnectionPool(0, 2, dsn=TEST_DSNS[0]), ttl=60)
+    assert shard_map.get(user_id) == ShardEntry(0, False)
+
+    set_user_shard(user_id, 1, False, lambda: directory)
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    assert shard_map.get(user_id) == ShardEntry(1, False)
@@ -0,0 +1,27 @@
+import secrets
+import string
+
+from strength import MAX_SCORED_LENGTH, Policy, estimate, estimate_batch
+
+
+def test_long_random_password_is_scored():
+    password = ''.join(secrets.choice(string.ascii_letters + string.digits + '!@#') for _ in range(260))
+    result = estimate(password)
+    assert result.score == 4
+    assert result.guesses_log10 > 10
+    assert Policy(min_score=2).check(password + 'Aa1!')[0]
+
+
+def test_only_the_scored_prefix_counts():
+    password = 'x' * (MAX_SCORED_LENGTH * 5)
+    assert estimate(password) == estimate(password[:MAX_SCORED_LENGTH])
+
+
+def test_batch_of_long_passwords():
+    results = estimate_batch(['A1!' + 'qwerty' * 100, 'password'])
+    assert results[0].score >= results[1].score
+    assert results[1].score == 0
+
+
+def test_empty_password():
+    assert estimate('') == (0.0, 0, ['Choose a password'])
@@ -0,0 +1,29 @@
+import io
+
+import pytest
+
+from vault_io import VaultImportError, iter_batches, iter_csv, iter_json
+
+
+def test_csv_and_json_rows():
+    csv_rows = list(iter_csv(io.BytesIO('﻿service,username,password\nmail,ana,s3cret\n'.encode())))
+    json_rows = list(iter_json(io.BytesIO(b'[{"service": "mail", "username": "ana", "password": "s3cret"}]'), chunk_size=7))
+    assert [dict(row) for row in csv_rows] == json_rows == [{'service': 'mail', 'username': 'ana', 'password': 's3cret'}]
+
+
+def test_json_lines():
+    stream = io.BytesIO(b'{"service": "a", "username": "u", "password": "p"}\n{"service": "b", "username": "u", "password": ""}\n')
+    batches = list(iter_batches(iter_json(stream), 10))
+    assert batches == [([('a', 'u', 'p')], [(2, 'missing password')])]
+
+
+@pytest.mark.parametrize('parse, data', [
+    (iter_csv, 'service,username,password\nmail,jos\xe9,x\n'.encode('latin-1')),
+    (iter_csv, b'service,username,password\nmail,ana,"' + b'x' * 200000 + b'"\n'),
+    (iter_json, '[{"service": "mail", "username": "jos\xe9", "password": "x"}]'.encode('latin-1')),
+    (iter_json, b'[{"service": "mail"'),
+    (iter_csv, b'service,username\nmail,ana\n'),
+], ids=['csv-latin1', 'csv-field-too-large', 'json-latin1', 'json-truncated', 'csv-header'])
+def test_unreadable_files_raise_import_errors(parse, data):
+    with pytest.raises(VaultImportError):
+        list(parse(io.BytesIO(data)))
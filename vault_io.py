@@ -0,0 +1,289 @@
+import codecs
+import csv
+import io
+import json
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from crypto import encrypt_password, decrypt_password, fingerprint_password
+from envelope import UserCipher
+from key_ring import KeyRing
+from strength import estimate_batch
+from models import bulk_insert_passwords, stream_user_passwords
+
+FIELDS = ('service', 'username', 'password')
+MAX_FIELD_LENGTH = {'service': 100, 'username': 100}
+
+
+class VaultImportError(ValueError):
+    """Raised when an import stream cannot be parsed"""
+
+
+def iter_csv(stream):
+    """Yield rows of a CSV stream with a service,username,password header"""
+    reader = csv.DictReader(codecs.getreader('utf-8-sig')(stream))
+    try:
+        missing = set(FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            raise VaultImportError('CSV header is missing: {}'.format(', '.join(sorted(missing))))
+        yield from reader
+    except UnicodeDecodeError:
+        raise VaultImportError('The file is not UTF-8 text') from None
+    except csv.Error as e:
+        raise VaultImportError('Invalid CSV near line {}: {}'.format(reader.line_num, e)) from None
+
+
+def _decode(decoder, chunk):
+    try:
+        return decoder.decode(chunk, final=not chunk)
+    except UnicodeDecodeError:
+        raise VaultImportError('The file is not UTF-8 text') from None
+
+
+def iter_json(stream, chunk_size=65536):
+    """Yield objects from a JSON array or from JSON Lines without loading the whole stream"""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8-sig')()
+    buf = ''
+    pos = 0
+    in_array = None
+    eof = False
+    while True:
+        # Skip whitespace and separators, reading more input when needed
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ',')):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = stream.read(chunk_size)
+            buf, pos = buf[pos:] + _decode(text, chunk), 0
+            eof = not chunk
+        if pos >= len(buf):
+            if in_array:
+                raise VaultImportError('Unterminated JSON array')
+            return
+        if in_array is None:
+            in_array = buf[pos] == '['
+            pos += in_array
+            continue
+        if in_array and buf[pos] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise VaultImportError('Invalid JSON near offset {}'.format(pos))
+            chunk = stream.read(chunk_size)
+            buf, pos = buf[pos:] + _decode(text, chunk), 0
+            eof = not chunk
+            continue
+        if end == len(buf) and not eof:
+            # A number or literal may continue in the next chunk
+            chunk = stream.read(chunk_size)
+            buf, pos = buf[pos:] + _decode(text, chunk), 0
+            eof = not chunk
+            continue
+        pos = end
+        if not isinstance(obj, dict):
+            raise VaultImportError('Expected JSON objects with service, username and password')
+        yield obj
+
+
+def validate_row(row):
+    """Return (service, username, password) or raise ValueError"""
+    values = []
+    for field in FIELDS:
+        value = row.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('missing {}'.format(field))
+        if len(value) > MAX_FIELD_LENGTH.get(field, len(value)):
+            raise ValueError('{} too long'.format(field))
+        values.append(value.strip() if field != 'password' else value)
+    return tuple(values)
+
+
+def iter_batches(rows, batch_size):
+    """Validate rows and group them; yields (batch, rejected) pairs"""
+    batch, rejected = [], []
+    for number, row in enumerate(rows, 1):
+        try:
+            batch.append(validate_row(row))
+        except ValueError as e:
+            rejected.append((number, str(e)))
+        if len(batch) >= batch_size:
+            yield batch, rejected
+            batch, rejected = [], []
+    if batch or rejected:
+        yield batch, rejected
+
+
+_cipher = None
+_fingerprint_key = None
+_user_id = None
+_min_score = 0
+
+
+def _init_worker(dek, keys, fingerprint_key, user_id, min_score):
+    global _cipher, _fingerprint_key, _user_id, _min_score
+    _cipher = UserCipher(dek, KeyRing(keys))
+    _fingerprint_key = fingerprint_key
+    _user_id = user_id
+    _min_score = min_score
+
+
+def _encrypt_batch(batch):
+    """Encrypt and fingerprint a batch; also count passwords scoring below the policy"""
+    weak = sum(result.score < _min_score for result in estimate_batch([password for _, _, password in batch]))
+    rows = [(service, username, encrypt_password(password, _cipher),
+             fingerprint_password(password, _fingerprint_key, _user_id))
+            for service, username, password in batch]
+    return rows, weak
+
+
+def import_passwords(rows, user_id, get_db_func, dek, ring, fingerprint_key, batch_size=500, workers=2, min_score=0):
+    """Validate, encrypt and COPY ``rows`` into the user's vault in one transaction.
+
+    Batches are encrypted on a process pool while earlier ones are being
+    loaded. Returns (imported, rejected, weak) where rejected lists (row
+    number, reason) for rows that were skipped and weak counts imported
+    passwords whose strength score is below ``min_score``.
+    """
+    rejected = []
+    weak = 0
+
+    def encrypted_batches(submit):
+        nonlocal weak
+        pending = []
+        for batch, batch_rejected in iter_batches(rows, batch_size):
+            rejected.extend(batch_rejected)
+            if batch:
+                pending.append(submit(_encrypt_batch, batch))
+            if len(pending) > max(workers, 1):
+                encrypted, batch_weak = pending.pop(0).result()
+                weak += batch_weak
+                yield encrypted
+        for future in pending:
+            encrypted, batch_weak = future.result()
+            weak += batch_weak
+            yield encrypted
+
+    initargs = (dek, ring.keys, fingerprint_key, user_id, min_score)
+    if workers > 1:
+        # Not forked: the app's workers hold pooled connections and threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'),
+                                 initializer=_init_worker, initargs=initargs) as executor:
+            imported = bulk_insert_passwords(encrypted_batches(executor.submit), user_id, get_db_func)
+    else:
+        _init_worker(*initargs)
+        imported = bulk_insert_passwords(encrypted_batches(_run_inline), user_id, get_db_func)
+    return imported, rejected, weak
+
+
+def _run_inline(func, *args):
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def export_passwords(user_id, get_db_func, cipher, fmt='csv'):
+    """Yield the decrypted vault as CSV or a JSON array, a chunk at a time"""
+    rows = stream_user_passwords(user_id, get_db_func)
+    if fmt == 'json':
+        yield '['
+        first = True
+        for row in rows:
+            entry = {'service': row['service'], 'username': row['username'],
+                     'password': decrypt_password(row['password'], cipher)}
+            yield ('' if first else ',') + '\n' + json.dumps(entry)
+            first = False
+        yield '\n]\n'
+        return
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    for n, row in enumerate(rows, 1):
+        writer.writerow((row['service'], row['username'], decrypt_password(row['password'], cipher)))
+        if n % 500 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def main():
+    import argparse
+    import getpass
+    import sys
+
+    import psycopg2
+    from psycopg2.extras import DictCursor
+
+    from config import Config
+    from crypto import load_key, load_fingerprint_key
+    from envelope import unwrap_dek
+    from models import find_directory_user, log_audit
+    from shards import shard_connect_kwargs
+    from security import verify_password
+
+    parser = argparse.ArgumentParser(description='Bulk import/export of a user vault')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('username')
+    parser.add_argument('path', nargs='?', default='-', help='file to import, or export destination (default: stdout)')
+    parser.add_argument('--format', choices=('csv', 'json'), help='default: from the file extension')
+    parser.add_argument('--workers', type=int, default=Config.BULK_IMPORT_WORKERS)
+    args = parser.parse_args()
+    fmt = args.format or ('json' if args.path.lower().endswith(('.json', '.jsonl')) else 'csv')
+
+    shard_kwargs = shard_connect_kwargs(vars(Config))
+    directory = psycopg2.connect(**shard_kwargs[0])
+    try:
+        entry = find_directory_user(args.username, lambda: directory)
+    finally:
+        directory.close()
+    if entry is None:
+        parser.error('unknown user {}'.format(args.username))
+    if entry['moving']:
+        parser.error('{} is being moved to another shard; try again shortly'.format(args.username))
+
+    conn = psycopg2.connect(**shard_kwargs[entry['shard']])
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT id, hashed_password, dek_wrapped, dek_salt, kdf_iterations
+                FROM users WHERE id = %s
+            """, (entry['user_id'],))
+            user = cur.fetchone()
+        conn.rollback()
+        if not user['dek_wrapped']:
+            parser.error('{} has no data key yet; log in once through the web interface'.format(args.username))
+        master_password = getpass.getpass('Master password for {}: '.format(args.username))
+        if not verify_password(user['hashed_password'], master_password):
+            parser.error('wrong master password')
+        dek = unwrap_dek(user['dek_wrapped'], master_password, user['dek_salt'], user['kdf_iterations'])
+        ring = load_key()
+
+        if args.command == 'import':
+            stream = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+            with stream:
+                rows = iter_json(stream) if fmt == 'json' else iter_csv(stream)
+                imported, rejected, weak = import_passwords(rows, user['id'], lambda: conn, dek, ring, load_fingerprint_key(),
+                                                            Config.BULK_IMPORT_BATCH_SIZE, args.workers,
+                                                            Config.MIN_PASSWORD_SCORE)
+            log_audit(user['id'], 'bulk_import', 'Imported {} passwords ({} rejected)'.format(imported, len(rejected)),
+                      'cli', lambda: conn)
+            for number, reason in rejected:
+                print('row {}: {}'.format(number, reason), file=sys.stderr)
+            print('Imported {} passwords ({} weak), {} rejected.'.format(imported, weak, len(rejected)), file=sys.stderr)
+        else:
+            out = sys.stdout if args.path == '-' else open(args.path, 'w', newline='')
+            with out:
+                for chunk in export_passwords(user['id'], lambda: conn, UserCipher(dek, ring), fmt):
+                    out.write(chunk)
+            log_audit(user['id'], 'bulk_export', 'Exported vault as {}'.format(fmt), 'cli', lambda: conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
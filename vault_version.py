@@ -0,0 +1,138 @@
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from flask import Response, current_app, g, request, session
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'vault_version'
+
+
+class VaultVersionCache:
+    """In-process cache of per-user vault versions.
+
+    A background thread LISTENs on the ``vault_version`` channel, which the
+    data layer notifies on every vault write, and updates cached entries as
+    other workers commit. The writing process also invalidates its own entry
+    after the request, so its next read is never stale. Entries expire after
+    ``ttl`` seconds, and while a listener is disconnected nothing is served
+    from the cache. ``connect`` may be a list, one per shard, each with its
+    own listener.
+    """
+
+    def __init__(self, connect, ttl=30, max_size=10000, listen=True):
+        self.connects = list(connect) if isinstance(connect, (list, tuple)) else [connect]
+        self.ttl = ttl
+        self.max_size = max_size
+        self.listen = listen
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = set()
+        self._pid = None
+
+    def _ensure_started(self):
+        """Start the listener thread once per process (fork-safe)"""
+        if not self.listen or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._data = OrderedDict()
+            self._listening = set()
+            self._pid = os.getpid()
+            for index, connect in enumerate(self.connects):
+                threading.Thread(target=self._run, args=(index, connect), name='vault-version-listener-{}'.format(index),
+                                 daemon=True).start()
+
+    def get(self, user_id, load):
+        """The user's version, calling ``load()`` on a miss"""
+        self._ensure_started()
+        now = time.monotonic()
+        if len(self._listening) == len(self.connects) or not self.listen:
+            with self._lock:
+                entry = self._data.get(user_id)
+                if entry is not None and entry[1] > now:
+                    self._data.move_to_end(user_id)
+                    return entry[0]
+        version = load()
+        self.set(user_id, version)
+        return version
+
+    def set(self, user_id, version):
+        with self._lock:
+            current = self._data.get(user_id)
+            if current is not None and current[0] > version:
+                return
+            self._data[user_id] = (version, time.monotonic() + self.ttl)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def _run(self, index, connect):
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute('LISTEN ' + CHANNEL)
+                # Anything cached before listening may have missed notifications
+                with self._lock:
+                    self._data.clear()
+                self._listening.add(index)
+                while True:
+                    if select.select([conn], [], [], 5) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            user_id, _, version = conn.notifies.pop(0).payload.partition(':')
+                            self.set(int(user_id), int(version))
+            except Exception:
+                logger.warning('Vault version listener disconnected; retrying', exc_info=True)
+            finally:
+                self._listening.discard(index)
+                if conn is not None:
+                    conn.close()
+            time.sleep(1)
+
+
+def vault_etag(user_id, load):
+    """Weak ETag of everything derived from the user's vault"""
+    version = g.vault_version = current_app.vault_versions.get(user_id, load)
+    return 'vault-{}-{}-{}'.format(user_id, version, current_app.build_id)
+
+
+def replica_behind(load):
+    """Whether this request read the vault from a replica that has not caught
+    up with the version in its ETag; such a page is read again from the primary.
+
+    ``load`` reads the version through the request's read connection.
+    """
+    return 'read_db_conn' in g and load() < g.get('vault_version', 0)
+
+
+def not_modified(etag):
+    """A 304 response if the client already has ``etag``, else None.
+
+    Pages with pending flash messages are always rendered.
+    """
+    if '_flashes' in session or not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    return with_etag(response, etag)
+
+
+def with_etag(response, etag):
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    # Always revalidate; the vault can change from another device
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response